@@ -0,0 +1,103 @@
+"""
+File hashing microbenchmark.
+
+Hashes synthetic files with old 128-byte reads and with `davo.utils.hashing`
+(single file and thread pool) and prints one JSON line per method: wall
+time and throughput. Files are hashed once before measuring, so all
+methods read from page cache.
+
+Usage:
+    python benchmarks/hash_bench.py --files 8 --size 64M --threads 4
+    python benchmarks/hash_bench.py --algorithm crc32
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from davo.services.s3sync import throttle
+from davo.utils import hashing
+
+
+def hash_old(file_path, algorithm):
+    hash_value = hashing.new(algorithm)
+    with open(file_path, "rb") as file:
+        while True:
+            block = file.read(128)
+            if not block:
+                break
+            hash_value.update(block)
+    return hash_value.hexdigest()
+
+
+def run(name, func, paths, size):
+    start = time.monotonic()
+    func(paths)
+    elapsed = time.monotonic() - start
+    print(
+        json.dumps(
+            {
+                "method": name,
+                "files": len(paths),
+                "bytes": size,
+                "seconds": round(elapsed, 4),
+                "mb_per_second": round(size / elapsed / 1024**2, 1),
+            }
+        ),
+        flush=True,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--files", type=int, default=4)
+    parser.add_argument("--size", type=throttle.parse_rate, default="32M")
+    parser.add_argument("--threads", type=int, default=os.cpu_count())
+    parser.add_argument(
+        "--algorithm", default=hashing.MD5, choices=hashing.algorithms()
+    )
+    parser.add_argument(
+        "--skip-old", action="store_true", help="skip slow 128-byte reads"
+    )
+    args = parser.parse_args()
+    names = (args.algorithm,)
+    part_size = 8 * 1024**2
+
+    with tempfile.TemporaryDirectory(prefix="hash-bench-") as root:
+        paths = []
+        for num in range(args.files):
+            file_path = os.path.join(root, "{}.bin".format(num))
+            with open(file_path, "wb") as file:
+                file.write(os.urandom(args.size))
+            paths.append(file_path)
+        size = args.size * args.files
+        # warm page cache
+        list(hashing.hash_files(paths, (hashing.CRC32,)))
+
+        if not args.skip_old and args.algorithm != hashing.ETAG:
+            run(
+                "read-128",
+                lambda paths: [hash_old(p, args.algorithm) for p in paths],
+                paths,
+                size,
+            )
+        run(
+            "readinto",
+            lambda paths: list(hashing.hash_files(paths, names, part_size)),
+            paths,
+            size,
+        )
+        run(
+            "readinto-threads-{}".format(args.threads),
+            lambda paths: list(
+                hashing.hash_files(paths, names, part_size, args.threads)
+            ),
+            paths,
+            size,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,474 @@
+"""
+Local S3-compatible stand-in for s3sync benchmarks.
+
+Serves the subset of S3 REST API used by boto 2 in s3sync (listing,
+object get/put/head/delete, server-side copy, multipart upload and copy,
+multi-object delete, acl) from memory, with configurable per-request
+latency and per-request bandwidth. Requests are counted by method and
+operation.
+"""
+
+import collections
+import datetime
+import hashlib
+import http.server
+import itertools
+import threading
+import time
+import urllib.parse
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+_NS = "http://s3.amazonaws.com/doc/2006-03-01/"
+_XML = '<?xml version="1.0" encoding="UTF-8"?>\n'
+
+
+def _now():
+    return datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+class Object:
+    __slots__ = ("data", "etag", "last_modified")
+
+    def __init__(self, data, etag=None):
+        self.data = data
+        self.etag = etag or '"{}"'.format(hashlib.md5(data).hexdigest())
+        self.last_modified = _now()
+
+
+class Store:
+    """
+    In-memory buckets, multipart uploads and request counters.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = collections.defaultdict(dict)
+        self.uploads = {}
+        self.requests = collections.Counter()
+        self._ids = itertools.count(1)
+
+    def reset_requests(self):
+        with self.lock:
+            requests = dict(self.requests)
+            self.requests.clear()
+        return requests
+
+    def count(self, operation):
+        with self.lock:
+            self.requests[operation] += 1
+
+    def new_upload(self, bucket, key):
+        with self.lock:
+            upload_id = "upload{}".format(next(self._ids))
+            self.uploads[upload_id] = (bucket, key, {})
+        return upload_id
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "S3Stub"
+    # headers and body are written separately
+    disable_nagle_algorithm = True
+
+    # set by `serve`
+    store = None
+    latency = 0.0
+    bandwidth = 0
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def _route(self):
+        url = urllib.parse.urlsplit(self.path)
+        parts = url.path.lstrip("/").split("/", 1)
+        bucket = urllib.parse.unquote(parts[0])
+        key = urllib.parse.unquote(parts[1]) if len(parts) > 1 else ""
+        query = urllib.parse.parse_qs(url.query, keep_blank_values=True)
+        query = {name: values[0] for name, values in query.items()}
+        return bucket, key, query
+
+    def _throttle(self, size):
+        if self.bandwidth and size:
+            time.sleep(size / float(self.bandwidth))
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        data = self.rfile.read(length) if length else b""
+        self._throttle(len(data))
+        return data
+
+    def _send(self, status=200, body=b"", headers=None, head=False):
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not head and body:
+            self._throttle(len(body))
+            self.wfile.write(body)
+
+    def _xml(self, root, content, status=200):
+        self._send(
+            status,
+            '{}<{} xmlns="{}">{}</{}>'.format(_XML, root, _NS, content, root),
+            {"Content-Type": "application/xml"},
+        )
+
+    def _error(self, status, code):
+        self._send(
+            status,
+            "{}<Error><Code>{}</Code><Message>{}</Message></Error>".format(
+                _XML, code, code
+            ),
+            {"Content-Type": "application/xml"},
+        )
+
+    def _handle(self, method):
+        time.sleep(self.latency)
+        bucket, key, query = self._route()
+        operation = next(
+            (
+                name
+                for name in ("uploads", "uploadId", "delete", "acl")
+                if name in query
+            ),
+            "object" if key else "bucket",
+        )
+        if method == "PUT" and "x-amz-copy-source" in self.headers:
+            operation = "copy"
+        self.store.count("{} {}".format(method, operation))
+
+        handler = getattr(self, "_{}_{}".format(method, operation).lower())
+        handler(bucket, key, query)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self._handle("GET")
+
+    def do_HEAD(self):  # pylint: disable=invalid-name
+        self._handle("HEAD")
+
+    def do_PUT(self):  # pylint: disable=invalid-name
+        self._handle("PUT")
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        self._handle("POST")
+
+    def do_DELETE(self):  # pylint: disable=invalid-name
+        self._handle("DELETE")
+
+    # bucket
+
+    def _head_bucket(self, bucket, key, query):
+        self._send(head=True)
+
+    def _get_bucket(self, bucket, key, query):
+        prefix = query.get("prefix", "")
+        delimiter = query.get("delimiter")
+        marker = query.get("marker", "")
+        max_keys = int(query.get("max-keys", 1000))
+
+        with self.store.lock:
+            names = sorted(self.store.buckets[bucket])
+
+        contents, prefixes = [], []
+        truncated = False
+        last = None
+        for name in names:
+            if name <= marker or not name.startswith(prefix):
+                continue
+            if delimiter and marker.endswith(delimiter):
+                # previous page ended with common prefix
+                if name.startswith(marker):
+                    continue
+            if len(contents) + len(prefixes) >= max_keys:
+                truncated = True
+                break
+            rest = name[len(prefix) :]
+            if delimiter and delimiter in rest:
+                sub = prefix + rest.split(delimiter, 1)[0] + delimiter
+                if prefixes and prefixes[-1] == sub:
+                    continue
+                prefixes.append(sub)
+                last = sub
+                continue
+            obj = self.store.buckets[bucket].get(name)
+            if obj is None:
+                continue
+            contents.append(
+                "<Contents><Key>{}</Key><LastModified>{}</LastModified>"
+                "<ETag>{}</ETag><Size>{}</Size>"
+                "<StorageClass>STANDARD</StorageClass></Contents>".format(
+                    escape(name),
+                    obj.last_modified,
+                    escape(obj.etag),
+                    len(obj.data),
+                )
+            )
+            last = name
+
+        content = (
+            "<Name>{}</Name><Prefix>{}</Prefix><Marker>{}</Marker>"
+            "<MaxKeys>{}</MaxKeys><IsTruncated>{}</IsTruncated>".format(
+                bucket,
+                escape(prefix),
+                escape(marker),
+                max_keys,
+                "true" if truncated else "false",
+            )
+        )
+        if truncated and last:
+            content += "<NextMarker>{}</NextMarker>".format(escape(last))
+        content += "".join(contents)
+        content += "".join(
+            "<CommonPrefixes><Prefix>{}</Prefix></CommonPrefixes>".format(
+                escape(sub)
+            )
+            for sub in prefixes
+        )
+        self._xml("ListBucketResult", content)
+
+    # objects
+
+    def _object(self, bucket, key):
+        with self.store.lock:
+            return self.store.buckets[bucket].get(key)
+
+    def _object_headers(self, obj):
+        return {
+            "ETag": obj.etag,
+            "Last-Modified": datetime.datetime.strptime(
+                obj.last_modified, "%Y-%m-%dT%H:%M:%S.000Z"
+            ).strftime("%a, %d %b %Y %H:%M:%S GMT"),
+            "Content-Type": "application/octet-stream",
+        }
+
+    def _get_object(self, bucket, key, query, head=False):
+        obj = self._object(bucket, key)
+        if obj is None:
+            self._error(404, "NoSuchKey")
+            return
+
+        headers = self._object_headers(obj)
+        data = obj.data
+        status = 200
+        ranged = self.headers.get("Range")
+        if ranged and ranged.startswith("bytes="):
+            start, end = ranged[len("bytes=") :].split("-")
+            start, end = int(start), min(int(end), len(data) - 1)
+            headers["Content-Range"] = "bytes {}-{}/{}".format(
+                start, end, len(data)
+            )
+            data = data[start : end + 1]
+            status = 206
+        if head:
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            return
+        self._send(status, data, headers)
+
+    def _head_object(self, bucket, key, query):
+        self._get_object(bucket, key, query, head=True)
+
+    def _put_object(self, bucket, key, query):
+        obj = Object(self._body())
+        with self.store.lock:
+            self.store.buckets[bucket][key] = obj
+        self._send(headers={"ETag": obj.etag})
+
+    def _delete_object(self, bucket, key, query):
+        with self.store.lock:
+            self.store.buckets[bucket].pop(key, None)
+        self._send(204)
+
+    def _source(self, header):
+        source = urllib.parse.unquote(self.headers[header]).lstrip("/")
+        src_bucket, src_key = source.split("/", 1)
+        return self._object(src_bucket, src_key)
+
+    def _put_copy(self, bucket, key, query):
+        source = self._source("x-amz-copy-source")
+        if source is None:
+            self._error(404, "NoSuchKey")
+            return
+
+        if "uploadId" in query:
+            self._copy_part(source, query)
+            return
+
+        obj = Object(source.data, source.etag)
+        with self.store.lock:
+            self.store.buckets[bucket][key] = obj
+        self._xml(
+            "CopyObjectResult",
+            "<LastModified>{}</LastModified><ETag>{}</ETag>".format(
+                obj.last_modified, escape(obj.etag)
+            ),
+        )
+
+    def _copy_part(self, source, query):
+        data = source.data
+        ranged = self.headers.get("x-amz-copy-source-range")
+        if ranged:
+            start, end = ranged[len("bytes=") :].split("-")
+            data = data[int(start) : int(end) + 1]
+        etag = self._save_part(query, data)
+        self._xml(
+            "CopyPartResult",
+            "<LastModified>{}</LastModified><ETag>{}</ETag>".format(
+                _now(), escape(etag)
+            ),
+        )
+
+    # acl
+
+    def _get_acl(self, bucket, key, query):
+        self._xml(
+            "AccessControlPolicy",
+            "<Owner><ID>stub</ID></Owner><AccessControlList>"
+            "</AccessControlList>",
+        )
+
+    def _put_acl(self, bucket, key, query):
+        self._body()
+        self._send()
+
+    # multipart
+
+    def _post_uploads(self, bucket, key, query):
+        upload_id = self.store.new_upload(bucket, key)
+        self._xml(
+            "InitiateMultipartUploadResult",
+            "<Bucket>{}</Bucket><Key>{}</Key><UploadId>{}</UploadId>".format(
+                bucket, escape(key), upload_id
+            ),
+        )
+
+    def _get_uploads(self, bucket, key, query):
+        prefix = query.get("prefix", "")
+        with self.store.lock:
+            uploads = [
+                (upload_id, name)
+                for upload_id, (upload_bucket, name, _parts) in (
+                    self.store.uploads.items()
+                )
+                if upload_bucket == bucket and name.startswith(prefix)
+            ]
+        self._xml(
+            "ListMultipartUploadsResult",
+            "<Bucket>{}</Bucket><IsTruncated>false</IsTruncated>{}".format(
+                bucket,
+                "".join(
+                    "<Upload><Key>{}</Key><UploadId>{}</UploadId>"
+                    "</Upload>".format(escape(name), upload_id)
+                    for upload_id, name in uploads
+                ),
+            ),
+        )
+
+    def _save_part(self, query, data):
+        with self.store.lock:
+            _bucket, _key, parts = self.store.uploads[query["uploadId"]]
+            parts[int(query["partNumber"])] = data
+        return '"{}"'.format(hashlib.md5(data).hexdigest())
+
+    def _put_uploadid(self, bucket, key, query):
+        etag = self._save_part(query, self._body())
+        self._send(headers={"ETag": etag})
+
+    def _get_uploadid(self, bucket, key, query):
+        with self.store.lock:
+            _bucket, _key, parts = self.store.uploads[query["uploadId"]]
+            parts = sorted(parts.items())
+        self._xml(
+            "ListPartsResult",
+            "<IsTruncated>false</IsTruncated>{}".format(
+                "".join(
+                    "<Part><PartNumber>{}</PartNumber><ETag>\"{}\"</ETag>"
+                    "<Size>{}</Size></Part>".format(
+                        num, hashlib.md5(data).hexdigest(), len(data)
+                    )
+                    for num, data in parts
+                )
+            ),
+        )
+
+    def _post_uploadid(self, bucket, key, query):
+        self._body()
+        with self.store.lock:
+            _bucket, _key, parts = self.store.uploads.pop(query["uploadId"])
+        parts = [data for _num, data in sorted(parts.items())]
+        etag = '"{}-{}"'.format(
+            hashlib.md5(
+                b"".join(hashlib.md5(data).digest() for data in parts)
+            ).hexdigest(),
+            len(parts),
+        )
+        with self.store.lock:
+            self.store.buckets[bucket][key] = Object(b"".join(parts), etag)
+        self._xml(
+            "CompleteMultipartUploadResult",
+            "<Bucket>{}</Bucket><Key>{}</Key><ETag>{}</ETag>".format(
+                bucket, escape(key), escape(etag)
+            ),
+        )
+
+    def _delete_uploadid(self, bucket, key, query):
+        with self.store.lock:
+            self.store.uploads.pop(query["uploadId"], None)
+        self._send(204)
+
+    # multi-object delete
+
+    def _post_delete(self, bucket, key, query):
+        root = ET.fromstring(self._body())
+        quiet = (root.findtext("Quiet") or "").lower() == "true"
+        names = [
+            element.findtext("Key") for element in root.iter("Object")
+        ]
+        with self.store.lock:
+            for name in names:
+                self.store.buckets[bucket].pop(name, None)
+        self._xml(
+            "DeleteResult",
+            ""
+            if quiet
+            else "".join(
+                "<Deleted><Key>{}</Key></Deleted>".format(escape(name))
+                for name in names
+            ),
+        )
+
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+def serve(latency=0.0, bandwidth=0, host="127.0.0.1", port=0):
+    """
+    Start stand-in in background thread.
+
+    :param float latency: seconds added to every request
+    :param int bandwidth: bytes per second of each request body, 0 is
+        unlimited
+    :param str host:
+    :param int port: 0 picks free one
+
+    :return: server (address in `server_address`) and its store
+    :rtype: tuple[Server, Store]
+    """
+    store = Store()
+    handler = type(
+        "Handler",
+        (Handler,),
+        {"store": store, "latency": latency, "bandwidth": bandwidth},
+    )
+    server = Server((host, port), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, store
@@ -0,0 +1,286 @@
+"""
+s3sync transfer benchmark.
+
+Runs s3sync commands against local S3 stand-in (see `s3_stub`) on
+synthetic trees and prints one JSON line per measured phase: wall time,
+requests (total, per file and by operation) and peak RSS. Each phase runs
+in own process, so peak RSS is per phase.
+
+Phases, in order: `update -U` (upload to empty bucket), `cache-update`,
+`diff` (no changes), `update -D` (download into emptied tree).
+
+Usage:
+    python benchmarks/s3sync_bench.py --threads 1,4,16 --latency 0.005
+    python benchmarks/s3sync_bench.py --scenario tiny --output bench.jsonl
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import s3_stub  # pylint: disable=import-error
+import yaml
+
+KB = 1024
+MB = 1024 * KB
+
+# name: list of (files count, file size)
+SCENARIOS = {
+    "tiny": [(2000, KB)],
+    "huge": [(2, 80 * MB)],
+    "mixed": [(1000, KB), (50, MB), (1, 80 * MB)],
+}
+
+PHASES = (
+    ("upload", ["update", "-r", "-q", "-U"]),
+    ("cache-update", ["cache-update"]),
+    ("diff", ["diff", "-r", "-b"]),
+    ("download", ["update", "-r", "-q", "-D"]),
+)
+
+
+def make_tree(root, spec, scale=1.0):
+    """
+    Write synthetic tree: 100 files per dir, random content.
+
+    :param str root:
+    :param list spec: of (files count, file size)
+    :param float scale: files count multiplier
+
+    :return: files count, total size
+    :rtype: tuple
+    """
+    files, size = 0, 0
+    block = os.urandom(MB)
+    for group, (count, file_size) in enumerate(spec):
+        for num in range(max(int(count * scale), 1)):
+            path = os.path.join(
+                root,
+                "g{}".format(group),
+                "d{:04d}".format(num // 100),
+                "f{:06d}.bin".format(num),
+            )
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as file:
+                # unique head, so files differ
+                head = os.urandom(min(file_size, 16))
+                file.write(head)
+                left = file_size - len(head)
+                while left > 0:
+                    file.write(block[: min(left, len(block))])
+                    left -= len(block)
+            files += 1
+            size += file_size
+    return files, size
+
+
+def _clear_tree(root):
+    shutil.rmtree(root)
+    os.makedirs(root)
+
+
+def _run_phase(project, address, bucket_name, threads, argv, results):
+    """
+    Child process: run one s3sync command, report time and peak RSS.
+    """
+    # pylint: disable=import-outside-toplevel
+    import boto.s3.connection
+
+    from davo.services.s3sync import cli, conf, utils
+
+    os.chdir(project)
+    logging.disable(logging.CRITICAL)
+
+    conf.init(local_root=project)
+    conf.update({"THREAD_MAX_COUNT": threads})
+
+    def _connect_bucket(*_args, **_kwargs):
+        conn = boto.s3.connection.S3Connection(
+            "bench",
+            "bench",
+            host=address[0],
+            port=address[1],
+            is_secure=False,
+            calling_format=boto.s3.connection.OrdinaryCallingFormat(),
+        )
+        return conn.get_bucket(bucket_name, validate=False)
+
+    utils.connect_bucket = _connect_bucket
+
+    namespace = cli.init_parser().parse_args(argv)
+    error = None
+    started = time.perf_counter()
+    try:
+        with open(os.devnull, "w") as devnull:
+            with contextlib.redirect_stdout(devnull):
+                namespace.func(namespace)
+    except BaseException as exc:  # pylint: disable=broad-except
+        error = "{}: {}".format(type(exc).__name__, exc)
+    seconds = time.perf_counter() - started
+
+    results.put(
+        {
+            "seconds": round(seconds, 4),
+            # kilobytes on linux, bytes on macos
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "error": error,
+        }
+    )
+
+
+def _phase_argv(argv, data, threads):
+    if argv[0] == "cache-update":
+        return list(argv)
+    argv = argv + [data]
+    if argv[0] == "update":
+        argv += ["-t", str(threads)]
+    return argv
+
+
+def run(scenario, threads, store, address, workdir, scale=1.0):
+    """
+    Run all phases of scenario with given threads count, in fresh
+    project and bucket.
+
+    :rtype: Iterator[dict]
+    """
+    project = tempfile.mkdtemp(
+        prefix="{}-{}-".format(scenario, threads), dir=workdir
+    )
+    data = os.path.join(project, "data")
+    bucket_name = "bench-{}-{}".format(scenario, threads)
+    with open(os.path.join(project, ".s3sync"), "w") as config:
+        yaml.dump(
+            {
+                "BUCKET": bucket_name,
+                "LOAD_SECRETS": False,
+                "GLOBAL_CONFIG": os.path.join(project, "missing.yaml"),
+            },
+            config,
+        )
+    files, size = make_tree(data, SCENARIOS[scenario], scale=scale)
+
+    context = multiprocessing.get_context("spawn")
+    try:
+        for phase, argv in PHASES:
+            if phase == "download":
+                _clear_tree(data)
+
+            results = context.Queue()
+            store.reset_requests()
+            process = context.Process(
+                target=_run_phase,
+                args=(
+                    project,
+                    address,
+                    bucket_name,
+                    threads,
+                    _phase_argv(argv, data, threads),
+                    results,
+                ),
+            )
+            process.start()
+            result = results.get()
+            process.join()
+            requests = store.reset_requests()
+            if phase == "download":
+                # files actually present, catches lost transfers
+                result["local_files"] = sum(
+                    len(names) for _root, _dirs, names in os.walk(data)
+                )
+
+            yield {
+                "scenario": scenario,
+                "phase": phase,
+                "threads": threads,
+                "files": files,
+                "bytes": size,
+                "requests": sum(requests.values()),
+                "requests_per_file": round(
+                    sum(requests.values()) / float(files), 3
+                ),
+                "requests_by_operation": requests,
+                "mb_per_second": round(size / MB / result["seconds"], 3)
+                if phase in ("upload", "download") and result["seconds"]
+                else None,
+                **result,
+            }
+    finally:
+        shutil.rmtree(project, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=sorted(SCENARIOS),
+        help="scenario to run (repeatable), all by default",
+    )
+    parser.add_argument(
+        "--threads",
+        default="1,4,16",
+        help="comma separated THREAD_MAX_COUNT values",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.005, help="seconds per request"
+    )
+    parser.add_argument(
+        "--bandwidth",
+        type=float,
+        default=0,
+        help="MB/s per request, 0 is unlimited",
+    )
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="files count multiplier"
+    )
+    parser.add_argument("--workdir", help="dir for trees, temp by default")
+    parser.add_argument(
+        "--output", help="append JSON lines to file instead of stdout"
+    )
+    args = parser.parse_args(argv)
+
+    from davo import version  # pylint: disable=import-outside-toplevel
+
+    server, store = s3_stub.serve(
+        latency=args.latency, bandwidth=int(args.bandwidth * MB)
+    )
+    meta = {
+        "version": version.__version__,
+        "python": platform.python_version(),
+        "latency": args.latency,
+        "bandwidth_mb": args.bandwidth,
+        "scale": args.scale,
+    }
+
+    output = open(args.output, "a") if args.output else sys.stdout
+    try:
+        for scenario in args.scenario or sorted(SCENARIOS):
+            for threads in args.threads.split(","):
+                for result in run(
+                    scenario,
+                    int(threads),
+                    store,
+                    server.server_address,
+                    args.workdir,
+                    scale=args.scale,
+                ):
+                    output.write(json.dumps({**meta, **result}) + "\n")
+                    output.flush()
+    finally:
+        server.shutdown()
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -69,6 +69,7 @@ def init_parser():
             "update",
             "cache-clean",
             "cache-update",
+            "manifest",
         ),
     )
 
@@ -40,3 +40,5 @@ STATE_CHOICES = (
 STATE_CHOICES_DICT = dict(STATE_CHOICES)
 
 LOCAL_CONF_PATH = ".dtconf"
+LOCAL_SNAPSHOT_PATH = ".dtsnapshot.db"
+DUPLICATES_CACHE_PATH = ".dtduplicates.db"
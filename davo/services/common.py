@@ -4,6 +4,7 @@ import logging
 import os
 
 import keyring
+import reprint
 
 import davo.utils
 from davo import constants, settings, version
@@ -47,11 +48,17 @@ def command_compare_dirs(
     other=False,
     force=False,
     commit=False,
+    walk_threads=None,
+    snapshot=False,
+    offline=False,
+    sync_threads=4,
 ):
     if sync_in and sync_out:
         raise davo.errors.UserError(
             "sync_in and sync_out are mutually exclusive"
         )
+    if offline and (sync_in or sync_out):
+        raise davo.errors.UserError("offline compare can't sync")
 
     root = davo.utils.path.find_config_root(
         os.getcwd(), constants.LOCAL_CONF_PATH
@@ -72,22 +79,30 @@ def command_compare_dirs(
     if root1 == ".":
         root1 = os.getcwd()
 
-    root1 = os.path.join(root1, "")
+    # compare gives absolute paths
+    root1 = os.path.join(os.path.abspath(root1), "")
     sub_path = root1.replace(root, "").lstrip("/")
 
     if root2:
-        root2 = os.path.join(root2, "")
+        root2 = os.path.join(os.path.abspath(root2), "")
     else:
         root2 = config.get("dest_path")
         if "~" in root2:
             root2 = os.path.expanduser(root2)
-        root2 = os.path.join(root2, sub_path, "")
+        root2 = os.path.join(os.path.abspath(root2), sub_path, "")
 
     if not exclude:
         exclude = [constants.LOCAL_CONF_PATH]
     if config.get("ignore"):
         exclude += config["ignore"]
 
+    store = None
+    if snapshot or offline:
+        exclude = list(exclude) + [constants.LOCAL_SNAPSHOT_PATH]
+        store = davo.utils.snapshot.Snapshot(
+            os.path.join(root, constants.LOCAL_SNAPSHOT_PATH)
+        )
+
     if show_all:
         states = "-+~<>r=?"
     elif this:
@@ -109,9 +124,15 @@ def command_compare_dirs(
             recursive=recursive,
             exclude=exclude,
             verbose=True,
+            walk_threads=walk_threads,
+            snapshot=store,
+            snapshot_only=offline,
         )
     except KeyboardInterrupt:
         raise davo.errors.UserError("KeyboardInterrupt")
+    finally:
+        if store is not None:
+            store.close()
 
     if sync_in or sync_out:
         _make_dirs_sync(
@@ -121,6 +142,7 @@ def command_compare_dirs(
             sync_in=sync_in,
             safe=not force,
             commit=commit,
+            threads=sync_threads,
         )
 
     else:
@@ -136,57 +158,111 @@ def command_compare_dirs(
         davo.utils.path.count_diff(files, verbose=True)
 
 
-def _make_dirs_sync(
-    files, root1, root2, sync_in=False, safe=True, commit=False
-):
-    processed = 0
-    for file, data in files.items():
+def _rebase(path, root_from, root_to):
+    return os.path.join(root_to, os.path.relpath(path, root_from))
+
+
+def _plan_dirs_sync(files, root1, root2, sync_in=False, safe=True):
+    """
+    Make sync operations for compare result.
+
+    :param dict files: see `davo.utils.path.compare_dirs`
+    :param str root1:
+    :param str root2:
+    :param bool sync_in: root2 -> root1, else root1 -> root2
+    :param bool safe: without deleting and overwriting
+
+    :rtype: list[davo.utils.sync.Operation]
+    """
+    operations = []
+    for data in files.values():
+        state = data["state"]
         if sync_in:
-            if data["state"] in ("+", "=", "?"):
-                processed += davo.utils.path.sync_file_remove(
-                    data["path_source"], safe=safe, commit=commit
-                )
+            if state in ("+", "=", "?"):
+                if not safe:
+                    operations.append(
+                        davo.utils.sync.remove(data["path_source"])
+                    )
 
-            elif data["state"] == "r":
-                processed += davo.utils.path.sync_file_rename(
-                    data["path"],
-                    data["path_source"],
-                    root2,
-                    root1,
-                    commit=commit,
+            elif state == "r":
+                operations.append(
+                    davo.utils.sync.move(
+                        data["path_source"],
+                        _rebase(data["path"], root2, root1),
+                    )
                 )
 
-            elif data["state"] in ("-", "~"):
-                processed += davo.utils.path.sync_file(
-                    data["path"], root1, root2, safe=safe, commit=commit
+            elif state in ("-", "~"):
+                operations.append(
+                    davo.utils.sync.copy(
+                        data["path"],
+                        _rebase(data["path"], root2, root1),
+                        overwrite=not safe,
+                    )
                 )
 
-        else:
-            if data["state"] in ("-", "=", "?"):
-                continue
-
-            elif data["state"] == "r":
-                processed += davo.utils.path.sync_file_rename(
-                    data["path_source"],
-                    data["path"],
-                    root1,
-                    root2,
-                    commit=commit,
+        elif state == "r":
+            operations.append(
+                davo.utils.sync.move(
+                    data["path"], _rebase(data["path_source"], root1, root2)
                 )
+            )
 
-            elif data["state"] == "+":
-                processed += davo.utils.path.sync_file(
+        elif state == "+":
+            operations.append(
+                davo.utils.sync.copy(
                     data["path_source"],
-                    root2,
-                    root1,
-                    safe=safe,
-                    commit=commit,
+                    _rebase(data["path_source"], root1, root2),
+                    overwrite=not safe,
                 )
+            )
+    return operations
 
-    if commit:
-        print("processed {}/{}".format(processed, len(files)))
-    else:
-        print("processed (dry-run) {}/{}".format(processed, len(files)))
+
+def _make_dirs_sync(
+    files,
+    root1,
+    root2,
+    sync_in=False,
+    safe=True,
+    commit=False,
+    threads=4,
+):
+    operations = _plan_dirs_sync(
+        files, root1, root2, sync_in=sync_in, safe=safe
+    )
+    if not commit:
+        davo.utils.sync.execute(operations, commit=False)
+        print("processed (dry-run) 0/{}".format(len(files)))
+        return
+
+    with reprint.output(initial_len=1) as output:
+        summary = davo.utils.sync.execute(
+            operations, threads=threads, commit=True, output=output
+        )
+
+    for operation, exc in summary.failed:
+        logger.error(
+            "%s %s %s: %s",
+            operation.action,
+            operation.source,
+            operation.dest or "",
+            exc,
+        )
+    info = "processed {}/{}, skipped existing {}, failed {}".format(
+        summary.done, len(files), summary.skipped, len(summary.failed)
+    )
+    print(
+        "{}, {} in {:.2f}s".format(
+            info,
+            davo.utils.format.humanize_bytes(summary.bytes).strip(),
+            summary.seconds,
+        )
+    )
+    if summary.failed:
+        raise davo.errors.UserError(
+            "{} sync operations failed".format(len(summary.failed))
+        )
 
 
 def init_parser(parser=None, subparsers=None, commands=()):
@@ -244,6 +320,29 @@ def init_parser(parser=None, subparsers=None, commands=()):
             help="force non-safe action like remove files",
         )
         cmd.add_argument("--commit", action="store_true")
+        cmd.add_argument(
+            "--walk-threads",
+            type=int,
+            default=0,
+            help="list dirs on N threads (network mounts)",
+        )
+        cmd.add_argument(
+            "--snapshot",
+            action="store_true",
+            help="reuse hashes of unchanged files and save roots to {}"
+            " next to config".format(constants.LOCAL_SNAPSHOT_PATH),
+        )
+        cmd.add_argument(
+            "--offline",
+            action="store_true",
+            help="compare with last snapshot of root2, without reading it",
+        )
+        cmd.add_argument(
+            "--sync-threads",
+            type=int,
+            default=4,
+            help="copy N files at once on sync",
+        )
         cmd.set_defaults(
             func=lambda namespace: command_compare_dirs(
                 root1=namespace.root1,
@@ -263,5 +362,9 @@ def init_parser(parser=None, subparsers=None, commands=()):
                 other=namespace.other,
                 force=namespace.force,
                 commit=namespace.commit,
+                walk_threads=namespace.walk_threads,
+                snapshot=namespace.snapshot,
+                offline=namespace.offline,
+                sync_threads=namespace.sync_threads,
             )
         )
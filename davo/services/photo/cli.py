@@ -7,6 +7,7 @@ import os
 import davo
 import davo.utils
 import davo.version
+from davo import constants
 
 from . import helpers
 
@@ -375,7 +376,37 @@ def init_parser(parser=None, subparsers=None, commands=()):
             help="search duplicates",
         )
         cmd.add_argument(
-            "-m", "--md5", action="store_true", help="check md5 hash"
+            "-m",
+            "--md5",
+            action="store_true",
+            help="confirm by full md5 hash, otherwise files matched by head"
+            " and tail hash are reported as partial",
+        )
+        cmd.add_argument(
+            "-j",
+            "--threads",
+            type=int,
+            default=os.cpu_count(),
+            help="hashing threads, default %(default)s",
+        )
+        cmd.add_argument(
+            "--cache",
+            nargs="?",
+            const=constants.DUPLICATES_CACHE_PATH,
+            help="keep hashes in sqlite file (relative to root), default"
+            " %(const)s",
+        )
+        cmd.add_argument(
+            "-s",
+            "--similar",
+            action="store_true",
+            help="also find similar images by perceptual hash",
+        )
+        cmd.add_argument(
+            "--distance",
+            type=int,
+            default=3,
+            help="max perceptual hash bits differing, default %(default)s",
         )
         cmd.set_defaults(
             func=lambda namespace: helpers.command_search_duplicates(  # noqa
@@ -383,6 +414,11 @@ def init_parser(parser=None, subparsers=None, commands=()):
                 md5=namespace.md5,
                 recursive=namespace.recursive,
                 verbose=namespace.verbose,
+                threads=namespace.threads,
+                cache=namespace.cache
+                and os.path.join(namespace.path, namespace.cache),
+                similar=namespace.similar,
+                distance=namespace.distance,
             )
         )
 
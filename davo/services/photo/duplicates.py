@@ -0,0 +1,287 @@
+import collections
+import concurrent.futures
+import logging
+import os
+
+from PIL import Image
+
+import davo.utils
+
+logger = logging.getLogger(__name__)
+
+KIND_EXACT = "exact"
+# same size, head and tail, not confirmed by full hash
+KIND_PARTIAL = "partial"
+KIND_SIMILAR = "similar"
+
+IMAGE_EXTENSIONS = {
+    ".bmp",
+    ".gif",
+    ".jpeg",
+    ".jpg",
+    ".png",
+    ".tif",
+    ".tiff",
+    ".webp",
+}
+
+# dhash grid: 8 rows of 8 gradients
+_DHASH_SIZE = 8
+
+Cluster = collections.namedtuple("Cluster", ("kind", "key", "size", "paths"))
+
+
+def scan(root, recursive=False, exclude=()):
+    """
+    List files with size and mtime.
+
+    :param str root:
+    :param bool recursive:
+    :param tuple exclude: see `davo.utils.path.compile_exclude`
+
+    :rtype: list[dict]
+    """
+    files = []
+    for entry in davo.utils.path.iter_file_entries(
+        root, recursive, exclude=exclude
+    ):
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        files.append(
+            {
+                "path": entry.path,
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+            }
+        )
+    return files
+
+
+def _group(files, field):
+    """
+    Split files by field, keep groups of two and more.
+
+    :rtype: list[list[dict]]
+    """
+    groups = collections.defaultdict(list)
+    for options in files:
+        if options.get(field) is not None:
+            groups[options[field]].append(options)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def _fill(files, field, func, threads):
+    """
+    Set field of files missing it to func(options), on thread pool.
+    Files failed to read get None.
+
+    :param list[dict] files:
+    :param str field:
+    :param callable func: options -> value
+    :param int threads:
+    """
+
+    def _call(options):
+        try:
+            return func(options)
+        except OSError as exc:
+            logger.warning("%s: %s", options["path"], exc)
+            return None
+
+    missing = [options for options in files if not options.get(field)]
+    if threads:
+        with concurrent.futures.ThreadPoolExecutor(
+            threads, thread_name_prefix="dupes"
+        ) as pool:
+            results = list(pool.map(_call, missing))
+    else:
+        results = [_call(options) for options in missing]
+    for options, value in zip(missing, results):
+        options[field] = value
+
+
+def _partial_hash(options):
+    return davo.utils.hashing.hash_file_ends(
+        options["path"], options["size"]
+    )
+
+
+def _full_hash(options):
+    return davo.utils.hashing.hash_file(options["path"])[
+        davo.utils.hashing.MD5
+    ]
+
+
+def _hashed_whole(options):
+    return options["size"] <= 2 * davo.utils.hashing.PARTIAL_SIZE
+
+
+def find_duplicates(files, full=False, threads=None):
+    """
+    Find files with same content, in tiers: same size, then same md5 of
+    head and tail (see `davo.utils.hashing.hash_file_ends`), then (with
+    `full`) same full md5. Each tier reads only files left by previous
+    one, hashes already in options (from cache) are reused. Clusters not
+    confirmed by full md5 are `KIND_PARTIAL`, small files hashed whole
+    are always `KIND_EXACT`.
+
+    :param list[dict] files: see `scan`
+    :param bool full: confirm by full md5
+    :param int threads: hashing threads
+
+    :rtype: list[Cluster]
+    """
+    # empty files are all same, not interesting
+    by_size = _group(
+        (options for options in files if options["size"]), "size"
+    )
+    _fill(
+        [options for group in by_size for options in group],
+        "md5_partial",
+        _partial_hash,
+        threads,
+    )
+
+    groups = [
+        same for group in by_size for same in _group(group, "md5_partial")
+    ]
+    to_hash = []
+    for same in groups:
+        if _hashed_whole(same[0]):
+            # hashed whole
+            for options in same:
+                options["md5"] = options["md5_partial"]
+        elif full:
+            to_hash.extend(same)
+    _fill(to_hash, "md5", _full_hash, threads)
+
+    clusters = []
+    for same in groups:
+        if full or _hashed_whole(same[0]):
+            kind, field = KIND_EXACT, "md5"
+        else:
+            kind, field = KIND_PARTIAL, "md5_partial"
+        clusters.extend(
+            Cluster(
+                kind,
+                equal[0][field],
+                equal[0]["size"],
+                sorted(options["path"] for options in equal),
+            )
+            for equal in _group(same, field)
+        )
+    clusters.sort(key=lambda cluster: (-cluster.size, cluster.paths))
+    return clusters
+
+
+def dhash(path):
+    """
+    Perceptual difference hash: signs of horizontal gradients of 9x8
+    grayscale thumbnail, stable under resize and recompression.
+
+    :param str path:
+
+    :return: 64 bit hash, hex
+    :rtype: str
+    """
+    try:
+        with Image.open(path) as image:
+            # decode JPEG scaled down, much faster
+            image.draft("L", (_DHASH_SIZE * 8, _DHASH_SIZE * 8))
+            pixels = (
+                image.convert("L")
+                .resize((_DHASH_SIZE + 1, _DHASH_SIZE), Image.BILINEAR)
+                .tobytes()
+            )
+    except (OSError, SyntaxError, ValueError) as exc:
+        raise OSError("can't read image: {}".format(exc)) from exc
+
+    value = 0
+    for row in range(_DHASH_SIZE):
+        for col in range(_DHASH_SIZE):
+            offset = row * (_DHASH_SIZE + 1) + col
+            value = value << 1 | (pixels[offset] > pixels[offset + 1])
+    return "{:016x}".format(value)
+
+
+def _bands(value, count):
+    """
+    Split 64 bit hash to `count` bit bands: hashes within distance
+    count - 1 share at least one band.
+    """
+    bits = 64
+    width = -(-bits // count)
+    return [
+        (num, (value >> (num * width)) & ((1 << width) - 1))
+        for num in range(count)
+    ]
+
+
+def find_similar(files, distance=3, threads=None, found=()):
+    """
+    Find images with perceptual hashes (see `dhash`) within hamming
+    distance. Candidates come from hash band index, so images are not
+    compared pairwise; similar pairs are joined into clusters.
+
+    :param list[dict] files: see `scan`
+    :param int distance: max different bits of 64
+    :param int threads: decoding threads
+    :param Iterable[Cluster] found: duplicates already found (see
+        `find_duplicates`), only first file of each is compared
+
+    :rtype: list[Cluster]
+    """
+    skip = {path for cluster in found for path in cluster.paths[1:]}
+    images = [
+        options
+        for options in files
+        if os.path.splitext(options["path"])[1].lower() in IMAGE_EXTENSIONS
+        and options["path"] not in skip
+    ]
+    _fill(images, "phash", lambda options: dhash(options["path"]), threads)
+    images = [options for options in images if options.get("phash")]
+
+    # same hashes are joined up front, index holds unique ones
+    by_value = collections.defaultdict(list)
+    for options in images:
+        by_value[int(options["phash"], 16)].append(options)
+    values = list(by_value)
+    index = collections.defaultdict(list)
+    for num, value in enumerate(values):
+        for band in _bands(value, distance + 1):
+            index[band].append(num)
+
+    parents = list(range(len(values)))
+
+    def _find(num):
+        while parents[num] != num:
+            parents[num] = parents[parents[num]]
+            num = parents[num]
+        return num
+
+    for bucket in index.values():
+        for pos, num in enumerate(bucket):
+            for other in bucket[pos + 1 :]:
+                if _find(num) == _find(other):
+                    continue
+                if bin(values[num] ^ values[other]).count("1") <= distance:
+                    parents[_find(other)] = _find(num)
+
+    clusters = collections.defaultdict(list)
+    for num, value in enumerate(values):
+        clusters[_find(num)].extend(by_value[value])
+
+    result = [
+        Cluster(
+            KIND_SIMILAR,
+            group[0]["phash"],
+            sum(options["size"] for options in group),
+            sorted(options["path"] for options in group),
+        )
+        for group in clusters.values()
+        if len(group) > 1
+    ]
+    result.sort(key=lambda cluster: (-cluster.size, cluster.paths))
+    return result
@@ -20,7 +20,7 @@ try:
 except ImportError:
     pass
 
-from . import clients, pdf, replace_classes, utils
+from . import clients, duplicates, pdf, replace_classes, utils
 
 logger = logging.getLogger(__name__)
 
@@ -385,64 +385,95 @@ def command_thumbs(
 
 
 def command_search_copy(root, source_file, recursive):
-    source_hash = davo.utils.path.file_hash(source_file)
-    source_hash_digest = source_hash.digest()
+    source_hash = davo.utils.hashing.hash_file(source_file)["md5"]
     size = os.path.getsize(source_file)
     source_full = os.path.abspath(source_file)
 
-    for file in utils.iter_files(root, recursive=recursive):
-        if source_full == file or size != os.path.getsize(file):
-            continue
-
-        if (
-            h := davo.utils.path.file_hash(file)
-        ) and source_hash_digest == h.digest():
-            logger.info("%s %s", file, source_hash.hexdigest())
+    candidates = (
+        file
+        for file in utils.iter_files(root, recursive=recursive)
+        if source_full != file and size == os.path.getsize(file)
+    )
+    for file, hashes in davo.utils.hashing.hash_files(
+        candidates, threads=os.cpu_count()
+    ):
+        if isinstance(hashes, OSError):
+            logger.warning("%s: %s", file, hashes)
+        elif hashes["md5"] == source_hash:
+            logger.info("%s %s", file, source_hash)
 
 
-def command_search_duplicates(root, md5, recursive, verbose):
-    files = {}
-    for file in utils.iter_files(root, recursive=recursive):
-        files[file] = {
-            "size": os.path.getsize(file),
-        }
-
+def command_search_duplicates(
+    root,
+    md5,
+    recursive,
+    verbose,
+    threads=None,
+    cache=None,
+    similar=False,
+    distance=3,
+):
+    root = os.path.abspath(root)
+    store = None
+    exclude = ()
+    if cache:
+        store = davo.utils.snapshot.Snapshot(cache)
+        exclude = (os.path.basename(cache),)
+
+    files = duplicates.scan(root, recursive=recursive, exclude=exclude)
     logger.info("total: %d", len(files))
+    if store is not None:
+        logger.info(
+            "hashes of %d files reused from cache", store.apply(root, files)
+        )
 
-    for i in utils.iter_files(root, recursive=recursive):
-        # file created after scan
-        if i not in files:
-            continue
-        i_options = files[i]
-        doubles = set()
-        for j, j_options in files.items():
-            if i == j or j_options["size"] != i_options["size"]:
-                continue
-            doubles.add(j)
-
-        if doubles and md5:
-            doubles2 = set()
-            if not i_options.get("hash"):
-                i_options["hash"] = davo.utils.path.file_hash(i)
-            md5sum = i_options["hash"]
-            for j in doubles:
-                j_options = files[j]
-                if not j_options.get("hash"):
-                    j_options["hash"] = davo.utils.path.file_hash(i)
-                if md5sum != j_options["hash"]:
-                    continue
-                doubles2.add(j)
-
-            if doubles2:
-                doubles = doubles2
-
-        if doubles:
-            logger.info(
-                "%s, %s, %s",
-                i.replace(root, "."),
-                len(doubles),
-                ",".join(doubles).replace(root, "."),
+    try:
+        clusters = duplicates.find_duplicates(
+            files, full=md5, threads=threads
+        )
+        if similar:
+            clusters += duplicates.find_similar(
+                files, distance=distance, threads=threads, found=clusters
             )
+    finally:
+        if store is not None:
+            store.save(
+                root,
+                (
+                    options
+                    for options in files
+                    if any(
+                        options.get(field)
+                        for field in davo.utils.snapshot.HASH_FIELDS
+                    )
+                ),
+            )
+            store.close()
+
+    wasted = {duplicates.KIND_EXACT: 0, duplicates.KIND_PARTIAL: 0}
+    for cluster in clusters:
+        if cluster.kind in wasted:
+            wasted[cluster.kind] += cluster.size * (len(cluster.paths) - 1)
+        logger.info(
+            "%s %s, %d files, %s",
+            cluster.kind,
+            cluster.key[:16],
+            len(cluster.paths),
+            davo.utils.format.humanize_bytes(cluster.size).strip(),
+        )
+        for path in cluster.paths:
+            logger.info("  %s", path.replace(root, ".", 1))
+
+    logger.info(
+        "clusters: %d, duplicates: %s, not confirmed by md5: %s",
+        len(clusters),
+        davo.utils.format.humanize_bytes(
+            wasted[duplicates.KIND_EXACT]
+        ).strip(),
+        davo.utils.format.humanize_bytes(
+            wasted[duplicates.KIND_PARTIAL]
+        ).strip(),
+    )
 
 
 def command_convert(
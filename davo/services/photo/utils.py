@@ -18,10 +18,12 @@ logger = logging.getLogger(__name__)
 
 
 def iter_files(root_path, recursive=False, sort=False):
-    it = davo.utils.path.iter_files(root_path, recursive=recursive)
+    it = davo.utils.path.iter_files(
+        root_path, recursive=recursive, sort=sort
+    )
 
     if sort:
-        return sorted(it)
+        return list(it)
 
     return it
 
@@ -1,19 +1,119 @@
+import contextlib
+import datetime
+import logging
 import os
+import queue
 import sqlite3
 import threading
+import time
 
 from . import conf
 
+logger = logging.getLogger(__name__)
+
+TABLE = "s3keys"
+TABLE_STAGING = "s3keys_staging"
+
 QUERY_CREATE_TABLE = (
-    "CREATE TABLE IF NOT EXISTS s3keys ( "
+    "CREATE TABLE IF NOT EXISTS {table} ( "
     "name text unique, "
     "size int, "
     "last_modified text, "
     "etag text, "
     "level int)"
 )
+QUERY_CREATE_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS {table}_level_name ON {table} (level, name)",
+)
+QUERY_CREATE_PREFIXES = (
+    "CREATE TABLE IF NOT EXISTS s3prefixes ( "
+    "prefix text unique, "
+    "refreshed_at text, "
+    "total int, "
+    "last_modified text)"
+)
+QUERY_CREATE_UPLOADS = (
+    "CREATE TABLE IF NOT EXISTS s3uploads ( "
+    "name text unique, "
+    "upload_id text, "
+    "size int, "
+    "mtime_ns int, "
+    "part_size int)"
+)
+QUERY_UPLOADS_UPSERT = (
+    "INSERT INTO s3uploads (name, upload_id, size, mtime_ns, part_size) "
+    "VALUES (:name, :upload_id, :size, :mtime_ns, :part_size) "
+    "ON CONFLICT(name) DO UPDATE SET "
+    "upload_id=excluded.upload_id, "
+    "size=excluded.size, "
+    "mtime_ns=excluded.mtime_ns, "
+    "part_size=excluded.part_size"
+)
+QUERY_UPLOADS_FILTER = (
+    "SELECT name, upload_id, size, mtime_ns, part_size FROM s3uploads"
+)
+QUERY_UPLOADS_DELETE = "DELETE FROM s3uploads WHERE name=?"
+QUERY_CREATE_RANGES = (
+    "CREATE TABLE IF NOT EXISTS s3ranges ( "
+    "name text, "
+    "etag text, "
+    "part_size int, "
+    "part_num int, "
+    "UNIQUE (name, part_num))"
+)
+QUERY_RANGES_INSERT = (
+    "INSERT OR REPLACE INTO s3ranges (name, etag, part_size, part_num) "
+    "VALUES (?, ?, ?, ?)"
+)
+QUERY_RANGES_FILTER = (
+    "SELECT part_num FROM s3ranges WHERE name=? and etag=? and part_size=?"
+)
+QUERY_RANGES_DELETE = "DELETE FROM s3ranges WHERE name=?"
+QUERY_CREATE_LOCAL = (
+    "CREATE TABLE IF NOT EXISTS s3local ( "
+    "path text unique, "
+    "size int, "
+    "mtime_ns int, "
+    "inode int, "
+    "part_size int, "
+    "md5 text, "
+    "etag text)"
+)
+QUERY_LOCAL_UPSERT = (
+    "INSERT INTO s3local "
+    "(path, size, mtime_ns, inode, part_size, md5, etag) "
+    "VALUES (:path, :size, :mtime_ns, :inode, :part_size, :md5, :etag) "
+    "ON CONFLICT(path) DO UPDATE SET "
+    "size=excluded.size, "
+    "mtime_ns=excluded.mtime_ns, "
+    "inode=excluded.inode, "
+    "part_size=excluded.part_size, "
+    "md5=excluded.md5, "
+    "etag=excluded.etag"
+)
+QUERY_LOCAL_FILTER = (
+    "SELECT path, size, mtime_ns, inode, part_size, md5, etag FROM s3local"
+)
+QUERY_CREATE_SEEN = "CREATE TEMP TABLE IF NOT EXISTS s3keys_seen (name text)"
 QUERY_SELECT_TOTAL = "SELECT COUNT(*) FROM s3keys"
 QUERY_TRUNCATE = "DELETE FROM s3keys WHERE level > 0"
+QUERY_PREFIXES_TRUNCATE = "DELETE FROM s3prefixes"
+QUERY_PREFIXES_DELETE = (
+    "DELETE FROM s3prefixes WHERE prefix=? or (prefix>=? and prefix<?)"
+)
+QUERY_PREFIXES_UPSERT = (
+    "INSERT INTO s3prefixes (prefix, refreshed_at, total, last_modified) "
+    "SELECT ?, ?, COUNT(*), MAX(last_modified) FROM s3keys WHERE {where}"
+)
+QUERY_PREFIXES_FILTER = (
+    "SELECT prefix, refreshed_at, total, last_modified FROM s3prefixes"
+)
+QUERY_SEEN_TRUNCATE = "DELETE FROM s3keys_seen"
+QUERY_SEEN_INSERT = "INSERT INTO s3keys_seen (name) VALUES (:name)"
+QUERY_DELETE_UNSEEN = (
+    "DELETE FROM s3keys WHERE {where} "
+    "AND name NOT IN (SELECT name FROM s3keys_seen)"
+)
 QUERY_EXISTS = "SELECT COUNT(*) FROM s3keys WHERE name=?"
 QUERY_UPDATE = (
     "UPDATE s3keys SET "
@@ -28,8 +128,103 @@ QUERY_INSERT = (
     "INSERT INTO s3keys (name, size, last_modified, etag, level) "
     "VALUES (:name, :size, :last_modified, :etag, :level)"
 )
+QUERY_UPSERT = (
+    "INSERT INTO {table} (name, size, last_modified, etag, level) "
+    "VALUES (:name, :size, :last_modified, :etag, :level) "
+    "ON CONFLICT(name) DO UPDATE SET "
+    "size=excluded.size, "
+    "last_modified=excluded.last_modified, "
+    "etag=excluded.etag, "
+    "level=excluded.level"
+)
 QUERY_DELETE = "DELETE FROM s3keys WHERE name=?"
 QUERY_FILTER = "SELECT name, size, last_modified, etag FROM s3keys"
+QUERY_DROP_TABLE = "DROP TABLE IF EXISTS {table}"
+QUERY_RENAME_TABLE = "ALTER TABLE {table} RENAME TO {name}"
+QUERY_COPY_ROOT = (
+    "INSERT INTO {table} (name, size, last_modified, etag, level) "
+    "SELECT name, size, last_modified, etag, level FROM s3keys "
+    "WHERE level <= 0"
+)
+
+
+class Writer(threading.Thread):
+    """
+    Cache writer thread, applies queued updates and deletes with group
+    commits: once per `interval` seconds or `size` pending changes.
+
+    Everything queued is committed on `close`. Changes are applied on
+    cache connection, other cache transactions commit them first (see
+    `Cache._transaction`).
+    """
+
+    def __init__(self, cache, interval=None, size=None):
+        super().__init__(name="s3cache-writer")
+        self.daemon = True
+        self.cache = cache
+        if interval is None:
+            interval = conf.get("CACHE_COMMIT_INTERVAL")
+        if size is None:
+            size = conf.get("CACHE_COMMIT_SIZE")
+        self.interval = interval
+        self.size = size
+        self.queue = queue.Queue()
+        self.error = None
+        self.commits = 0
+
+    def update(self, name, data):
+        self.queue.put((self.cache.update, (name, data)))
+
+    def delete(self, name):
+        self.queue.put((self.cache.delete, (name,)))
+
+    def run(self):
+        pending = 0
+        deadline = None
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - time.time(), 0)
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+
+            if item:
+                func, args = item
+                try:
+                    func(*args)
+                except Exception as exc:  # pylint: disable=broad-except
+                    logger.error("cache write failed: %s", exc)
+                    if self.error is None:
+                        self.error = exc
+                pending += 1
+                if deadline is None:
+                    deadline = time.time() + self.interval
+
+            if pending and (
+                item is None
+                or pending >= self.size
+                or time.time() >= deadline
+            ):
+                self.cache.flush()
+                self.commits += 1
+                pending = 0
+                deadline = None
+
+            if item is None:
+                break
+
+    def close(self):
+        """
+        Commit queued changes and stop.
+
+        :raises sqlite3.Error: first failed write
+        """
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
 
 
 class Cache:
@@ -37,13 +232,20 @@ class Cache:
 
     def __init__(self):
         self._lock = threading.RLock()
+        self._writer = None
 
     def init(self):
         path = os.path.join(
             conf.get("PROJECT_ROOT"), conf.get("CACHE_FILE_NAME")
         )
         self.conn = sqlite3.connect(path, check_same_thread=False)
-        self.conn.cursor().execute(QUERY_CREATE_TABLE)
+        cur = self.conn.cursor()
+        _create_table(cur, TABLE)
+        _create_indexes(cur, TABLE)
+        cur.execute(QUERY_CREATE_PREFIXES)
+        cur.execute(QUERY_CREATE_UPLOADS)
+        cur.execute(QUERY_CREATE_RANGES)
+        cur.execute(QUERY_CREATE_LOCAL)
 
     def update(self, name, data):
         self._lock.acquire()
@@ -60,7 +262,296 @@ class Cache:
         finally:
             self._lock.release()
 
+    @contextlib.contextmanager
+    def writer(self, interval=None, size=None):
+        """
+        Route `write_update`/`write_delete` through writer thread.
+
+        Queued changes are committed on exit, Ctrl-C included.
+
+        :param float interval: max seconds between commits
+        :param int size: max changes per commit
+        """
+        if self.conn is None:
+            yield None
+            return
+
+        writer = Writer(self, interval=interval, size=size)
+        writer.start()
+        self._writer = writer
+        try:
+            yield writer
+        finally:
+            self._writer = None
+            writer.close()
+
+    def write_update(self, name, data):
+        """
+        Update key, committed by writer thread if running, now otherwise.
+        Skipped when cache isn't inited.
+
+        :param str name: current key name
+        :param dict data: name, size, last_modified, etag
+        """
+        if self.conn is None:
+            return
+        writer = self._writer
+        if writer is not None:
+            writer.update(name, data)
+        else:
+            self.update(name, data)
+            self.flush()
+
+    def write_delete(self, name):
+        """
+        Delete key, committed by writer thread if running, now otherwise.
+        Skipped when cache isn't inited.
+
+        :param str name:
+        """
+        if self.conn is None:
+            return
+        writer = self._writer
+        if writer is not None:
+            writer.delete(name)
+        else:
+            self.delete(name)
+            self.flush()
+
+    def bulk_update(self, records, batch_size=None, fast=False):
+        """
+        Insert or update many key records with batched upserts.
+
+        By default all batches are written in one transaction, so an
+        interrupted load leaves the cache untouched. In `fast` mode journal
+        is switched to WAL, records are loaded into a staging table (one
+        commit per batch) which replaces the main table at the end, so
+        keys missing in `records` are dropped. Journal mode is restored
+        after the load (it is saved in database file). Writer thread waits
+        for the load, see `_transaction`.
+
+        :param Iterable[dict] records: name, size, last_modified, etag
+        :param int batch_size: rows per `executemany` call
+        :param bool fast:
+
+        :return: number of written records
+        :rtype: int
+        """
+        if batch_size is None:
+            batch_size = conf.get("CACHE_BATCH_SIZE")
+
+        total = 0
+        if not fast:
+            query = QUERY_UPSERT.format(table=TABLE)
+            with self._transaction():
+                for batch in _iter_batches(records, batch_size):
+                    self.conn.executemany(query, batch)
+                    total += len(batch)
+            return total
+
+        query = QUERY_UPSERT.format(table=TABLE_STAGING)
+        self._lock.acquire()
+        try:
+            self._staging_begin()
+            try:
+                for batch in _iter_batches(records, batch_size):
+                    self.conn.executemany(query, batch)
+                    self.conn.commit()
+                    total += len(batch)
+            except BaseException:
+                self.conn.rollback()
+                self.conn.execute(QUERY_DROP_TABLE.format(table=TABLE_STAGING))
+                self._staging_end()
+                raise
+
+            try:
+                self._staging_swap()
+            finally:
+                self._staging_end()
+        finally:
+            self._lock.release()
+        return total
+
+    def _staging_begin(self):
+        self._lock.acquire()
+        try:
+            self.conn.commit()
+            cur = self.conn.cursor()
+            cur.execute("PRAGMA journal_mode=WAL")
+            cur.execute("PRAGMA synchronous=NORMAL")
+            cur.execute(QUERY_DROP_TABLE.format(table=TABLE_STAGING))
+            _create_table(cur, TABLE_STAGING)
+            cur.execute(QUERY_COPY_ROOT.format(table=TABLE_STAGING))
+            self.conn.commit()
+        finally:
+            self._lock.release()
+
+    def _staging_swap(self):
+        self._lock.acquire()
+        try:
+            cur = self.conn.cursor()
+            cur.execute("BEGIN")
+            try:
+                cur.execute(QUERY_DROP_TABLE.format(table=TABLE))
+                cur.execute(
+                    QUERY_RENAME_TABLE.format(table=TABLE_STAGING, name=TABLE)
+                )
+                _create_indexes(cur, TABLE)
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
+            self.conn.commit()
+        finally:
+            self._lock.release()
+
+    def _staging_end(self):
+        """
+        Restore rollback journal, WAL would leave -wal and -shm files next
+        to cache for all later commands.
+        """
+        self._lock.acquire()
+        try:
+            cur = self.conn.cursor()
+            cur.execute("PRAGMA journal_mode=DELETE")
+            cur.execute("PRAGMA synchronous=FULL")
+        finally:
+            self._lock.release()
+
+    def refresh_prefix(self, prefix, records, batch_size=None):
+        """
+        Reconcile cached keys under prefix with fresh listing records.
+
+        Listed records are upserted, cached keys under prefix missing in
+        the listing are deleted, rest of the cache is not touched. Prefix
+        watermark is saved in the same transaction.
+
+        :param str prefix: key prefix, empty for whole bucket; dir prefix
+            (with trailing slash) isn't listed with key of same name
+        :param Iterable[dict] records: name, size, last_modified, etag
+        :param int batch_size: rows per `executemany` call
+
+        :return: number of listed and deleted records
+        :rtype: tuple
+        """
+        if batch_size is None:
+            batch_size = conf.get("CACHE_BATCH_SIZE")
+
+        is_dir_prefix = prefix.endswith("/")
+        prefix = prefix.strip("/")
+        where, params = _prefix_where(prefix, exact=not is_dir_prefix)
+        query = QUERY_UPSERT.format(table=TABLE)
+
+        total = 0
+        with self._transaction():
+            self.conn.execute(QUERY_CREATE_SEEN)
+            self.conn.execute(QUERY_SEEN_TRUNCATE)
+            for batch in _iter_batches(records, batch_size):
+                self.conn.executemany(query, batch)
+                self.conn.executemany(QUERY_SEEN_INSERT, batch)
+                total += len(batch)
+
+            deleted = self.conn.execute(
+                QUERY_DELETE_UNSEEN.format(where=where), params
+            ).rowcount
+            self.conn.execute(QUERY_SEEN_TRUNCATE)
+            self._mark_refreshed(prefix)
+
+        return total, deleted
+
+    def mark_refreshed(self, prefix=""):
+        """
+        Save prefix watermark: refresh time, keys total, max last_modified.
+
+        :param str prefix: key prefix, empty for whole bucket
+        """
+        self._lock.acquire()
+        try:
+            self._mark_refreshed(prefix.strip("/"))
+            self.conn.commit()
+        finally:
+            self._lock.release()
+
+    def _mark_refreshed(self, prefix):
+        # nested watermarks are covered by the new one
+        if prefix:
+            self.conn.execute(
+                QUERY_PREFIXES_DELETE, (prefix, prefix + "/", prefix + "0")
+            )
+        else:
+            self.conn.execute(QUERY_PREFIXES_TRUNCATE)
+
+        where, params = _prefix_where(prefix)
+        self.conn.execute(
+            QUERY_PREFIXES_UPSERT.format(where=where),
+            (
+                prefix,
+                datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                *params,
+            ),
+        )
+
+    def watermark(self, prefix=""):
+        """
+        Get the latest watermark covering prefix (itself or any parent).
+
+        :param str prefix:
+
+        :rtype: dict|None
+        """
+        parts = prefix.strip("/").split("/")
+        prefixes = [""] + [
+            "/".join(parts[:index]) for index in range(1, len(parts) + 1)
+        ]
+        record = self.conn.execute(
+            QUERY_PREFIXES_FILTER
+            + " WHERE prefix IN ({})".format(",".join("?" * len(prefixes)))
+            + " ORDER BY refreshed_at DESC",
+            prefixes,
+        ).fetchone()
+        if not record:
+            return None
+        prefix, refreshed_at, total, last_modified = record
+        return {
+            "prefix": prefix,
+            "refreshed_at": refreshed_at,
+            "total": total,
+            "last_modified": last_modified,
+        }
+
+    def is_fresh(self, prefix="", ttl=None):
+        """
+        Check prefix is covered by a watermark not older than ttl.
+
+        :param str prefix:
+        :param int ttl: seconds, None for no expiration
+
+        :rtype: bool
+        """
+        watermark = self.watermark(prefix)
+        if not watermark:
+            return False
+        if ttl is None:
+            return True
+
+        refreshed_at = datetime.datetime.strptime(
+            watermark["refreshed_at"], "%Y-%m-%dT%H:%M:%S.000Z"
+        )
+        age = datetime.datetime.utcnow() - refreshed_at
+        return age.total_seconds() < ttl
+
     def select(self, prefix=None, delimiter=None, depth=None):
+        """
+        Iterate cached keys ordered by name, streaming rows from the cursor.
+
+        Prefix is matched with a range scan over `name` index, delimiter and
+        depth are resolved by `level` column.
+
+        :param str prefix: file key or dir prefix (with trailing slash)
+        :param str delimiter: list only prefix level
+        :param int depth: max sub dirs depth
+
+        :rtype: Iterator[dict]
+        """
         cur = self.conn.cursor()
 
         query = " WHERE 1=1"
@@ -68,8 +559,9 @@ class Cache:
         if prefix:
             is_dir_prefix = prefix.endswith("/")
             prefix = prefix.strip("/")
-            query += " and (name=? or name like ?)"
-            params.extend((prefix, "{}/%".format(prefix)))
+            where, where_params = _prefix_where(prefix)
+            query += " and " + where
+            params.extend(where_params)
 
             prefix_level = len(prefix.split("/"))
             if is_dir_prefix:
@@ -81,10 +573,14 @@ class Cache:
             query += " and (name=? or level=?)"
             params.extend((prefix, prefix_level))
 
-        for line in cur.execute(QUERY_FILTER + query, params).fetchall():
+        if depth:
+            query += " and level<=?"
+            params.append(depth + 1)
+
+        query += " ORDER BY name"
+
+        for line in cur.execute(QUERY_FILTER + query, params):
             name, size, last_modified, etag = line
-            if depth and depth < name.count("/"):
-                continue
             yield {
                 "name": name,
                 "size": size,
@@ -92,6 +588,134 @@ class Cache:
                 "etag": etag,
             }
 
+    def upload_get(self, name):
+        """
+        Get unfinished multipart upload state of key, none when cache
+        isn't inited.
+
+        :param str name:
+
+        :rtype: dict|None
+        """
+        if self.conn is None:
+            return None
+        record = self.conn.execute(
+            QUERY_UPLOADS_FILTER + " WHERE name=?", (name,)
+        ).fetchone()
+        if not record:
+            return None
+        name, upload_id, size, mtime_ns, part_size = record
+        return {
+            "name": name,
+            "upload_id": upload_id,
+            "size": size,
+            "mtime_ns": mtime_ns,
+            "part_size": part_size,
+        }
+
+    def upload_save(self, data):
+        """
+        Save multipart upload state, committed at once for resume.
+
+        :param dict data: name, upload_id, size, mtime_ns, part_size
+        """
+        if self.conn is None:
+            return
+        self._lock.acquire()
+        try:
+            self.conn.execute(QUERY_UPLOADS_UPSERT, data)
+            self.conn.commit()
+        finally:
+            self._lock.release()
+
+    def upload_delete(self, name):
+        if self.conn is None:
+            return
+        self._lock.acquire()
+        try:
+            self.conn.execute(QUERY_UPLOADS_DELETE, (name,))
+            self.conn.commit()
+        finally:
+            self._lock.release()
+
+    def ranges_get(self, name, etag, part_size):
+        """
+        Get downloaded range numbers of key version, none when cache
+        isn't inited.
+
+        :param str name:
+        :param str etag:
+        :param int part_size:
+
+        :rtype: set[int]
+        """
+        if self.conn is None:
+            return set()
+        return {
+            part_num
+            for (part_num,) in self.conn.execute(
+                QUERY_RANGES_FILTER, (name, etag, part_size)
+            )
+        }
+
+    def range_done(self, name, etag, part_size, part_num):
+        if self.conn is None:
+            return
+        self._lock.acquire()
+        try:
+            self.conn.execute(
+                QUERY_RANGES_INSERT, (name, etag, part_size, part_num)
+            )
+            self.conn.commit()
+        finally:
+            self._lock.release()
+
+    def ranges_delete(self, name):
+        if self.conn is None:
+            return
+        self._lock.acquire()
+        try:
+            self.conn.execute(QUERY_RANGES_DELETE, (name,))
+            self.conn.commit()
+        finally:
+            self._lock.release()
+
+    def local_get(self, path):
+        """
+        Get saved stat and hashes of local file.
+
+        :param str path:
+
+        :rtype: dict|None
+        """
+        record = self.conn.execute(
+            QUERY_LOCAL_FILTER + " WHERE path=?", (path,)
+        ).fetchone()
+        if not record:
+            return None
+        path, size, mtime_ns, inode, part_size, md5, etag = record
+        return {
+            "path": path,
+            "size": size,
+            "mtime_ns": mtime_ns,
+            "inode": inode,
+            "part_size": part_size,
+            "md5": md5,
+            "etag": etag,
+        }
+
+    def local_update(self, data):
+        """
+        Save stat and hashes of local file, committed by `flush`.
+
+        :param dict data: path, size, mtime_ns, inode, part_size, md5, etag
+        """
+        self._lock.acquire()
+        try:
+            self.conn.execute(QUERY_LOCAL_UPSERT, data)
+        finally:
+            self._lock.release()
+
     def select_one(self, name):
         cur = self.conn.cursor()
 
@@ -115,6 +739,32 @@ class Cache:
         finally:
             self._lock.release()
 
+    def delete_many(self, names):
+        """
+        Delete keys in one transaction. Skipped when cache isn't inited.
+
+        :param Iterable[str] names:
+        """
+        if self.conn is None:
+            return
+        with self._transaction():
+            self.conn.executemany(QUERY_DELETE, ((name,) for name in names))
+
+    def rewrite(self, deleted=(), updated=()):
+        """
+        Delete and upsert keys in one transaction. Skipped when cache isn't
+        inited.
+
+        :param Iterable[str] deleted: names
+        :param Iterable[dict] updated: name, size, last_modified, etag
+        """
+        if self.conn is None:
+            return
+        with self._transaction():
+            self.conn.executemany(QUERY_DELETE, ((name,) for name in deleted))
+            for batch in _iter_batches(updated, conf.get("CACHE_BATCH_SIZE")):
+                self.conn.executemany(QUERY_UPSERT.format(table=TABLE), batch)
+
     def total(self):
         return self.conn.cursor().execute(QUERY_SELECT_TOTAL).fetchone()[0]
 
@@ -122,6 +772,23 @@ class Cache:
         self._lock.acquire()
         try:
             self.conn.cursor().execute(QUERY_TRUNCATE)
+            self.conn.cursor().execute(QUERY_PREFIXES_TRUNCATE)
+        finally:
+            self._lock.release()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """
+        Run block in own transaction, committed on success and rolled back
+        on error. Lock is held for whole block, so changes applied by writer
+        thread (see `Writer`) on the same connection are committed before
+        it and can't be rolled back with it.
+        """
+        self._lock.acquire()
+        try:
+            self.conn.commit()
+            with self.conn:
+                yield
         finally:
             self._lock.release()
 
@@ -136,4 +803,43 @@ class Cache:
         self.conn.close()
 
 
+def _create_table(cur, table):
+    cur.execute(QUERY_CREATE_TABLE.format(table=table))
+
+
+def _create_indexes(cur, table):
+    for query in QUERY_CREATE_INDEXES:
+        cur.execute(query.format(table=table))
+
+
+def _prefix_where(prefix, exact=True):
+    """
+    :param str prefix: without trailing slash
+    :param bool exact: match key named as prefix too, not only keys under it
+
+    :return: where clause, params
+    :rtype: tuple
+    """
+    if not prefix:
+        return "level > 0", ()
+    if not exact:
+        return "(name>=? and name<?)", (prefix + "/", prefix + "0")
+    return "(name=? or (name>=? and name<?))", (
+        prefix,
+        prefix + "/",
+        prefix + "0",
+    )
+
+
+def _iter_batches(records, batch_size):
+    batch = []
+    for data in records:
+        batch.append({"level": len(data["name"].split("/")), **data})
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 cache = Cache()
@@ -6,7 +6,7 @@ import os
 import davo.utils.cli
 from davo import constants, version
 
-from . import conf, const, handlers, utils
+from . import conf, const, handlers, throttle, utils
 
 logger = logging.getLogger(__name__)
 
@@ -123,7 +123,17 @@ def init_parser(parser=None, subparsers=None, commands=()):
         help="file types (extension) for compare",
     )
     common_diff.add_argument("--no-cache", action="store_true")
+    common_diff.add_argument(
+        "--refresh-cache",
+        action="store_true",
+        help="relist path prefix into cache before comparing",
+    )
     common_diff.add_argument("-v", "--verbose", action="store_true")
+    common_diff.add_argument(
+        "--metrics",
+        metavar="PATH",
+        help="write metrics: JSON lines, or Prometheus textfile if *.prom",
+    )
 
     if not commands or "diff" in commands:
         name = _command("diff", commands)
@@ -159,7 +169,19 @@ def init_parser(parser=None, subparsers=None, commands=()):
             action="store",
             default=0,
             type=int,
-            help="threads count",
+            help="max threads count",
+        )
+        cmd.add_argument(
+            "--fixed-threads",
+            action="store_true",
+            help="keep all threads active (no adaptive concurrency)",
+        )
+        cmd.add_argument(
+            "--bwlimit",
+            action="store",
+            metavar="RATE",
+            type=throttle.parse_rate,
+            help="bandwidth cap, bytes/s with K/M/G suffix, 0 is unlimited",
         )
         cmd.add_argument(
             "-q", "--quiet", action="store_true", help="quiet (no interactive)"
@@ -210,6 +232,56 @@ def init_parser(parser=None, subparsers=None, commands=()):
         name = _command("cache-update", commands)
         cmd = subparsers.add_parser(name, help="update cache")
         cmd.set_defaults(func=handlers.on_cache_update)
+        cmd.add_argument(
+            "path",
+            nargs="?",
+            help="relist only this path prefix (incremental)",
+        )
+        cmd.add_argument(
+            "--fast",
+            action="store_true",
+            help="load via staging table, WAL journal (less durable)",
+        )
+        cmd.add_argument(
+            "--metrics",
+            metavar="PATH",
+            help="write metrics: JSON lines, or Prometheus textfile if *.prom",
+        )
+
+    if not commands or "manifest" in commands:
+        name = _command("manifest", commands)
+        cmd = subparsers.add_parser(
+            name, help="export or verify checksum manifest"
+        )
+        cmd.set_defaults(func=handlers.on_manifest)
+        cmd.add_argument(
+            "action",
+            choices=("export", "verify"),
+            help="export cache and local hashes, or verify local files",
+        )
+        cmd.add_argument(
+            "-f",
+            "--file",
+            metavar="PATH",
+            help="manifest file, MANIFEST_FILE_NAME in project by default",
+        )
+        cmd.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=0,
+            help="hashing processes, cpu count by default",
+        )
+        cmd.add_argument(
+            "--restart",
+            action="store_true",
+            help="verify all entries, don't resume unfinished run",
+        )
+        cmd.add_argument(
+            "--metrics",
+            metavar="PATH",
+            help="write metrics: JSON lines, or Prometheus textfile if *.prom",
+        )
 
     return parser
 
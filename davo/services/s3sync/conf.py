@@ -12,8 +12,23 @@ _CONFIG = {
     "KEY_PATTERN": "{name} {storage} {size} {modified} {owner} {md5}",
     "KEY_PATTERN_NAME_LEN": 60,
     "THREAD_MAX_COUNT": 16,
+    "THREAD_MIN_COUNT": 2,
+    "THREAD_ADAPTIVE": True,
+    "THREAD_ADAPTIVE_INTERVAL": 1.0,
+    "BANDWIDTH_LIMIT": 0,
+    "BANDWIDTH_SCHEDULE": {},
     "ENDED_OUTPUT_MAX_COUNT": 4,
+    "TASK_QUEUE_SIZE": None,
+    "TASK_RETRIES": 3,
+    "TASK_RETRY_BACKOFF": 1.0,
+    "TASK_COST": 64 * 1024,
+    "SCHEDULE_SMALL_SIZE": 1024**2,
     "UPLOAD_CB_NUM": 10,
+    "MULTIPART_THRESHOLD": 64 * 1024**2,
+    "MULTIPART_CHUNK_SIZE": 16 * 1024**2,
+    "MULTIPART_THREADS": 8,
+    "DELETE_BATCH_SIZE": 1000,
+    "PROGRESS_INTERVAL": 0.1,
     "UPLOAD_FORMAT": "[{progress}>{left}]"
     "\t{progress_percent:3.0f}%"
     "\t{speed}"
@@ -28,7 +43,14 @@ _CONFIG = {
     "LOCAL_CONFIG": None,
     "ALLOWED_EXTENSIONS": (),
     "CACHE_FILE_NAME": ".s3cache.db",
+    "CACHE_BATCH_SIZE": 10000,
+    "CACHE_REFRESH_TTL": None,
+    "CACHE_COMMIT_INTERVAL": 1.0,
+    "CACHE_COMMIT_SIZE": 1000,
+    "METRICS_FILE": None,
+    "MANIFEST_FILE_NAME": ".s3manifest.db",
     "IGNORE": (),
+    "WALK_THREADS": 0,
     "LOAD_SECRETS": None,
     "GLOBAL_CONFIG": "~/Dropbox/etc/s3sync.yaml",
 }
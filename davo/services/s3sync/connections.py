@@ -0,0 +1,111 @@
+import threading
+
+import boto.s3.connection
+import boto.s3.key
+import boto.s3.multipart
+
+from . import metrics
+
+_local = threading.local()
+
+
+class Connection(boto.s3.connection.S3Connection):
+    """
+    S3 connection counting sent requests in metrics.
+    """
+
+    def make_request(self, method, *args, **kwargs):
+        metrics.metrics.inc("requests_total", label=method)
+        return super().make_request(method, *args, **kwargs)
+
+
+def thread_bucket(bucket):
+    """
+    Get handle of bucket owned by current thread.
+
+    boto connection isn't meant to be shared between threads, so each
+    thread gets own connection (with same host and credentials), which
+    keeps its http connections alive between requests. Handle is made
+    without bucket validation request.
+
+    :param boto.s3.bucket.Bucket bucket:
+
+    :rtype: boto.s3.bucket.Bucket
+    """
+    conn = getattr(bucket, "connection", None)
+    if not isinstance(conn, boto.s3.connection.S3Connection):
+        return bucket
+
+    handles = getattr(_local, "buckets", None)
+    if handles is None:
+        handles = _local.buckets = {}
+
+    handle_key = (conn.host, conn.port, conn.aws_access_key_id, bucket.name)
+    handle = handles.get(handle_key)
+    if handle is None:
+        thread_conn = Connection(
+            aws_access_key_id=conn.aws_access_key_id,
+            aws_secret_access_key=conn.aws_secret_access_key,
+            security_token=conn.provider.security_token,
+            is_secure=conn.is_secure,
+            port=conn.port,
+            host=conn.host,
+            calling_format=conn.calling_format,
+        )
+        handle = thread_conn.get_bucket(bucket.name, validate=False)
+        handles[handle_key] = handle
+    return handle
+
+
+def make_key(bucket, name, size=None, etag=None, last_modified=None):
+    """
+    Build key of current thread bucket from known metadata, no HEAD request.
+
+    :param boto.s3.bucket.Bucket bucket:
+    :param str name:
+    :param int size:
+    :param str etag: quoted
+    :param str last_modified:
+
+    :rtype: boto.s3.key.Key
+    """
+    key = boto.s3.key.Key(bucket=thread_bucket(bucket), name=name)
+    key.size = size
+    key.etag = etag
+    key.last_modified = last_modified
+    return key
+
+
+def thread_key(key):
+    """
+    Rebind listed boto key to current thread bucket.
+
+    :param key: boto key or cached key (works on thread bucket itself)
+
+    :return: same key
+    """
+    if isinstance(key, boto.s3.key.Key):
+        key.bucket = thread_bucket(key.bucket)
+    return key
+
+
+def thread_upload(mp):
+    """
+    Copy multipart upload handle onto current thread bucket.
+
+    :param boto.s3.multipart.MultiPartUpload mp:
+
+    :rtype: boto.s3.multipart.MultiPartUpload
+    """
+    if not isinstance(mp, boto.s3.multipart.MultiPartUpload):
+        return mp
+
+    bucket = thread_bucket(mp.bucket)
+    if bucket is mp.bucket:
+        return mp
+
+    thread_mp = boto.s3.multipart.MultiPartUpload(bucket)
+    thread_mp.id = mp.id
+    thread_mp.key_name = mp.key_name
+    thread_mp.bucket_name = mp.bucket_name
+    return thread_mp
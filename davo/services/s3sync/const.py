@@ -3,3 +3,9 @@ from davo import constants as _constants
 TOPICS = {
     "modes": _constants.STATE_CHOICES_DICT,
 }
+
+# suffix of partially downloaded files
+DOWNLOAD_PART_SUFFIX = ".s3part"
+
+# sqlite journal files next to database
+SQLITE_SIDECAR_SUFFIXES = ("-wal", "-shm", "-journal")
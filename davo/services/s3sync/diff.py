@@ -0,0 +1,285 @@
+import collections
+import datetime
+import os
+
+import davo.utils
+from davo import constants
+
+from . import conf, utils
+
+_NEW_OR_MISSING = {constants.STATE_LOCAL_NEW, constants.STATE_LOCAL_MISSING}
+
+
+class Record:
+    """
+    Diff entry of one key.
+
+    Compact replacement of diff dict, item access (`data["state"]`,
+    `data.get("size")`) is kept for tasks and handlers.
+    """
+
+    __slots__ = (
+        "state",
+        "key",
+        "name",
+        "size",
+        "modified",
+        "md5",
+        "hashes",
+        "comment",
+        "local_path",
+        "local_size",
+        "local_name",
+    )
+
+    def __init__(self, state, **kwargs):
+        self.state = state
+        self.key = None
+        self.name = None
+        self.size = None
+        self.modified = None
+        self.md5 = None
+        self.hashes = None
+        self.comment = []
+        self.local_path = None
+        self.local_size = None
+        self.local_name = None
+        self.update(**kwargs)
+
+    def __repr__(self):
+        name = self.name or self.local_path
+        return "<Record {} {}>".format(self.state, name)
+
+    def __getitem__(self, item):
+        try:
+            return getattr(self, item)
+        except AttributeError:
+            raise KeyError(item) from None
+
+    def __setitem__(self, item, value):
+        try:
+            setattr(self, item, value)
+        except AttributeError:
+            raise KeyError(item) from None
+
+    def get(self, item, default=None):
+        value = getattr(self, item, None)
+        return default if value is None else value
+
+    def update(self, **kwargs):
+        for item, value in kwargs.items():
+            self[item] = value
+
+
+def merge_join(local, remote):
+    """
+    Join two streams of (key, item) pairs, both sorted by key.
+
+    :param Iterable[tuple] local:
+    :param Iterable[tuple] remote:
+
+    :return: key, local item or None, remote item or None
+    :rtype: Iterator[tuple]
+    """
+    local, remote = iter(local), iter(remote)
+    left, right = next(local, None), next(remote, None)
+    while left is not None or right is not None:
+        if right is None or (left is not None and left[0] < right[0]):
+            yield left[0], left[1], None
+            left = next(local, None)
+        elif left is None or right[0] < left[0]:
+            yield right[0], None, right[1]
+            right = next(remote, None)
+        else:
+            yield left[0], left[1], right[1]
+            left, right = next(local, None), next(remote, None)
+
+
+def iter_diff(
+    local,
+    remote,
+    md5=False,
+    force_upload=False,
+    force_download=False,
+):
+    """
+    Compare local files with remote keys, one record per key.
+
+    Records are emitted as the streams are joined, renames are not
+    resolved here (see `match_renames`).
+
+    :param Iterable[tuple] local: (key, file path), sorted by key
+    :param Iterable[tuple] remote: (key, s3 key), sorted by key
+    :param bool md5: compare content of same sized files
+    :param bool force_upload: prefer local for different files
+    :param bool force_download: prefer remote for different files
+
+    :return: key, record
+    :rtype: Iterator[tuple]
+    """
+    allowed = conf.get("ALLOWED_EXTENSIONS")
+
+    for key, path, s3key in merge_join(local, remote):
+        if s3key is None:
+            stat = os.stat(path)
+            record = Record(
+                constants.STATE_LOCAL_NEW,
+                local_size=stat.st_size,
+                local_path=path,
+                modified=stat.st_mtime,
+            )
+            if allowed:
+                ext = davo.utils.path.get_extension(path, lower=True)
+                if ext not in allowed:
+                    record.state = constants.STATE_INVALID_TYPE
+            yield key, record
+            continue
+
+        record = Record(
+            constants.STATE_LOCAL_MISSING,
+            key=s3key,
+            name=s3key.name,
+            size=s3key.size,
+            modified=s3key.last_modified,
+            md5=s3key.etag[1:-1] if s3key.etag else None,
+        )
+        if path is None:
+            record.local_path = utils.file_path(s3key.name)
+        else:
+            record.local_path = path
+            _compare(record, md5, force_upload, force_download)
+        yield key, record
+
+
+def _compare(record, md5, force_upload, force_download):
+    stat = os.stat(record.local_path)
+
+    equal = True
+    if stat.st_size != record.size:
+        equal = False
+        if record.size:
+            diff = stat.st_size * 100 / float(record.size)
+        else:
+            diff = 0
+        record.comment.append("size: {:.2f}%".format(diff))
+
+    elif md5:
+        hashes = utils.local_hashes(record.local_path, stat)
+        if not utils.etag_matches(hashes, record.md5):
+            equal = False
+            record.comment.append("md5: different")
+
+    if equal:
+        record.state = constants.STATE_EQUAL
+        return
+
+    record.local_size = stat.st_size
+    local_modified = datetime.datetime.fromtimestamp(stat.st_ctime).replace(
+        microsecond=0
+    )
+    remote_modified = datetime.datetime.strptime(
+        record.modified, "%Y-%m-%dT%H:%M:%S.000Z"
+    )
+    remote_modified += datetime.timedelta(hours=4)
+
+    delta = local_modified - remote_modified
+    if delta.days > 1:
+        record.comment.append(
+            "modified: remote {0} days older".format(delta.days)
+        )
+    else:
+        record.comment.append("modified: {0}".format(delta))
+
+    if force_upload:
+        record.state = constants.STATE_LOCAL_NEWER
+    elif force_download:
+        record.state = constants.STATE_LOCAL_OLDER
+    elif local_modified > remote_modified:
+        record.state = constants.STATE_LOCAL_NEWER
+    else:
+        record.state = constants.STATE_LOCAL_OLDER
+
+
+def match_renames(files, md5=False):
+    """
+    Pair new local files with missing remote keys of same size (and md5).
+
+    Missing keys are indexed by size, so matching is linear. Candidates are
+    taken in key order, which keeps the pairing deterministic. Paired
+    missing records become renames, paired new records are removed.
+
+    :param dict files: key: record, in key order
+    :param bool md5: also match content, new files are hashed only when
+        there is a candidate of the same size
+
+    :return: number of renames
+    :rtype: int
+    """
+    # size: etag (or None without md5): missing keys
+    candidates = collections.defaultdict(
+        lambda: collections.defaultdict(collections.deque)
+    )
+    for key, record in files.items():
+        if record.state == constants.STATE_LOCAL_MISSING:
+            candidates[record.size][record.md5 if md5 else None].append(key)
+
+    renamed = []
+    for key, record in files.items():
+        if record.state != constants.STATE_LOCAL_NEW:
+            continue
+
+        found = _pop_candidate(candidates, record, md5)
+        if found is None:
+            continue
+
+        missing = files[found]
+        missing.update(
+            state=constants.STATE_RENAMED,
+            local_name=key,
+            local_size=record.local_size,
+        )
+        missing.comment.append("new: {0}".format(key))
+        renamed.append(key)
+
+    for key in renamed:
+        del files[key]
+    return len(renamed)
+
+
+def _pop_candidate(candidates, record, md5):
+    by_etag = candidates.get(record.local_size)
+    if not by_etag:
+        return None
+
+    if md5:
+        if record.hashes is None:
+            record.hashes = utils.local_hashes(record.local_path)
+            record.md5 = record.hashes[0]
+        etags = record.hashes
+    else:
+        etags = (None,)
+
+    for etag in etags:
+        keys = by_etag.get(etag)
+        if keys:
+            key = keys.popleft()
+            if not keys:
+                del by_etag[etag]
+            if not by_etag:
+                del candidates[record.local_size]
+            return key
+    return None
+
+
+def is_pending(record, modes):
+    """
+    Check record is to be kept until renames are matched.
+
+    :param Record record:
+    :param set modes:
+
+    :rtype: bool
+    """
+    return record.state in modes or (
+        constants.STATE_RENAMED in modes and record.state in _NEW_OR_MISSING
+    )
@@ -0,0 +1,138 @@
+import concurrent.futures
+import logging
+import os
+
+import davo.errors
+
+from . import cache, conf, connections, const, multipart
+
+logger = logging.getLogger(__name__)
+
+
+def download(key, path, callback=None, chunk_size=None):
+    """
+    Download key by byte ranges concurrently, resuming unfinished download.
+
+    Ranges are written into preallocated `<path>.s3part` file, each done
+    range is saved to cache. File is moved to path after etag check.
+
+    :param key: boto key or cached key (name, size, etag, bucket)
+    :param str path: local file path
+    :param callable callback: progress callback (received, total)
+    :param int chunk_size: preferred range size
+
+    :raises davo.errors.Error: on etag mismatch
+    """
+    size = key.size
+    part_size = multipart.part_size_for(size, chunk_size)
+    part_path = path + const.DOWNLOAD_PART_SUFFIX
+    progress = multipart.Progress(size, callback)
+
+    done = set()
+    if os.path.exists(part_path) and os.path.getsize(part_path) == size:
+        done = cache.cache.ranges_get(key.name, key.etag, part_size)
+    else:
+        cache.cache.ranges_delete(key.name)
+        with open(part_path, "wb") as file:
+            file.truncate(size)
+
+    if done:
+        logger.info("resuming download %s (%d ranges)", key.name, len(done))
+
+    fd = os.open(part_path, os.O_WRONLY)
+    try:
+        futures = []
+        for part_num, offset, length in multipart.iter_parts(size, part_size):
+            if part_num in done:
+                progress.update(part_num, length)
+                continue
+            futures.append(
+                multipart.get_pool().submit(
+                    _download_range,
+                    key,
+                    fd,
+                    part_size,
+                    part_num,
+                    offset,
+                    length,
+                    progress,
+                )
+            )
+        try:
+            for future in futures:
+                future.result()
+        except BaseException:
+            # done ranges are kept in cache for resume
+            for future in futures:
+                future.cancel()
+            concurrent.futures.wait(futures)
+            raise
+    finally:
+        os.close(fd)
+
+    if key.etag:
+        _verify(key, part_path, size)
+
+    os.replace(part_path, path)
+    cache.cache.ranges_delete(key.name)
+
+
+def _verify(key, path, size):
+    etag = file_etag(path, key.etag, size)
+    if etag is None or etag == key.etag.strip('"'):
+        return
+
+    if "-" in key.etag:
+        # part size of multipart etag is a guess, don't drop the file
+        logger.warning("can't verify %s, etag differs: %s", key.name, etag)
+        return
+
+    cache.cache.ranges_delete(key.name)
+    os.remove(path)
+    raise davo.errors.Error(
+        "etag mismatch {}: {} != {}".format(key.name, etag, key.etag)
+    )
+
+
+def _download_range(key, fd, part_size, part_num, offset, length, progress):
+    # own key object per range, no HEAD request is made
+    s3key = connections.make_key(key.bucket, key.name)
+    data = s3key.get_contents_as_string(
+        headers={"Range": "bytes={}-{}".format(offset, offset + length - 1)},
+        cb=lambda received, _total: progress.update(part_num, received),
+        num_cb=conf.get("UPLOAD_CB_NUM"),
+    )
+    if len(data) != length:
+        raise davo.errors.Error(
+            "range {} of {} is {} bytes, expected {}".format(
+                part_num, key.name, len(data), length
+            )
+        )
+
+    os.pwrite(fd, data, offset)
+    cache.cache.range_done(key.name, key.etag, part_size, part_num)
+    progress.update(part_num, length)
+
+
+def file_etag(path, etag, size):
+    """
+    Compute local file etag in format of remote one (plain or multipart).
+
+    :param str path:
+    :param str etag: remote etag, multipart one has `-<parts>` suffix
+    :param int size:
+
+    :return: unquoted etag or None when part size can't be guessed
+    :rtype: str|None
+    """
+    etag = etag.strip('"')
+    if "-" in etag:
+        parts = int(etag.rsplit("-", 1)[1])
+        if len(range(0, size, multipart.part_size_for(size))) != parts:
+            logger.warning("can't verify %s, unknown part size", path)
+            return None
+
+    md5, multipart_etag = multipart.file_hashes(path, size)
+    if "-" in etag:
+        return multipart_etag
+    return md5
@@ -1,4 +1,4 @@
-import datetime
+import concurrent.futures
 import logging
 import os
 import pprint
@@ -10,7 +10,19 @@ import yaml
 import davo.utils
 from davo import constants, errors, settings
 
-from . import cache, conf, const, tasks, utils, workers
+from . import (
+    cache,
+    conf,
+    const,
+    diff,
+    manifest,
+    metrics,
+    rename,
+    schedule,
+    tasks,
+    utils,
+    workers,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -70,6 +82,7 @@ def on_list_buckets(_namespace):
         logger.info(bucket.name)
 
 
+@metrics.instrument("diff")
 def on_diff(namespace, print_details=True):
     conf.init()
 
@@ -83,39 +96,29 @@ def on_diff(namespace, print_details=True):
         modes = namespace.modes
 
     path = os.path.abspath(namespace.path)
+    local_count = 0
 
-    src_files = []
-    it = utils.iter_local_path(
-        path=path,
-        recursive=namespace.recursive,
-        exclude=conf.get("IGNORE"),
-        depth=namespace.depth,
-    )
-    for file_path in it:
-        if not os.path.isfile(file_path):
-            continue
-
-        if not utils.check_file_type(file_path, namespace.file_types):
-            continue
-
-        key = utils.file_key(file_path)
-        if namespace.ignore_case:
-            key = key.lower()
-
-        if key == conf.get("CACHE_FILE_NAME"):
-            continue
-
-        src_files.append((key, file_path))
+    def _iter_local():
+        nonlocal local_count
+        for item in _iter_local_keys(path, namespace):
+            local_count += 1
+            yield item
 
-    logger.info("%d local objects", len(src_files))
-
-    remote_files = dict()
+    # walk comes sorted by path, so by key
+    local = _iter_local()
+    if namespace.ignore_case:
+        # lowered keys are out of walk order
+        local = sorted(local)
 
     if not namespace.no_cache:
         cache.cache.init()
-        if not cache.cache.total():
-            logger.info("updating cache...")
-            utils.update_cache(bucket)
+        prefix = utils.remote_prefix(path)
+        if namespace.refresh_cache or not cache.cache.is_fresh(
+            prefix, ttl=conf.get("CACHE_REFRESH_TTL")
+        ):
+            logger.info("updating cache `%s`...", prefix)
+            listed, deleted = utils.refresh_cache(bucket, prefix)
+            logger.info("%d keys listed, %d removed", listed, deleted)
 
     ls_remote = utils.iter_remote_path(
         bucket,
@@ -124,161 +127,122 @@ def on_diff(namespace, print_details=True):
         cached=not namespace.no_cache,
         depth=namespace.depth,
     )
+    remote_count = 0
 
-    for file_ in ls_remote:
-        if not utils.check_file_type(file_.name, namespace.file_types):
-            continue
+    def _iter_remote_keys():
+        nonlocal remote_count
+        for file_ in ls_remote:
+            if not utils.check_file_type(file_.name, namespace.file_types):
+                continue
+            remote_count += 1
+            if namespace.ignore_case:
+                yield file_.name.lower(), file_
+            else:
+                yield file_.name, file_
 
-        key = file_.name
-        if namespace.ignore_case:
-            key = key.lower()
+    remote = _iter_remote_keys()
+    if namespace.ignore_case:
+        # lowered keys are out of listing order
+        remote = sorted(remote, key=lambda item: item[0])
 
-        remote_files[key] = dict(
-            key=file_,
-            name=file_.name,
-            size=file_.size,
-            modified=file_.last_modified,
-            md5=file_.etag[1:-1] if file_.etag else None,
-            state=constants.STATE_LOCAL_MISSING,
-            comment=[],
-            local_path=utils.file_path(file_.name),
-        )
+    logger.info("comparing...")
+    remote_files = {}
+    records = diff.iter_diff(
+        local,
+        remote,
+        md5=namespace.md5,
+        force_upload=namespace.force_upload,
+        force_download=namespace.force_download,
+    )
+    with metrics.metrics.phase("compare"):
+        for key, record in records:
+            if diff.is_pending(record, modes):
+                remote_files[key] = record
+    logger.info("%d local objects", local_count)
+    metrics.metrics.inc("keys_total", local_count, "local")
+    metrics.metrics.inc("keys_total", remote_count, "remote")
 
     if not namespace.no_cache:
-        logger.info("%d remote objects, using cache", len(remote_files.keys()))
+        logger.info("%d remote objects, using cache", remote_count)
     else:
-        logger.info("%d remote objects", len(remote_files.keys()))
+        logger.info("%d remote objects", remote_count)
 
-    if not src_files and not remote_files:
+    if not local_count and not remote_count:
         return None
 
-    logger.info("comparing...")
-    for key, f_path in src_files:
-        stat = os.stat(f_path)
-
-        if key in remote_files:
-            equal = True
-            remote = remote_files[key]
-            remote["local_path"] = f_path
-
-            if stat.st_size != remote["size"]:
-                equal = False
-                if remote["size"]:
-                    diff = stat.st_size * 100 / float(remote["size"])
-                else:
-                    diff = 0
-                remote["comment"].append("size: {:.2f}%".format(diff))
-
-            elif namespace.md5:
-                if davo.utils.path.file_hash(f_path) != remote["md5"]:
-                    equal = False
-                    remote["comment"].append("md5: different")
-
-            if equal:
-                remote.update(state=constants.STATE_EQUAL, comment=[])
-            else:
-                remote["local_size"] = stat.st_size
-                local_modified = datetime.datetime.fromtimestamp(
-                    stat.st_ctime
-                ).replace(microsecond=0)
-                remote_modified = datetime.datetime.strptime(
-                    remote["modified"], "%Y-%m-%dT%H:%M:%S.000Z"
-                )
-                remote_modified += datetime.timedelta(hours=4)
-
-                delta = local_modified - remote_modified
-                if delta.days > 1:
-                    remote["comment"].append(
-                        "modified: remote {0} days older".format(delta.days)
-                    )
-                else:
-                    remote["comment"].append("modified: {0}".format(delta))
-
-                if namespace.force_upload:
-                    remote["state"] = constants.STATE_LOCAL_NEWER
-
-                elif namespace.force_download:
-                    remote["state"] = constants.STATE_LOCAL_OLDER
-
-                elif local_modified > remote_modified:
-                    remote["state"] = constants.STATE_LOCAL_NEWER
-
-                else:
-                    remote["state"] = constants.STATE_LOCAL_OLDER
-
-            if remote["state"] not in modes:
-                del remote_files[key]
-
-        else:
-            if (
-                constants.STATE_LOCAL_NEW not in modes
-                and constants.STATE_RENAMED not in modes
-            ):
-                continue
-
-            remote_files[key] = dict(
-                local_size=stat.st_size,
-                local_path=f_path,
-                modified=stat.st_mtime,
-                md5=None,
-                state=constants.STATE_LOCAL_NEW,
-                comment=[],
-            )
-            if conf.get("ALLOWED_EXTENSIONS"):
-                ext = davo.utils.path.get_extension(f_path, lower=True)
-                if ext not in conf.get("ALLOWED_EXTENSIONS"):
-                    remote_files[key]["state"] = constants.STATE_INVALID_TYPE
-            if namespace.md5:
-                remote_files[key]["md5"] = davo.utils.path.file_hash(f_path)
-
-    # find renames
     if constants.STATE_RENAMED in modes:
-        to_del = []
-        for key, new_data in remote_files.items():
-            if new_data["state"] != constants.STATE_LOCAL_NEW:
-                continue
-            for name, data in remote_files.items():
-                if data["state"] != constants.STATE_LOCAL_MISSING:
-                    continue
-                if data["size"] != new_data["local_size"]:
-                    continue
-                if namespace.md5 and data["md5"] != new_data["md5"]:
-                    continue
-                remote_files[name].update(
-                    state=constants.STATE_RENAMED,
-                    local_name=key,
-                    local_size=new_data["local_size"],
-                )
-                remote_files[name]["comment"].append("new: {0}".format(key))
-                to_del.append(key)
-                break
+        with metrics.metrics.phase("rename_matching"):
+            diff.match_renames(remote_files, md5=namespace.md5)
 
-        for key in to_del:
-            del remote_files[key]
+    if namespace.md5 and not namespace.no_cache:
+        cache.cache.flush()
 
     remote_files = {
         k: v for k, v in remote_files.items() if v["state"] in modes
     }
 
     if print_details and not namespace.brief:
-        keys = remote_files.keys()
-        for key in keys:
-            data = remote_files[key]
+        renames = []
+        for key, data in remote_files.items():
+            if data["state"] == constants.STATE_RENAMED:
+                renames.append((key, data["name"], data["local_name"]))
+                continue
             print(
                 "{} {} {}".format(
                     data["state"], key, ", ".join(data.get("comment", []))
                 )
             )
+        for move in rename.group_moves(renames):
+            print("{} {}".format(constants.STATE_RENAMED, move))
 
     davo.utils.path.count_diff(remote_files, verbose=True)
 
     return bucket, remote_files
 
 
+def _iter_local_keys(path, namespace):
+    it = utils.iter_local_path(
+        path=path,
+        recursive=namespace.recursive,
+        exclude=conf.get("IGNORE"),
+        depth=namespace.depth,
+    )
+    cache_files = _sqlite_files(conf.get("CACHE_FILE_NAME"))
+    for file_path in it:
+        if not utils.check_file_type(file_path, namespace.file_types):
+            continue
+
+        key = utils.file_key(file_path)
+        if namespace.ignore_case:
+            key = key.lower()
+
+        if key in cache_files:
+            continue
+
+        if key.endswith(const.DOWNLOAD_PART_SUFFIX):
+            continue
+
+        yield key, file_path
+
+
+def _sqlite_files(path):
+    """
+    :return: path of sqlite database and of its journal files
+    :rtype: set
+    """
+    return {path} | {path + suffix for suffix in const.SQLITE_SIDECAR_SUFFIXES}
+
+
+@metrics.instrument("update")
 def on_update(namespace):
     conf.init()
     if namespace.threads:
         conf.option("THREAD_MAX_COUNT", value=namespace.threads)
+    if namespace.fixed_threads:
+        conf.option("THREAD_ADAPTIVE", value=False)
+    if namespace.bwlimit is not None:
+        conf.option("BANDWIDTH_LIMIT", value=namespace.bwlimit)
+        conf.option("BANDWIDTH_SCHEDULE", value={})
 
     bucket, files = on_diff(namespace, print_details=False)
     if not files:
@@ -306,11 +270,118 @@ def on_update(namespace):
 
 
 def _update(bucket, files, namespace):
+    plan, processed, size = _plan(files, namespace)
+    plan = _batch_deletes(plan, conf.get("DELETE_BATCH_SIZE"))
+    plan = _batch_renames(plan, conf.get("DELETE_BATCH_SIZE"))
+    plan = [
+        task_cls().init(bucket, name, data) for task_cls, name, data in plan
+    ]
+    plan = schedule.order(
+        [(task, task.size()) for task in plan],
+        conf.get("THREAD_MAX_COUNT"),
+        conf.get("SCHEDULE_SMALL_SIZE"),
+        conf.get("TASK_COST"),
+    )
+
+    transfer = metrics.metrics.phase("transfer")
+    with transfer, cache.cache.writer(), reprint.output(
+        initial_len=utils.output_len()
+    ) as output:
+        with workers.Executor(
+            conf.get("THREAD_MAX_COUNT"),
+            output=output,
+            tasks_total=len(plan),
+            size_total=size,
+        ) as executor:
+            executor.map(plan)
+
+    return processed, size
+
+
+def _batch_deletes(plan, batch_size):
+    """
+    Replace remote deletes of plan with multi-object delete batches.
+
+    :param list plan: of (task class, name, data)
+    :param int batch_size: keys per delete request (S3 allows 1000)
+
+    :rtype: list
+    """
+    if not batch_size or batch_size <= 1:
+        return plan
+
+    result = []
+    batch = []
+
+    def _flush():
+        name = "{} ({} keys)".format(batch[0]["name"], len(batch))
+        result.append((tasks.DeleteRemoteBatch, name, list(batch)))
+        batch.clear()
+
+    for task_cls, name, data in plan:
+        if task_cls is not tasks.DeleteRemote:
+            result.append((task_cls, name, data))
+            continue
+
+        batch.append(data)
+        if len(batch) >= batch_size:
+            _flush()
+
+    if batch:
+        _flush()
+    return result
+
+
+def _batch_renames(plan, batch_size):
+    """
+    Replace remote renames of plan with directory move batches.
+
+    :param list plan: of (task class, name, data)
+    :param int batch_size: keys per batch (sources are deleted at once)
+
+    :rtype: list
+    """
+    if not batch_size or batch_size <= 1:
+        return plan
+
+    result = []
+    renames = {}
+    for task_cls, name, data in plan:
+        if task_cls is tasks.RenameRemote:
+            renames[name] = data
+        else:
+            result.append((task_cls, name, data))
+
+    moves = rename.group_moves(
+        (name, data["key"].name, data["local_name"])
+        for name, data in renames.items()
+    )
+    for move in moves:
+        chunks = range(0, len(move.names), batch_size)
+        for index, start in enumerate(chunks, start=1):
+            name = str(move)
+            if len(chunks) > 1:
+                name += " [{}/{}]".format(index, len(chunks))
+            keys = move.names[start : start + batch_size]
+            batch = [renames[key] for key in keys]
+            result.append((tasks.RenameRemoteBatch, name, batch))
+    return result
+
+
+def _plan(files, namespace):
+    """
+    Choose action for each diff entry (asking user if needed).
+
+    :param dict files: diff result
+    :param argparse.Namespace namespace:
+
+    :return: plan of (task class, name, data), processed count, total size
+    :rtype: tuple
+    """
+    plan = []
     processed = 0
     size = 0
 
-    pool = workers.ThreadPool(conf.get("THREAD_MAX_COUNT"))
-
     for name, data in files.items():
         action = None
 
@@ -320,9 +391,9 @@ def _update(bucket, files, namespace):
 
         elif data["state"] == constants.STATE_LOCAL_NEW:
             if namespace.upload:
-                action = tasks.Upload()
+                action = tasks.Upload
             elif namespace.delete_local:
-                action = tasks.DeleteLocal()
+                action = tasks.DeleteLocal
             elif namespace.quiet:
                 continue
             else:
@@ -332,13 +403,13 @@ def _update(bucket, files, namespace):
                 if act == "n":
                     continue
                 else:
-                    action = act
+                    action = type(act)
 
         elif data["state"] == constants.STATE_LOCAL_MISSING:
             if namespace.download:
-                action = tasks.Download()
+                action = tasks.Download
             elif namespace.delete_remote:
-                action = tasks.DeleteRemote()
+                action = tasks.DeleteRemote
             elif namespace.quiet:
                 continue
             else:
@@ -348,48 +419,44 @@ def _update(bucket, files, namespace):
 
                 if act == "n":
                     continue
-                action = act
+                action = type(act)
 
         elif data["state"] == constants.STATE_RENAMED:
             if _check(name, data, namespace.quiet, namespace.rename_remote):
-                action = tasks.RenameRemote()
+                action = tasks.RenameRemote
             elif _check(name, data, namespace.quiet, namespace.rename_local):
-                action = tasks.RenameLocal()
+                action = tasks.RenameLocal
             else:
                 continue
 
         elif data["state"] == constants.STATE_LOCAL_NEWER:
             if _check(name, data, namespace.quiet, namespace.replace_upload):
-                action = tasks.ReplaceUpload()
+                action = tasks.ReplaceUpload
             else:
                 continue
 
         elif data["state"] == constants.STATE_LOCAL_OLDER:
             if _check(name, data, namespace.quiet, namespace.replace_download):
-                action = tasks.Download()
+                action = tasks.Download
             else:
                 continue
 
         if not action:
             logging.error("Unknown action")
             continue
-        pool.add_task(action.init(bucket, name, data))
+        plan.append((action, name, data))
         processed += 1
 
-        if isinstance(action, tasks.Download):
+        if issubclass(action, tasks.Download):
             size += data.get("size") or 0
-        elif isinstance(action, (tasks.Upload, tasks.ReplaceUpload)):
+        elif issubclass(action, (tasks.Upload, tasks.ReplaceUpload)):
             size += data.get("local_size") or 0
 
         if processed >= namespace.limit > 0:
             logger.info("list limit reached!")
             break
 
-    with reprint.output(initial_len=conf.get("THREAD_MAX_COUNT")) as output:
-        pool.start(output)
-        pool.join()
-
-    return processed, size
+    return plan, processed, size
 
 
 def _check(name, data, quiet, confirm):
@@ -431,10 +498,108 @@ def _confirm_update(name, data, *values):
     return values_map[input_data[0]]
 
 
-def on_cache_update(_namespace):
+@metrics.instrument("manifest")
+def on_manifest(namespace):
+    conf.init()
+    root = conf.get("PROJECT_ROOT")
+    if not root:
+        raise errors.UserError("not in project")
+
+    path = namespace.file or os.path.join(
+        root, conf.get("MANIFEST_FILE_NAME")
+    )
+    jobs = namespace.jobs or os.cpu_count() or 1
+    target = manifest.Manifest(path)
+    try:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+            if namespace.action == "export":
+                _manifest_export(target, root, pool, jobs * 4)
+            else:
+                _manifest_verify(target, pool, jobs * 4, namespace.restart)
+    finally:
+        target.close()
+
+
+def _manifest_export(target, root, pool, window):
+    cache.cache.init()
+    if not cache.cache.total():
+        logger.warning("cache is empty, run cache-update first")
+
+    skip = _sqlite_files(target.path) | _sqlite_files(
+        os.path.join(root, conf.get("CACHE_FILE_NAME"))
+    )
+    with metrics.metrics.phase("local_walk"):
+        local = sorted(
+            (utils.file_key(file_path), file_path)
+            for file_path in utils.iter_local_path(
+                root, recursive=True, exclude=conf.get("IGNORE")
+            )
+            if file_path not in skip
+        )
+    metrics.metrics.inc("keys_total", len(local), "local")
+
+    items = diff.merge_join(
+        local, ((row["name"], row) for row in cache.cache.select())
+    )
+    with metrics.metrics.phase("hash"):
+        written, hashed = manifest.export(
+            target,
+            items,
+            root,
+            pool,
+            window,
+            cached=utils.cached_hashes,
+            saved=utils.save_hashes,
+        )
+    cache.cache.flush()
+    logger.info(
+        "manifest %s: %d entries updated, %d files hashed",
+        target.path,
+        written,
+        hashed,
+    )
+
+
+def _manifest_verify(target, pool, window, restart):
+    if target.meta("root") is None:
+        raise errors.UserError("manifest {} is empty".format(target.path))
+
+    with metrics.metrics.phase("hash"):
+        run, failed = manifest.verify(target, pool, window, restart=restart)
+    for name, status in failed:
+        logger.warning("%s %s", status, name)
+
+    summary = target.verify_summary(run)
+    logger.info(
+        "verify run %d: %s",
+        run,
+        ", ".join(
+            "{} {}".format(count, status)
+            for status, count in sorted(summary.items())
+        )
+        or "nothing to check",
+    )
+    failed_count = sum(
+        count
+        for status, count in summary.items()
+        if status != manifest.STATUS_OK
+    )
+    if failed_count:
+        raise errors.UserError(
+            "{} files failed verification".format(failed_count)
+        )
+
+
+@metrics.instrument("cache-update")
+def on_cache_update(namespace):
     conf.init()
     cache.cache.init()
     bucket = utils.connect_bucket()
-    with reprint.output() as output:
-        utils.update_cache(bucket, reprint=output)
+    with reprint.output(initial_len=utils.output_len()) as output:
+        if namespace.path:
+            utils.refresh_cache(
+                bucket, utils.remote_prefix(namespace.path), reprint=output
+            )
+        else:
+            utils.update_cache(bucket, reprint=output, fast=namespace.fast)
     logger.info("cached %d remote objects", cache.cache.total())
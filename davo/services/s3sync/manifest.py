@@ -0,0 +1,389 @@
+import concurrent.futures
+import datetime
+import logging
+import os
+import sqlite3
+
+from . import diff, multipart
+
+logger = logging.getLogger(__name__)
+
+QUERY_CREATE_ENTRIES = (
+    "CREATE TABLE IF NOT EXISTS entries ( "
+    "name text PRIMARY KEY, "
+    "size int, "
+    "mtime_ns int, "
+    "inode int, "
+    "md5 text, "
+    "local_etag text, "
+    "remote_size int, "
+    "etag text, "
+    "verified text, "
+    "verify_run int) WITHOUT ROWID"
+)
+QUERY_CREATE_META = (
+    "CREATE TABLE IF NOT EXISTS meta (key text PRIMARY KEY, value text)"
+)
+QUERY_META_SET = "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)"
+QUERY_META_GET = "SELECT value FROM meta WHERE key=?"
+QUERY_ENTRIES_UPSERT = (
+    "INSERT INTO entries "
+    "(name, size, mtime_ns, inode, md5, local_etag, remote_size, etag) "
+    "VALUES (:name, :size, :mtime_ns, :inode, :md5, :local_etag, "
+    ":remote_size, :etag) "
+    "ON CONFLICT(name) DO UPDATE SET "
+    "size=excluded.size, "
+    "mtime_ns=excluded.mtime_ns, "
+    "inode=excluded.inode, "
+    "md5=excluded.md5, "
+    "local_etag=excluded.local_etag, "
+    "remote_size=excluded.remote_size, "
+    "etag=excluded.etag, "
+    "verified=NULL, "
+    "verify_run=NULL"
+)
+QUERY_ENTRIES_FILTER = (
+    "SELECT name, size, mtime_ns, inode, md5, local_etag, remote_size, etag "
+    "FROM entries"
+)
+QUERY_ENTRIES_DELETE = "DELETE FROM entries WHERE name=?"
+QUERY_VERIFY_SET = (
+    "UPDATE entries SET verified=?, verify_run=? WHERE name=?"
+)
+QUERY_VERIFY_SUMMARY = (
+    "SELECT verified, COUNT(*) FROM entries WHERE verify_run=? "
+    "GROUP BY verified"
+)
+
+STATUS_OK = "ok"
+STATUS_MISSING = "missing"
+STATUS_SIZE = "size"
+STATUS_CHANGED = "changed"
+# can't read file
+STATUS_ERROR = "error"
+
+_FIELDS = (
+    "name",
+    "size",
+    "mtime_ns",
+    "inode",
+    "md5",
+    "local_etag",
+    "remote_size",
+    "etag",
+)
+
+
+class Manifest:
+    """
+    Checksum manifest of synced tree: SQLite file with one row per key
+    (sorted by name), local size, mtime, md5 and multipart etag, remote
+    size and etag.
+
+    Rows are committed in batches, so interrupted export or verify
+    continues from where it stopped. Journal is WAL, so entries are read
+    by separate connection while results are written.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        cur = self.conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute(QUERY_CREATE_ENTRIES)
+        cur.execute(QUERY_CREATE_META)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def meta(self, key, default=None):
+        row = self.conn.execute(QUERY_META_GET, (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_meta(self, key, value):
+        self.conn.execute(QUERY_META_SET, (key, str(value)))
+
+    def iter_entries(self, skip_run=None):
+        """
+        Iterate entries ordered by name, from snapshot taken on start.
+
+        :param int skip_run: skip entries verified by this run
+
+        :rtype: Iterator[dict]
+        """
+        query = QUERY_ENTRIES_FILTER
+        params = ()
+        if skip_run is not None:
+            query += " WHERE verify_run IS NULL OR verify_run!=?"
+            params = (skip_run,)
+        reader = sqlite3.connect(self.path)
+        try:
+            for row in reader.execute(query + " ORDER BY name", params):
+                yield dict(zip(_FIELDS, row))
+        finally:
+            reader.close()
+
+    def write(self, entries, deleted=()):
+        """
+        :param list[dict] entries: upserted
+        :param list[str] deleted: names
+        """
+        with self.conn:
+            self.conn.executemany(QUERY_ENTRIES_UPSERT, entries)
+            self.conn.executemany(
+                QUERY_ENTRIES_DELETE, ((name,) for name in deleted)
+            )
+
+    def set_verified(self, results, run):
+        """
+        :param Iterable[tuple] results: name, status
+        :param int run: verify run id
+        """
+        with self.conn:
+            self.conn.executemany(
+                QUERY_VERIFY_SET,
+                ((status, run, name) for name, status in results),
+            )
+
+    def verify_summary(self, run):
+        """
+        :return: status: count
+        :rtype: dict
+        """
+        return dict(self.conn.execute(QUERY_VERIFY_SUMMARY, (run,)))
+
+
+def map_bounded(pool, func, jobs, window):
+    """
+    Run jobs on pool keeping at most `window` of them in flight, so long
+    job streams don't pile up in memory.
+
+    :param concurrent.futures.Executor pool:
+    :param callable func:
+    :param Iterable[tuple] jobs: tag, args
+    :param int window:
+
+    :return: tag, result or exception, in completion order
+    :rtype: Iterator[tuple]
+    """
+    pending = {}
+
+    def _drain(return_when):
+        done, _ = concurrent.futures.wait(pending, return_when=return_when)
+        for future in done:
+            tag = pending.pop(future)
+            exc = future.exception()
+            yield tag, exc if exc is not None else future.result()
+
+    try:
+        for tag, args in jobs:
+            pending[pool.submit(func, *args)] = tag
+            if len(pending) >= window:
+                yield from _drain(concurrent.futures.FIRST_COMPLETED)
+        while pending:
+            yield from _drain(concurrent.futures.FIRST_COMPLETED)
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def export(
+    manifest,
+    items,
+    root,
+    pool,
+    window,
+    cached=None,
+    saved=None,
+    batch_size=1000,
+):
+    """
+    Write manifest entries for merged local and remote keys.
+
+    Items are merged with manifest as both are sorted by name: files
+    unchanged since last export (same size, mtime, inode and etag) are
+    kept, entries of gone keys are deleted. Other local files get hashes
+    from `cached` or are hashed on process pool (part size is computed
+    here, workers don't share config).
+
+    :param Manifest manifest:
+    :param Iterable[tuple] items: key, local path or None, remote row or
+        None (see `diff.merge_join`)
+    :param str root: project root, stored for verify
+    :param concurrent.futures.Executor pool:
+    :param int window: max hash jobs in flight
+    :param callable cached: (path, stat, part size) -> hashes or None
+    :param callable saved: (path, stat, part size, hashes), on new hashes
+    :param int batch_size: entries per commit
+
+    :return: written entries, hashed files
+    :rtype: tuple
+    """
+    manifest.set_meta("root", root)
+    manifest.set_meta(
+        "exported_at",
+        datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+    )
+    batch = []
+    deleted = []
+    written = hashed = 0
+
+    def _add(entry=None, name=None):
+        if entry is not None:
+            batch.append(entry)
+        if name is not None:
+            deleted.append(name)
+        if len(batch) + len(deleted) >= batch_size:
+            _flush()
+
+    def _flush():
+        nonlocal written
+        manifest.write(batch, deleted)
+        written += len(batch)
+        batch.clear()
+        deleted.clear()
+
+    def _jobs():
+        merged = diff.merge_join(
+            ((key, (path, row)) for key, path, row in items),
+            ((entry["name"], entry) for entry in manifest.iter_entries()),
+        )
+        for key, item, old in merged:
+            if item is None:
+                _add(name=key)
+                continue
+
+            path, row = item
+            entry = dict.fromkeys(_FIELDS)
+            entry["name"] = key
+            if row is not None:
+                entry["remote_size"] = row["size"]
+                entry["etag"] = (row["etag"] or "").strip('"') or None
+
+            stat = None
+            if path is not None:
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    pass
+            if stat is not None:
+                entry["size"] = stat.st_size
+                entry["mtime_ns"] = stat.st_mtime_ns
+                entry["inode"] = stat.st_ino
+
+            if old is not None and all(
+                old[field] == entry[field]
+                for field in ("size", "mtime_ns", "inode", "etag")
+            ):
+                continue
+
+            if stat is None:
+                _add(entry)
+                continue
+
+            part_size = multipart.part_size_for(stat.st_size)
+            hashes = cached(path, stat, part_size) if cached else None
+            if hashes is not None:
+                entry["md5"], entry["local_etag"] = hashes
+                _add(entry)
+                continue
+
+            yield (entry, path, stat, part_size), (
+                path,
+                stat.st_size,
+                part_size,
+            )
+
+    results = map_bounded(pool, multipart.file_hashes, _jobs(), window)
+    for (entry, path, stat, part_size), result in results:
+        if isinstance(result, BaseException):
+            logger.warning("%s: %s", entry["name"], result)
+            continue
+        hashed += 1
+        entry["md5"], entry["local_etag"] = result
+        if saved:
+            saved(path, stat, part_size, result)
+        _add(entry)
+
+    _flush()
+    return written, hashed
+
+
+def verify(manifest, pool, window, restart=False, batch_size=1000):
+    """
+    Check local files against manifest md5, hashing on pool.
+
+    Results are saved per entry with run id, so next call (unless
+    `restart`) skips entries already checked by unfinished run. Files
+    failed to read are reported as `STATUS_ERROR`, results checked before
+    other errors are saved.
+
+    :param Manifest manifest:
+    :param concurrent.futures.Executor pool:
+    :param int window: max hash jobs in flight
+    :param bool restart: start new run
+    :param int batch_size: results per commit
+
+    :return: run id, mismatched (name, status) of this call
+    :rtype: tuple
+    """
+    root = manifest.meta("root")
+    run = int(manifest.meta("verify_run", 0))
+    if restart or manifest.meta("verify_done") == str(run):
+        run += 1
+        manifest.set_meta("verify_run", run)
+        manifest.conn.commit()
+
+    results = []
+    failed = []
+
+    def _save(name, status):
+        results.append((name, status))
+        if status != STATUS_OK:
+            failed.append((name, status))
+        if len(results) >= batch_size:
+            manifest.set_verified(results, run)
+            results.clear()
+
+    def _jobs():
+        for entry in manifest.iter_entries(skip_run=run):
+            if entry["md5"] is None:
+                continue
+            path = os.path.join(root, entry["name"])
+            try:
+                size = os.stat(path).st_size
+            except FileNotFoundError:
+                _save(entry["name"], STATUS_MISSING)
+                continue
+            except OSError as exc:
+                logger.warning("%s: %s", entry["name"], exc)
+                _save(entry["name"], STATUS_ERROR)
+                continue
+            if size != entry["size"]:
+                _save(entry["name"], STATUS_SIZE)
+                continue
+            part_size = multipart.part_size_for(size)
+            yield entry, (path, size, part_size)
+
+    hashed = map_bounded(pool, multipart.file_hashes, _jobs(), window)
+    try:
+        for entry, result in hashed:
+            if isinstance(result, FileNotFoundError):
+                _save(entry["name"], STATUS_MISSING)
+            elif isinstance(result, OSError):
+                logger.warning("%s: %s", entry["name"], result)
+                _save(entry["name"], STATUS_ERROR)
+            elif isinstance(result, BaseException):
+                raise result
+            elif result[0] != entry["md5"]:
+                _save(entry["name"], STATUS_CHANGED)
+            else:
+                _save(entry["name"], STATUS_OK)
+    finally:
+        manifest.set_verified(results, run)
+
+    manifest.set_meta("verify_done", run)
+    manifest.conn.commit()
+    return run, failed
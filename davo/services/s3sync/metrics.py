@@ -0,0 +1,206 @@
+import collections
+import contextlib
+import datetime
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+from . import conf
+
+logger = logging.getLogger(__name__)
+
+PROMETHEUS_PREFIX = "s3sync_"
+
+# name: type, label name (or None), help
+METRICS = {
+    "phase_seconds": ("gauge", "phase", "Wall time of operation phase."),
+    "keys_total": ("counter", "source", "Keys walked, listed or compared."),
+    "requests_total": ("counter", "method", "S3 requests sent."),
+    "tasks_total": ("counter", "task", "Tasks finished."),
+    "errors_total": ("counter", "task", "Tasks failed."),
+    "retries_total": ("counter", None, "Transient errors retried."),
+    "bytes_total": ("counter", "task", "Bytes transferred."),
+    "worker_utilization": ("gauge", "worker", "Busy share of worker time."),
+    "concurrency_limit": ("gauge", None, "Last adaptive workers limit."),
+    "throttled_seconds": (
+        "counter",
+        None,
+        "Time transfers slept in bandwidth limiter, summed over threads.",
+    ),
+}
+
+
+class Metrics:
+    """
+    Thread-safe registry of command metrics.
+
+    Each metric has at most one label (see `METRICS`), so a report is
+    a flat mapping of metric: value or metric: {label value: value}.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.values = collections.defaultdict(float)
+
+    def reset(self):
+        with self._lock:
+            self.values.clear()
+
+    def inc(self, name, value=1, label=None):
+        """
+        Add value to counter (or to accumulated gauge).
+
+        :param str name: one of `METRICS`
+        :param float value:
+        :param str label: label value, if metric has label
+        """
+        with self._lock:
+            self.values[name, label] += value
+
+    def set(self, name, value, label=None):
+        with self._lock:
+            self.values[name, label] = value
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Add block wall time to `phase_seconds`.
+
+        :param str name:
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.inc("phase_seconds", time.perf_counter() - started, name)
+
+    def report(self):
+        """
+        :return: metric: value or metric: {label value: value}
+        :rtype: dict
+        """
+        with self._lock:
+            items = sorted(
+                self.values.items(),
+                key=lambda item: (item[0][0], str(item[0][1] or "")),
+            )
+
+        result = {}
+        for (name, label), value in items:
+            value = round(float(value), 6)
+            if value.is_integer():
+                value = int(value)
+            if METRICS[name][1] is None:
+                result[name] = value
+            else:
+                result.setdefault(name, {})[label] = value
+        return result
+
+    def to_json(self, command):
+        return json.dumps(
+            {
+                "time": datetime.datetime.utcnow().strftime(
+                    "%Y-%m-%dT%H:%M:%S.000Z"
+                ),
+                "command": command,
+                **self.report(),
+            }
+        )
+
+    def to_prometheus(self, command):
+        lines = []
+        for name, value in self.report().items():
+            kind, label_name, help_ = METRICS[name]
+            full_name = PROMETHEUS_PREFIX + name
+            lines.append("# HELP {} {}".format(full_name, help_))
+            lines.append("# TYPE {} {}".format(full_name, kind))
+            if not isinstance(value, dict):
+                lines.append(
+                    '{}{{command="{}"}} {}'.format(full_name, command, value)
+                )
+                continue
+            for label, label_value in value.items():
+                lines.append(
+                    '{}{{command="{}",{}="{}"}} {}'.format(
+                        full_name,
+                        command,
+                        label_name,
+                        _escape(label),
+                        label_value,
+                    )
+                )
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, command):
+        """
+        Write report of command: appended JSON line, or Prometheus textfile
+        (replaced atomically) if path ends with `.prom`.
+
+        :param str path:
+        :param str command:
+        """
+        if path.endswith(".prom"):
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w") as file:
+                file.write(self.to_prometheus(command))
+            os.replace(tmp_path, path)
+        else:
+            with open(path, "a") as file:
+                file.write(self.to_json(command) + "\n")
+
+
+def _escape(value):
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+    )
+
+
+metrics = Metrics()
+
+_depth = 0
+
+
+def instrument(command):
+    """
+    Collect metrics of handler call, written to `--metrics` path (or
+    METRICS_FILE) when outermost instrumented handler returns or fails.
+
+    :param str command: name in report
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(namespace, *args, **kwargs):
+            global _depth  # pylint: disable=global-statement
+            if _depth == 0:
+                metrics.reset()
+            _depth += 1
+            try:
+                if _depth > 1:
+                    return func(namespace, *args, **kwargs)
+                with metrics.phase("total"):
+                    return func(namespace, *args, **kwargs)
+            finally:
+                _depth -= 1
+                if _depth == 0:
+                    _write(namespace, command)
+
+        return wrapper
+
+    return decorator
+
+
+def _write(namespace, command):
+    path = getattr(namespace, "metrics", None) or conf.get("METRICS_FILE")
+    if not path:
+        return
+    try:
+        metrics.write(os.path.expanduser(path), command)
+    except OSError as exc:
+        logger.error("metrics write failed: %s", exc)
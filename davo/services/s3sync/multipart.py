@@ -0,0 +1,239 @@
+import base64
+import concurrent.futures
+import hashlib
+import io
+import logging
+import math
+import os
+import threading
+
+import davo.utils
+
+from . import cache, conf, connections
+
+logger = logging.getLogger(__name__)
+
+# S3 limit of parts per upload
+PARTS_MAX = 10000
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Part pool shared by all uploads, sized by MULTIPART_THREADS.
+
+    :rtype: concurrent.futures.ThreadPoolExecutor
+    """
+    global _pool  # pylint: disable=global-statement
+    with _pool_lock:
+        if _pool is None:
+            _pool = concurrent.futures.ThreadPoolExecutor(
+                conf.get("MULTIPART_THREADS"),
+                thread_name_prefix="s3part",
+            )
+        return _pool
+
+
+def part_size_for(size, chunk_size=None):
+    """
+    Part size for file size, grown to fit S3 parts limit.
+
+    :param int size:
+    :param int chunk_size: preferred part size
+
+    :rtype: int
+    """
+    if chunk_size is None:
+        chunk_size = conf.get("MULTIPART_CHUNK_SIZE")
+    return max(chunk_size, math.ceil(size / PARTS_MAX))
+
+
+def iter_parts(size, part_size):
+    """
+    Iterate file parts: number (from 1), offset, length.
+
+    :param int size:
+    :param int part_size:
+
+    :rtype: Iterator[tuple]
+    """
+    for index, offset in enumerate(range(0, size, part_size), start=1):
+        yield index, offset, min(part_size, size - offset)
+
+
+def multipart_etag(digests):
+    """
+    S3 ETag of multipart upload: md5 of part md5 digests with parts count.
+
+    :param list[bytes] digests: part md5 digests, in part order
+
+    :rtype: str
+    """
+    return '"{}-{}"'.format(
+        hashlib.md5(b"".join(digests)).hexdigest(), len(digests)
+    )
+
+
+def file_hashes(path, size, part_size=None):
+    """
+    Compute file md5 and multipart etag in one read.
+
+    :param str path:
+    :param int size:
+    :param int part_size: part size of multipart etag
+
+    :return: md5 hex, unquoted multipart etag
+    :rtype: tuple
+    """
+    if part_size is None:
+        part_size = part_size_for(size)
+
+    hashes = davo.utils.hashing.hash_file(
+        path,
+        (davo.utils.hashing.MD5, davo.utils.hashing.ETAG),
+        part_size=part_size,
+    )
+    return hashes[davo.utils.hashing.MD5], hashes[davo.utils.hashing.ETAG]
+
+
+class Progress:
+    """
+    Thread-safe sum of parts progress, reported to transfer callback.
+    """
+
+    def __init__(self, size, callback=None):
+        self.size = size
+        self.callback = callback
+        self.sent = 0
+        self._parts = {}
+        self._lock = threading.Lock()
+
+    def update(self, part_num, sent):
+        with self._lock:
+            self.sent += sent - self._parts.get(part_num, 0)
+            self._parts[part_num] = sent
+            total = self.sent
+        if self.callback and self.size:
+            self.callback(total, self.size)
+
+
+def upload(bucket, name, path, callback=None, chunk_size=None):
+    """
+    Upload file by parts concurrently, resuming unfinished upload.
+
+    Upload id is saved to cache, so an interrupted upload of unchanged
+    file continues with parts missing on S3.
+
+    :param boto.s3.bucket.Bucket bucket:
+    :param str name: key name
+    :param str path: local file path
+    :param callable callback: progress callback (sent, total)
+    :param int chunk_size: preferred part size
+
+    :return: multipart etag, quoted like S3 one
+    :rtype: str
+    """
+    stat = os.stat(path)
+    part_size = part_size_for(stat.st_size, chunk_size)
+    progress = Progress(stat.st_size, callback)
+
+    mp, uploaded = _resume(bucket, name, stat, part_size)
+    if mp is None:
+        mp = bucket.initiate_multipart_upload(name)
+        cache.cache.upload_save(
+            {
+                "name": name,
+                "upload_id": mp.id,
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "part_size": part_size,
+            }
+        )
+    else:
+        logger.info("resuming upload %s (%d parts)", name, len(uploaded))
+
+    futures = [
+        get_pool().submit(
+            _upload_part,
+            mp,
+            path,
+            part_num,
+            offset,
+            length,
+            uploaded.get(part_num),
+            progress,
+        )
+        for part_num, offset, length in iter_parts(stat.st_size, part_size)
+    ]
+    try:
+        digests = [future.result() for future in futures]
+    except BaseException:
+        # upload is kept on S3 and in cache for resume
+        for future in futures:
+            future.cancel()
+        concurrent.futures.wait(futures)
+        raise
+
+    result = mp.complete_upload()
+    cache.cache.upload_delete(name)
+
+    etag = multipart_etag(digests)
+    if result.etag and result.etag != etag:
+        logger.warning(
+            "multipart etag mismatch %s: %s != %s", name, result.etag, etag
+        )
+        etag = result.etag
+    return etag
+
+
+def _resume(bucket, name, stat, part_size):
+    state = cache.cache.upload_get(name)
+    if not state:
+        return None, {}
+
+    if (
+        state["size"] != stat.st_size
+        or state["mtime_ns"] != stat.st_mtime_ns
+        or state["part_size"] != part_size
+    ):
+        _cancel(bucket, name, state["upload_id"])
+        return None, {}
+
+    for mp in bucket.get_all_multipart_uploads(prefix=name):
+        if mp.id == state["upload_id"] and mp.key_name == name:
+            return mp, {part.part_number: part.etag for part in mp}
+
+    cache.cache.upload_delete(name)
+    return None, {}
+
+
+def _cancel(bucket, name, upload_id):
+    cache.cache.upload_delete(name)
+    try:
+        bucket.cancel_multipart_upload(name, upload_id)
+    except Exception as exc:  # pylint: disable=broad-except
+        logger.warning("stale upload %s cancel failed: %s", name, exc)
+
+
+def _upload_part(mp, path, part_num, offset, length, etag, progress):
+    with open(path, "rb") as file:
+        file.seek(offset)
+        data = file.read(length)
+
+    md5 = hashlib.md5(data)
+    if etag == '"{}"'.format(md5.hexdigest()):
+        progress.update(part_num, length)
+        return md5.digest()
+
+    connections.thread_upload(mp).upload_part_from_file(
+        io.BytesIO(data),
+        part_num,
+        cb=lambda sent, _total: progress.update(part_num, sent),
+        num_cb=conf.get("UPLOAD_CB_NUM"),
+        md5=(md5.hexdigest(), base64.b64encode(md5.digest()).decode()),
+        size=length,
+    )
+    progress.update(part_num, length)
+    return md5.digest()
@@ -0,0 +1,178 @@
+import concurrent.futures
+import dataclasses
+import logging
+
+from . import conf, connections, multipart
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class Move:
+    """
+    Renames sharing one prefix change (`source` -> `dest`).
+
+    Prefixes are whole directories (with trailing slash), or full key names
+    when the file name itself was changed.
+    """
+
+    source: str
+    dest: str
+    names: list = dataclasses.field(default_factory=list)
+
+    def __str__(self):
+        if len(self.names) == 1 and not self.source.endswith("/"):
+            return "{} -> {}".format(self.source, self.dest)
+        return "{}* -> {}* ({} keys)".format(
+            self.source, self.dest, len(self.names)
+        )
+
+
+def split_move(name, new_name):
+    """
+    Reduce rename to directory move: strip common trailing path parts.
+
+    :param str name: old key
+    :param str new_name: new key
+
+    :return: source prefix, dest prefix
+    :rtype: tuple
+    """
+    parts = name.split("/")
+    new_parts = new_name.split("/")
+
+    common = 0
+    while (
+        common < min(len(parts), len(new_parts))
+        and parts[-1 - common] == new_parts[-1 - common]
+    ):
+        common += 1
+
+    if not common:
+        return name, new_name
+
+    source = "/".join(parts[: len(parts) - common])
+    dest = "/".join(new_parts[: len(new_parts) - common])
+    return source + "/" if source else "", dest + "/" if dest else ""
+
+
+def group_moves(renames):
+    """
+    Group renames by prefix change, in order of first appearance.
+
+    :param Iterable[tuple] renames: key, old name, new name
+
+    :rtype: list[Move]
+    """
+    moves = {}
+    for key, name, new_name in renames:
+        source, dest = split_move(name, new_name)
+        move = moves.get((source, dest))
+        if move is None:
+            move = moves[source, dest] = Move(source, dest)
+        move.names.append(key)
+    return list(moves.values())
+
+
+def copy_keys(bucket, entries, callback=None):
+    """
+    Copy keys inside bucket server-side, concurrently.
+
+    Small keys are copied on multipart pool, large ones (from
+    MULTIPART_THRESHOLD) by multipart copy with parts on the same pool.
+
+    :param boto.s3.bucket.Bucket bucket:
+    :param list[tuple] entries: source name, dest name, size
+    :param callable callback: progress (copied keys, total keys)
+
+    :return: dest etags by source name, errors by source name
+    :rtype: tuple[dict, dict]
+    """
+    threshold = conf.get("MULTIPART_THRESHOLD")
+    pool = multipart.get_pool()
+    etags, errors = {}, {}
+    copied = 0
+
+    def _done(source, func, *args):
+        nonlocal copied
+        try:
+            etags[source] = func(*args)
+        except Exception as exc:  # pylint: disable=broad-except
+            errors[source] = exc
+        copied += 1
+        if callback:
+            callback(copied, len(entries))
+
+    futures = {
+        source: pool.submit(copy_key, bucket, source, dest)
+        for source, dest, size in entries
+        if size < threshold
+    }
+    try:
+        for source, dest, size in entries:
+            if size >= threshold:
+                _done(source, copy_key_multipart, bucket, source, dest, size)
+        for source, future in futures.items():
+            _done(source, future.result)
+    except BaseException:
+        for future in futures.values():
+            future.cancel()
+        concurrent.futures.wait(futures.values())
+        raise
+
+    return etags, errors
+
+
+def copy_key(bucket, source, dest):
+    """
+    Copy key with one request, keeping its ACL.
+
+    :rtype: str
+    :return: dest etag
+    """
+    bucket = connections.thread_bucket(bucket)
+    key = bucket.copy_key(dest, bucket.name, source, preserve_acl=True)
+    return key.etag
+
+
+def copy_key_multipart(bucket, source, dest, size):
+    """
+    Copy large key by ranges of source concurrently, keeping its ACL.
+
+    Unfinished upload is aborted on error.
+
+    :rtype: str
+    :return: dest etag (multipart one)
+    """
+    bucket = connections.thread_bucket(bucket)
+    mp = bucket.initiate_multipart_upload(dest)
+    futures = [
+        multipart.get_pool().submit(
+            _copy_part, mp, bucket.name, source, part_num, offset, length
+        )
+        for part_num, offset, length in multipart.iter_parts(
+            size, multipart.part_size_for(size)
+        )
+    ]
+    try:
+        for future in futures:
+            future.result()
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        concurrent.futures.wait(futures)
+        try:
+            mp.cancel_upload()
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.warning("copy upload %s cancel failed: %s", dest, exc)
+        raise
+
+    result = mp.complete_upload()
+    bucket.set_xml_acl(bucket.get_xml_acl(source), dest)
+    return result.etag
+
+
+def _copy_part(mp, bucket_name, source, part_num, offset, length):
+    connections.thread_upload(mp).copy_part_from_key(
+        bucket_name, source, part_num, offset, offset + length - 1
+    )
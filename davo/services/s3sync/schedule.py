@@ -0,0 +1,87 @@
+import heapq
+
+LANE_META = "meta"
+LANE_SMALL = "small"
+LANE_LARGE = "large"
+
+# lane: classes it takes, in order of preference
+_PREFERENCE = {
+    LANE_META: (LANE_META, LANE_SMALL, LANE_LARGE),
+    LANE_SMALL: (LANE_SMALL, LANE_META, LANE_LARGE),
+    LANE_LARGE: (LANE_LARGE, LANE_SMALL, LANE_META),
+}
+
+
+def size_class(size, small_size):
+    """
+    :param int size: bytes to transfer, 0 for metadata only operations
+    :param int small_size: smallest size of large transfer
+
+    :rtype: str
+    """
+    if not size:
+        return LANE_META
+    if size < small_size:
+        return LANE_SMALL
+    return LANE_LARGE
+
+
+def lanes_for(threads, classes):
+    """
+    Split threads to lanes: one for metadata operations and one for small
+    files (when there are any), the rest for large transfers.
+
+    :param int threads:
+    :param set classes: size classes present in plan
+
+    :rtype: list[str]
+    """
+    lanes = []
+    for lane in (LANE_META, LANE_SMALL):
+        if lane in classes and len(lanes) < threads - 1:
+            lanes.append(lane)
+    return lanes + [LANE_LARGE] * (threads - len(lanes))
+
+
+def order(items, threads, small_size, task_cost):
+    """
+    Order items for FIFO thread pool, so it runs them as dedicated lanes.
+
+    Executor threads take next queued item when free, so items are
+    ordered by start time of greedy simulation: large transfers go
+    longest first (LPT) on large lanes, small files and metadata
+    operations keep own lanes running meanwhile. Lane that ran out of
+    its class helps others. Cost of item is its size plus `task_cost`
+    (request overhead in bytes).
+
+    :param list[tuple] items: item, size
+    :param int threads:
+    :param int small_size: smallest size of large transfer
+    :param int task_cost:
+
+    :rtype: list
+    """
+    pending = {lane: [] for lane in _PREFERENCE}
+    for index, (item, size) in enumerate(items):
+        pending[size_class(size, small_size)].append((size, index, item))
+    # pop from the end: largest first, others keep plan order
+    pending[LANE_LARGE].sort(key=lambda entry: (entry[0], -entry[1]))
+    pending[LANE_SMALL].reverse()
+    pending[LANE_META].reverse()
+
+    lanes = lanes_for(
+        max(threads, 1), {lane for lane, left in pending.items() if left}
+    )
+    free = [(0, num) for num in range(len(lanes))]
+    started = []
+    while any(pending.values()):
+        at, num = heapq.heappop(free)
+        for cls in _PREFERENCE[lanes[num]]:
+            if pending[cls]:
+                size, index, item = pending[cls].pop()
+                break
+        started.append((at, num, index, item))
+        heapq.heappush(free, (at + size + task_cost, num))
+
+    started.sort(key=lambda entry: entry[:3])
+    return [entry[3] for entry in started]
@@ -1,12 +1,22 @@
 import datetime
 import os
+import threading
 import time
 
-import boto.s3.key
-
 import davo.utils
 
-from . import cache, conf, utils
+from . import (
+    cache,
+    conf,
+    connections,
+    download,
+    metrics,
+    multipart,
+    rename,
+    throttle,
+    utils,
+    workers,
+)
 
 
 class _Task:
@@ -19,6 +29,8 @@ class _Task:
         self.worker = None
         self.show_estimate = False
         self._t = None
+        self._sent = 0
+        self._sent_lock = threading.Lock()
 
     def handler(self):
         raise NotImplementedError()
@@ -36,7 +48,11 @@ class _Task:
 
         size = self.size()
         if size:
-            self.worker.speed_list.append(size / (time.time() - self._t))
+            self.worker.add_speed(size / (time.time() - self._t))
+            self._account(size)
+        self.worker.record(tasks=1)
+        metrics.metrics.inc("tasks_total", label=str(self))
+        metrics.metrics.inc("bytes_total", size, str(self))
 
         self.output_finish()
         self.worker.cb_queue.put((self.name, 100, size))
@@ -45,6 +61,9 @@ class _Task:
         return 0
 
     def progress(self, uploaded, full):
+        if self.worker and self.worker.cancelled.is_set():
+            raise workers.Cancelled()
+
         len_full = 40
         progress = round(float(uploaded) / full, 2) * 100
         progress_len = int(progress) * len_full // 100
@@ -52,6 +71,7 @@ class _Task:
         size = self.size()
         if size:
             uploaded = size * float(uploaded) / full
+            self._account(uploaded)
             speed_value = self.worker.speed(uploaded / (time.time() - self._t))
             speed_human = davo.utils.format.humanize_speed(speed_value)
         else:
@@ -77,6 +97,22 @@ class _Task:
         )
         self.output_edit(line)
 
+    def _account(self, sent):
+        """
+        Pass bytes sent since last call through bandwidth limiter (pauses
+        transfer thread when over the cap) and concurrency controller.
+
+        :param float sent: bytes sent by task so far
+        """
+        with self._sent_lock:
+            delta = int(sent) - self._sent
+            if delta <= 0:
+                return
+            self._sent = int(sent)
+
+        throttle.consume(delta, cancelled=self.worker.cancelled)
+        self.worker.record(size=delta)
+
     def output_edit(self, line):
         if self.worker:
             self.worker.output[self.worker.index] = line
@@ -84,7 +120,9 @@ class _Task:
             print(line)
 
     def output_finish(self):
-        line = "{} {}".format(self.done, self.name)
+        self.report("{} {}".format(self.done, self.name))
+
+    def report(self, line):
         if not self.worker:
             print(line)
             return
@@ -92,36 +130,50 @@ class _Task:
         utils.output_finish(self.worker.output, line)
 
 
+def _utcnow():
+    return datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
 def _upload(key, callback, local_path, cb_num, replace=False):
+    """
+    Upload file, multipart when large. Unless `replace`, key written since
+    diff (e.g. by concurrent writer) is kept and upload skipped.
+
+    :return: uploaded
+    :rtype: bool
+    """
     local_file_path = utils.file_path(local_path)
+    size = os.stat(local_file_path).st_size
 
-    with open(local_file_path, "rb") as local_file:
-        key.set_contents_from_file(
-            local_file,
-            replace=replace,
-            cb=callback,
-            num_cb=cb_num,
-            rewind=True,
-        )
+    if not replace and key.bucket.lookup(key.name):
+        return False
 
-    if replace:
-        stat = os.stat(local_file_path)
-        size = stat.st_size
+    if size >= conf.get("MULTIPART_THRESHOLD"):
+        etag = multipart.upload(
+            key.bucket, key.name, local_file_path, callback=callback
+        )
     else:
-        size = key.size
-
-    cache.cache.update(
+        with open(local_file_path, "rb") as local_file:
+            # existence is checked above for both upload kinds
+            key.set_contents_from_file(
+                local_file,
+                replace=True,
+                cb=callback,
+                num_cb=cb_num,
+                rewind=True,
+            )
+        etag = key.etag
+
+    cache.cache.write_update(
         key.name,
         {
             "name": key.name,
             "size": size,
-            "last_modified": datetime.datetime.utcnow().strftime(
-                "%Y-%m-%dT%H:%M:%S.000Z"
-            ),
-            "etag": key.etag,
+            "last_modified": _utcnow(),
+            "etag": etag,
         },
     )
-    cache.cache.flush()
+    return True
 
 
 class Upload(_Task):
@@ -134,13 +186,15 @@ class Upload(_Task):
         return self.data.get("local_size") or 0
 
     def handler(self):
-        _upload(
-            boto.s3.key.Key(bucket=self.bucket, name=self.name),
+        if _upload(
+            connections.make_key(self.bucket, self.name),
             self.progress,
             self.data["local_path"],
             conf.get("UPLOAD_CB_NUM"),
-        )
-        self.data["comment"] = ["uploaded"]
+        ):
+            self.data["comment"] = ["uploaded"]
+        else:
+            self.data["comment"] = ["exists on s3, skipped"]
 
 
 class ReplaceUpload(_Task):
@@ -154,7 +208,7 @@ class ReplaceUpload(_Task):
 
     def handler(self):
         _upload(
-            self.data["key"],
+            connections.thread_key(self.data["key"]),
             self.progress,
             self.data["local_path"],
             conf.get("UPLOAD_CB_NUM"),
@@ -170,10 +224,53 @@ class DeleteRemote(_Task):
         return "delete_remote"
 
     def handler(self):
-        self.data["key"].delete()
+        connections.thread_key(self.data["key"]).delete()
         self.data["comment"] = ["deleted from s3"]
 
 
+class DeleteRemoteBatch(_Task):
+    """
+    Delete keys with one multi-object delete request.
+
+    Data is a list of diff entries. Keys failed on S3 are reported and
+    kept in cache, the rest are removed from cache in one transaction.
+    """
+
+    done = "deleted (remote)"
+
+    def __str__(self):
+        return "delete_remote_batch"
+
+    def handler(self):
+        self.progress(0, 1)
+        names = [data["key"].name for data in self.data]
+        result = connections.thread_bucket(self.bucket).delete_keys(
+            names, quiet=True
+        )
+        errors = {error.key: error for error in result.errors}
+        cache.cache.delete_many(name for name in names if name not in errors)
+
+        for data in self.data:
+            error = errors.get(data["key"].name)
+            if error is None:
+                data["comment"] = ["deleted from s3"]
+                continue
+            data["comment"] = [
+                "delete failed: {} {}".format(error.code, error.message)
+            ]
+            self.report(
+                "delete failed {}: {} {}".format(
+                    error.key, error.code, error.message
+                )
+            )
+
+        if errors:
+            self.done = "deleted (remote) {}/{}".format(
+                len(names) - len(errors), len(names)
+            )
+        self.progress(1, 1)
+
+
 class RenameRemote(_Task):
     done = "renamed (remote)"
 
@@ -181,22 +278,89 @@ class RenameRemote(_Task):
         return "rename_remote"
 
     def handler(self):
-        new_key = self.data["key"].copy(
+        key = connections.thread_key(self.data["key"])
+        new_key = key.copy(
             conf.get("BUCKET"),
             self.data["local_name"],
             metadata=None,
             preserve_acl=True,
             encrypt_key=False,
-            validate_dst_bucket=True,
+            validate_dst_bucket=False,
         )
 
         if new_key:
-            self.data["key"].delete()
+            key.delete()
             self.data["comment"] = ["renamed"]
         else:
             raise Exception("s3 key copy failed")
 
 
+class RenameRemoteBatch(_Task):
+    """
+    Rename keys of one directory move: server-side copies, then sources are
+    deleted with one multi-object delete request.
+
+    Data is a list of diff entries. Failed keys are reported and kept,
+    cache rows of the rest are rewritten in one transaction.
+    """
+
+    done = "renamed (remote)"
+
+    def __str__(self):
+        return "rename_remote_batch"
+
+    def handler(self):
+        self.progress(0, 1)
+        entries = [
+            (data["key"].name, data["local_name"], data.get("size") or 0)
+            for data in self.data
+        ]
+        etags, errors = rename.copy_keys(
+            connections.thread_bucket(self.bucket),
+            entries,
+            callback=self.progress,
+        )
+
+        copied = [name for name, _dest, _size in entries if name in etags]
+        if copied:
+            result = connections.thread_bucket(self.bucket).delete_keys(
+                copied, quiet=True
+            )
+            for error in result.errors:
+                errors[error.key] = "{} {}".format(error.code, error.message)
+
+        modified = _utcnow()
+        cache.cache.rewrite(
+            deleted=(name for name in copied if name not in errors),
+            updated=(
+                {
+                    "name": dest,
+                    "size": size,
+                    "last_modified": modified,
+                    "etag": etags[name],
+                }
+                for name, dest, size in entries
+                if name in etags
+            ),
+        )
+
+        for data in self.data:
+            error = errors.get(data["key"].name)
+            if error is None:
+                data["comment"] = ["renamed"]
+                continue
+            data["comment"] = ["rename failed: {}".format(error)]
+            self.report(
+                "rename failed {}: {}".format(data["key"].name, error)
+            )
+
+        if errors:
+            self.done = "renamed (remote) {}/{}".format(
+                len(entries) - len(errors), len(entries)
+            )
+        self.progress(1, 1)
+
+
 class RenameLocal(_Task):
     done = "renamed (local)"
 
@@ -229,7 +393,11 @@ class Download(_Task):
     def handler(self):
         file_path = self.data["local_path"]
         davo.utils.path.ensure(file_path, commit=True)
-        self.data["key"].get_contents_to_filename(
+        if self.size() >= conf.get("MULTIPART_THRESHOLD"):
+            download.download(self.data["key"], file_path, self.progress)
+            return
+
+        connections.thread_key(self.data["key"]).get_contents_to_filename(
             file_path,
             cb=self.progress,
             num_cb=20,
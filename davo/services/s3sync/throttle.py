@@ -0,0 +1,146 @@
+import datetime
+import threading
+import time
+
+import davo.utils
+
+from . import conf, metrics
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket limiting bytes per second.
+
+    Transfers report bytes after sending them, so bucket goes into debt
+    and the caller sleeps until debt is paid: sending thread is paused
+    before its next chunk. Burst (one second of rate by default) caps
+    tokens saved while idle.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: bytes per second, or callable returning it (0 is
+            unlimited), so rate can change on the fly
+        :param float burst: seconds of rate kept while idle
+        """
+        self._rate = rate if callable(rate) else lambda: rate
+        self.burst = 1.0 if burst is None else burst
+        self.tokens = 0.0
+        self._t = time.monotonic()
+        self._lock = threading.Lock()
+
+    def rate(self):
+        return self._rate() or 0
+
+    def consume(self, amount, cancelled=None):
+        """
+        Take amount of tokens, sleep while bucket is in debt.
+
+        :param int amount: bytes
+        :param threading.Event cancelled: stop waiting when set
+
+        :return: seconds slept
+        :rtype: float
+        """
+        rate = self.rate()
+        with self._lock:
+            now = time.monotonic()
+            if not rate:
+                self.tokens = 0.0
+                self._t = now
+                return 0.0
+            self.tokens = min(
+                self.tokens + (now - self._t) * rate, rate * self.burst
+            )
+            self._t = now
+            self.tokens -= amount
+            delay = -self.tokens / rate if self.tokens < 0 else 0.0
+
+        if delay:
+            if cancelled is None:
+                time.sleep(delay)
+            else:
+                cancelled.wait(delay)
+        return delay
+
+
+def parse_rate(value):
+    """
+    :param value: bytes per second as number or string with K/M/G/T
+        suffix (`512K`, `2.5M`)
+
+    :rtype: int
+    """
+    if not value:
+        return 0
+    if isinstance(value, (int, float)):
+        return int(value)
+    value = str(value).strip().upper()
+    level = davo.utils.format.LEVELS_SIZE.get(value[-1:])
+    if level is not None and value[-1:] != " ":
+        return int(float(value[:-1]) * level)
+    return int(float(value))
+
+
+def rate_for(limit, schedule, now=None):
+    """
+    Bandwidth cap for time of day.
+
+    :param limit: default cap (see `parse_rate`)
+    :param dict schedule: `HH:MM-HH:MM`: cap, windows may wrap midnight,
+        first matching window wins
+    :param datetime.time now:
+
+    :rtype: int
+    """
+    if now is None:
+        now = datetime.datetime.now().time()
+    for window, window_limit in (schedule or {}).items():
+        start, end = (
+            datetime.time.fromisoformat(part.strip())
+            for part in window.split("-")
+        )
+        if start <= end:
+            matched = start <= now < end
+        else:
+            matched = now >= start or now < end
+        if matched:
+            return parse_rate(window_limit)
+    return parse_rate(limit)
+
+
+def current_rate():
+    return rate_for(
+        conf.get("BANDWIDTH_LIMIT"), conf.get("BANDWIDTH_SCHEDULE")
+    )
+
+
+def get_limiter():
+    """
+    Bandwidth limiter shared by all transfers, upload and download, capped
+    by BANDWIDTH_LIMIT and BANDWIDTH_SCHEDULE.
+
+    :rtype: TokenBucket
+    """
+    global _limiter  # pylint: disable=global-statement
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = TokenBucket(current_rate)
+        return _limiter
+
+
+def consume(amount, cancelled=None):
+    """
+    Account transferred bytes in shared limiter.
+
+    :param int amount:
+    :param threading.Event cancelled:
+    """
+    if amount <= 0:
+        return
+    delay = get_limiter().consume(amount, cancelled=cancelled)
+    if delay:
+        metrics.metrics.inc("throttled_seconds", delay)
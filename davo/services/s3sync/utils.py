@@ -1,18 +1,22 @@
 import argparse
+import concurrent.futures
 import dataclasses
 import logging
 import os
+import queue
 import re
+import threading
 
 import boto.s3
 import boto.s3.bucket
 import boto.s3.connection
 import boto.s3.key
+import boto.s3.prefix
 
 import davo.errors
 from davo import settings, utils
 
-from . import cache, conf
+from . import cache, conf, connections, metrics, multipart
 
 logger = logging.getLogger(__name__)
 
@@ -68,6 +72,8 @@ def iter_local_path(path, recursive=False, exclude=(), depth=None):
         recursive=recursive,
         exclude=exclude,
         depth=depth,
+        sort=True,
+        threads=conf.get("WALK_THREADS"),
     )
 
 
@@ -79,13 +85,7 @@ def iter_remote_path(
     cached=False,
     depth=None,
 ):
-    local_path, key = file_path_info(
-        path,
-        project_root=conf.get("PROJECT_ROOT"),
-        current_root=current_root,
-    )
-    if key and os.path.isdir(local_path) and key[-1] != "/":
-        key += "/"
+    key = remote_prefix(path, current_root=current_root)
 
     params = {}
     if depth is not None:
@@ -102,6 +102,25 @@ def iter_remote_path(
     return _iter_remote(bucket, **params)
 
 
+def remote_prefix(path, current_root=None):
+    """
+    Get remote key prefix for local path, dirs end with slash.
+
+    :param str path:
+    :param str current_root:
+
+    :rtype: str
+    """
+    local_path, key = file_path_info(
+        path,
+        project_root=conf.get("PROJECT_ROOT"),
+        current_root=current_root,
+    )
+    if key and os.path.isdir(local_path) and key[-1] != "/":
+        key += "/"
+    return key.replace("\\", "/")
+
+
 @dataclasses.dataclass
 class S3KeyCached:
     bucket: boto.s3.bucket.Bucket
@@ -111,17 +130,22 @@ class S3KeyCached:
     etag: str
 
     def _key(self):
-        return self.bucket.get_key(self.name)
+        return connections.make_key(
+            self.bucket,
+            self.name,
+            size=self.size,
+            etag=self.etag,
+            last_modified=self.last_modified,
+        )
 
     def delete(self):
         self._key().delete()
-        cache.cache.delete(self.name)
-        cache.cache.flush()
+        cache.cache.write_delete(self.name)
 
     def copy(self, bucket, local_name, **kwargs):
         new_key = self._key().copy(bucket, local_name, **kwargs)
         if new_key:
-            cache.cache.update(
+            cache.cache.write_update(
                 local_name,
                 {
                     "name": local_name,
@@ -130,14 +154,16 @@ class S3KeyCached:
                     "etag": self.etag,
                 },
             )
-            cache.cache.flush()
         return new_key
 
     def get_contents_to_filename(self, *args, **kwargs):
         return self._key().get_contents_to_filename(*args, **kwargs)
 
     def set_contents_from_file(self, *args, **kwargs):
-        return self._key().set_contents_from_file(*args, **kwargs)
+        key = self._key()
+        result = key.set_contents_from_file(*args, **kwargs)
+        self.etag = key.etag
+        return result
 
     def url(self, ttl=3600):
         return self._key().generate_url(expires_in=ttl)
@@ -159,37 +185,271 @@ def _iter_remote(bucket, depth=None, **params):
         yield key
 
 
-def update_cache(bucket, reprint=None):
-    if cache.cache.total():
+def iter_remote_sharded(
+    bucket, prefix="", threads=None, output=None, batch_size=1000
+):
+    """
+    List keys under prefix concurrently, one listing per sub prefix.
+
+    Shards are discovered by delimiter listings (up to two levels deep,
+    until there is a shard per thread). Keys are yielded in shard batches,
+    order between shards is not preserved.
+
+    :param boto.s3.bucket.Bucket bucket:
+    :param str prefix:
+    :param int threads: number of concurrent listings
+    :param list output: reprint output for per-shard progress
+    :param int batch_size: keys per hand-over from listing threads
+
+    :rtype: Iterator[boto.s3.key.Key]
+    """
+    if threads is None:
+        threads = conf.get("THREAD_MAX_COUNT")
+
+    shards, keys = _discover_shards(bucket, prefix, threads)
+    yield from keys
+    if not shards:
+        return
+
+    results = queue.Queue(maxsize=threads * 4)
+    stop = threading.Event()
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _list(shard):
+        batch = []
+        try:
+            for key in _iter_remote(bucket, prefix=shard):
+                if stop.is_set():
+                    return
+                batch.append(key)
+                if len(batch) >= batch_size:
+                    _put((shard, batch, None))
+                    batch = []
+            if batch:
+                _put((shard, batch, None))
+        except Exception as exc:  # pylint: disable=broad-except
+            _put((shard, None, exc))
+        finally:
+            _put((shard, None, None))
+
+    progress = {}
+    slots = min(len(output) - 1, threads) if output else 0
+
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        try:
+            for shard in shards:
+                executor.submit(_list, shard)
+
+            pending = len(shards)
+            while pending:
+                shard, batch, error = results.get()
+                if error is not None:
+                    raise error
+
+                if batch is None:
+                    pending -= 1
+                    count = progress.pop(shard, 0)
+                    if output:
+                        output_finish(
+                            output, "listed {} ({})".format(shard, count)
+                        )
+                else:
+                    progress[shard] = progress.get(shard, 0) + len(batch)
+                    yield from batch
+
+                for index, (name, count) in enumerate(
+                    list(progress.items())[:slots], start=1
+                ):
+                    output[index] = "listing {} ({})".format(name, count)
+        finally:
+            stop.set()
+
+
+def _discover_shards(bucket, prefix, min_shards, max_depth=2):
+    keys = []
+    shards = [prefix]
+    for _level in range(max_depth):
+        sub_shards = []
+        for shard in shards:
+            for item in bucket.list(prefix=shard, delimiter="/"):
+                if isinstance(item, boto.s3.prefix.Prefix):
+                    sub_shards.append(item.name)
+                elif (
+                    isinstance(item, boto.s3.key.Key) and item.name[-1] != "/"
+                ):
+                    keys.append(item)
+        shards = sub_shards
+        if len(shards) >= min_shards:
+            break
+    return shards, keys
+
+
+def _iter_remote_listing(bucket, prefix="", output=None):
+    if conf.get("THREAD_MAX_COUNT") > 1:
+        return iter_remote_sharded(bucket, prefix=prefix, output=output)
+
+    params = {"prefix": prefix} if prefix else {}
+    return _iter_remote(bucket, **params)
+
+
+def update_cache(bucket, reprint=None, fast=False):
+    """
+    Reload remote keys listing into cache.
+
+    :param boto.s3.bucket.Bucket bucket:
+    :param list reprint: reprint output
+    :param bool fast: load via staging table with relaxed durability
+    """
+    if cache.cache.total() and not fast:
         cache.cache.clear()
 
     if reprint:
         reprint[0] = "connecting..."
 
-    it = iter_remote_path(
-        bucket, path="", current_root="", recursive=True, cached=False
-    )
-    for index, s3key in enumerate(it):
-        if reprint and index % 100 == 0:
-            reprint[0] = "loading... ({})".format(index)
-        cache.cache.update(
-            s3key.name,
-            {
-                "name": s3key.name,
-                "size": s3key.size,
-                "last_modified": s3key.last_modified,
-                "etag": s3key.etag,
-            },
+    it = _iter_remote_listing(bucket, output=reprint)
+    with metrics.metrics.phase("remote_listing"):
+        listed = cache.cache.bulk_update(
+            _iter_cache_records(it, reprint), fast=fast
         )
+    metrics.metrics.inc("keys_total", listed, "listed")
+    cache.cache.mark_refreshed()
+
+    if reprint:
+        reprint[0] = "saved successfully"
+
+
+def refresh_cache(bucket, prefix, reprint=None):
+    """
+    Relist keys under prefix and reconcile them with cache.
+
+    :param boto.s3.bucket.Bucket bucket:
+    :param str prefix: key prefix, empty for whole bucket
+    :param list reprint: reprint output
 
+    :return: number of listed and deleted keys
+    :rtype: tuple
+    """
     if reprint:
-        reprint[0] = "saving..."
+        reprint[0] = "connecting..."
 
-    cache.cache.flush()
+    it = _iter_remote_listing(bucket, prefix=prefix, output=reprint)
+    with metrics.metrics.phase("remote_listing"):
+        listed, deleted = cache.cache.refresh_prefix(
+            prefix, _iter_cache_records(it, reprint)
+        )
+    metrics.metrics.inc("keys_total", listed, "listed")
 
     if reprint:
         reprint[0] = "saved successfully"
 
+    return listed, deleted
+
+
+def _iter_cache_records(keys, reprint=None):
+    for index, s3key in enumerate(keys):
+        if reprint and index % 100 == 0:
+            reprint[0] = "loading... ({})".format(index)
+        yield {
+            "name": s3key.name,
+            "size": s3key.size,
+            "last_modified": s3key.last_modified,
+            "etag": s3key.etag,
+        }
+
+
+def local_hashes(path, stat=None):
+    """
+    Get local file md5 and multipart etag, reusing cached ones.
+
+    Hashes are recomputed only when file size, mtime or inode changed.
+    Updates are saved to cache (when inited) on next `flush`.
+
+    :param str path:
+    :param os.stat_result stat:
+
+    :return: md5 hex, unquoted multipart etag
+    :rtype: tuple
+    """
+    if stat is None:
+        stat = os.stat(path)
+    part_size = multipart.part_size_for(stat.st_size)
+
+    hashes = cached_hashes(path, stat, part_size)
+    if hashes is None:
+        hashes = multipart.file_hashes(path, stat.st_size, part_size)
+        save_hashes(path, stat, part_size, hashes)
+    return hashes
+
+
+def cached_hashes(path, stat, part_size):
+    """
+    Get cached hashes of local file, if file wasn't changed since.
+
+    :param str path:
+    :param os.stat_result stat:
+    :param int part_size: part size of multipart etag
+
+    :return: md5 hex, unquoted multipart etag or None
+    :rtype: tuple
+    """
+    if cache.cache.conn is None:
+        return None
+
+    saved = cache.cache.local_get(path)
+    if (
+        saved
+        and saved["size"] == stat.st_size
+        and saved["mtime_ns"] == stat.st_mtime_ns
+        and saved["inode"] == stat.st_ino
+        and saved["part_size"] == part_size
+    ):
+        return saved["md5"], saved["etag"]
+    return None
+
+
+def save_hashes(path, stat, part_size, hashes):
+    """
+    Save hashes of local file to cache (when inited).
+    """
+    if cache.cache.conn is None:
+        return
+
+    md5, etag = hashes
+    cache.cache.local_update(
+        {
+            "path": path,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "inode": stat.st_ino,
+            "part_size": part_size,
+            "md5": md5,
+            "etag": etag,
+        }
+    )
+
+
+def etag_matches(hashes, etag):
+    """
+    Compare local hashes with remote etag (plain md5 or multipart).
+
+    :param tuple hashes: md5 hex, multipart etag (see `local_hashes`)
+    :param str etag: quoted or unquoted
+
+    :rtype: bool
+    """
+    md5, multipart_etag = hashes
+    etag = (etag or "").strip('"')
+    if "-" in etag:
+        return etag == multipart_etag
+    return etag == md5
+
 
 def check_file_type(filename, types):
     if not types:
@@ -282,7 +542,7 @@ def connect_host(region=boto.s3.connection.NoHostProvided):
 
     :rtype: boto.s3.connection.S3Connection
     """
-    return boto.s3.connection.S3Connection(
+    return connections.Connection(
         conf.get("ACCESS_KEY"),
         conf.get("SECRET_KEY"),
         host=region,
@@ -341,8 +601,17 @@ def _connect_bucket(name, region_host):
     return connect_host_bucket(region_host, name)
 
 
+def output_len():
+    """
+    Reprint output lines before finished ones: status + line per thread.
+
+    :rtype: int
+    """
+    return conf.get("THREAD_MAX_COUNT") + 1
+
+
 def output_finish(output, string):
-    prefix = conf.get("THREAD_MAX_COUNT")
+    prefix = output_len()
     total = prefix + conf.get("ENDED_OUTPUT_MAX_COUNT")
     if len(output) >= total:
         output[prefix:total] = output[prefix + 1 : total] + [string]
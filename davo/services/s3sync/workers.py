@@ -1,81 +1,315 @@
+import concurrent.futures
 import datetime
+import http.client
+import logging
 import queue
+import socket
+import ssl
 import threading
 import time
 
+import boto.exception
+
 import davo.utils
 
-from . import conf, utils
+from . import conf, metrics, utils
+
+logger = logging.getLogger(__name__)
+
+_TRANSIENT_CODES = {"RequestTimeout", "SlowDown", "Throttling"}
+_TRANSIENT_ERRORS = (
+    ConnectionError,
+    TimeoutError,
+    socket.timeout,
+    ssl.SSLError,
+    http.client.HTTPException,
+)
+
+
+class Cancelled(Exception):
+    """
+    Task aborted by executor cancellation.
+    """
+
+
+def is_transient(exc):
+    """
+    Check error is worth retrying: network failures, S3 throttling and 5xx.
+
+    :param Exception exc:
+
+    :rtype: bool
+    """
+    if isinstance(exc, boto.exception.BotoServerError):
+        return (exc.status or 0) >= 500 or exc.error_code in _TRANSIENT_CODES
+    return isinstance(exc, _TRANSIENT_ERRORS)
+
+
+class _Controller:
+    """
+    Adaptive limit of active workers.
+
+    Each `interval` goodput of the last window (transferred bytes, plus
+    `task_cost` bytes per finished task, so request bound phases count
+    too) is compared with the previous one: the limit grows by one while
+    goodput improves, growth which didn't improve it is undone, on
+    plateau next step is probed, and transient errors (throttling,
+    timeouts) halve the limit. Workers with
+    index above the limit wait before taking next task.
+    """
+
+    def __init__(self, low, high, interval=None, task_cost=None):
+        self.low = max(min(low, high), 1)
+        self.high = high
+        self.limit = max(self.low, (high + 1) // 2)
+        if interval is None:
+            interval = conf.get("THREAD_ADAPTIVE_INTERVAL")
+        self.interval = interval
+        if task_cost is None:
+            task_cost = conf.get("TASK_COST")
+        self.task_cost = task_cost
+
+        self._cond = threading.Condition()
+        self._released = False
+        self._t = time.monotonic()
+        self._score = 0
+        self._errors = 0
+        self._previous = None
+        self._step = 0
+        metrics.metrics.set("concurrency_limit", self.limit)
+
+    def admit(self, index, cancelled):
+        """
+        Block worker while its index is above the limit.
+
+        :param int index: worker index, from 1
+        :param threading.Event cancelled:
+        """
+        with self._cond:
+            while (
+                index > self.limit
+                and not self._released
+                and not cancelled.is_set()
+            ):
+                self._cond.wait(self.interval)
+                self._tick()
+
+    def release(self):
+        """
+        Admit all workers (to take stop sentinels).
+        """
+        with self._cond:
+            self._released = True
+            self._cond.notify_all()
+
+    def record(self, size=0, tasks=0, errors=0):
+        """
+        :param int size: transferred bytes
+        :param int tasks: finished tasks
+        :param int errors: transient errors
+        """
+        with self._cond:
+            self._score += size + tasks * self.task_cost
+            self._errors += errors
+            self._tick()
+
+    def _tick(self):
+        now = time.monotonic()
+        elapsed = now - self._t
+        if elapsed < self.interval:
+            return
+
+        goodput = self._score / elapsed
+        limit = self.limit
+        if self._errors:
+            limit = max(self.low, limit // 2)
+        elif self._previous is None:
+            pass
+        elif goodput > self._previous * 1.05:
+            limit = min(self.high, limit + 1)
+        elif self._step > 0:
+            # growth didn't pay off
+            limit = max(self.low, limit - 1)
+        elif goodput >= self._previous * 0.95:
+            # plateau: probe for spare capacity
+            limit = min(self.high, limit + 1)
+
+        self._previous = None if self._errors else goodput
+        self._step = limit - self.limit
+        self._t = now
+        self._score = 0
+        self._errors = 0
+
+        if limit != self.limit:
+            self.limit = limit
+            metrics.metrics.set("concurrency_limit", limit)
+            self._cond.notify_all()
 
 
 class _Worker(threading.Thread):
     """
-    Thread executing tasks from a given tasks queue.
+    Thread executing tasks from a given tasks queue until stop sentinel.
     """
 
-    def __init__(self, index, task_queue, cb_queue, output=None):
+    def __init__(
+        self,
+        index,
+        task_queue,
+        cb_queue,
+        cancelled,
+        output=None,
+        retries=0,
+        backoff=0,
+        controller=None,
+    ):
         super().__init__()
         self.index = index
         self.task_queue = task_queue
         self.cb_queue = cb_queue
+        self.cancelled = cancelled
         self.daemon = True
-        self.speed_list = []
+        self.speed_sum = 0
+        self.speed_count = 0
         self.output = output
+        self.retries = retries
+        self.backoff = backoff
+        self.busy = 0.0
+        self.controller = controller
 
     def run(self):
-        while self.task_queue.unfinished_tasks:
+        while True:
+            if self.controller is not None:
+                self.controller.admit(self.index, self.cancelled)
+            item = self.task_queue.get()
             try:
-                task = self.task_queue.get(timeout=10)
-            except queue.Empty:
-                break
+                if item is None:
+                    break
+
+                future, task = item
+                if not future.set_running_or_notify_cancel():
+                    continue
+
+                started = time.perf_counter()
+                try:
+                    self._exec(task)
+                except BaseException as exc:  # pylint: disable=broad-except
+                    future.set_exception(exc)
+                    if not isinstance(exc, Cancelled):
+                        metrics.metrics.inc("errors_total", label=str(task))
+                        self.report(
+                            "Unhandled error {}: {}".format(
+                                type(exc).__name__, exc
+                            )
+                        )
+                else:
+                    future.set_result(task)
+                finally:
+                    self.busy += time.perf_counter() - started
 
+            finally:
+                self.task_queue.task_done()
+
+    def _exec(self, task):
+        attempt = 0
+        while True:
+            if self.cancelled.is_set():
+                raise Cancelled()
             try:
                 task.exec(worker=self)
-                if self.cb_queue:
-                    self.cb_queue.put((task.name, 100, task.size()))
+                return
             except Exception as exc:
-                utils.output_finish(
-                    self.output,
-                    "Unhandled error {}: {}".format(type(exc).__name__, exc),
+                if attempt >= self.retries or not is_transient(exc):
+                    raise
+
+                delay = self.backoff * 2**attempt
+                attempt += 1
+                metrics.metrics.inc("retries_total")
+                self.record(errors=1)
+                self.report(
+                    "retry {}/{} in {:.1f}s {}: {}".format(
+                        attempt, self.retries, delay, task.name, exc
+                    )
                 )
+                if self.cancelled.wait(delay):
+                    raise Cancelled()
 
-            finally:
-                self.task_queue.task_done()
+    def report(self, line):
+        if self.output is None:
+            logger.info(line)
+        else:
+            utils.output_finish(self.output, line)
+
+    def record(self, size=0, tasks=0, errors=0):
+        """
+        Report transfer progress to concurrency controller.
+        """
+        if self.controller is not None:
+            self.controller.record(size=size, tasks=tasks, errors=errors)
+
+    def add_speed(self, value):
+        self.speed_sum += value
+        self.speed_count += 1
 
     def speed(self, current):
-        if not self.speed_list:
-            return current
-        return (sum(self.speed_list) + current) / float(
-            len(self.speed_list) + 1
-        )
+        return (self.speed_sum + current) / float(self.speed_count + 1)
 
 
 class _System(threading.Thread):
     """
     System thread. Collect result from workers and draw output.
+
+    Totals are kept as running sums updated by per-task deltas, output is
+    redrawn at most once per `interval` seconds. Estimate extrapolates
+    cost done so far: bytes plus `task_cost` per finished task, so many
+    small files don't look faster than they are.
     """
 
-    def __init__(self, index, cb_queue, output, tasks_total, size_total):
+    def __init__(
+        self,
+        index,
+        cb_queue,
+        output,
+        tasks_total,
+        size_total,
+        interval=None,
+        task_cost=None,
+    ):
         super().__init__()
         self.daemon = True
 
         self.index = index
         self.cb_queue = cb_queue
         self.output = output
+        if interval is None:
+            interval = conf.get("PROGRESS_INTERVAL")
+        self.interval = interval
+        if task_cost is None:
+            task_cost = conf.get("TASK_COST")
+        self.task_cost = task_cost
 
         self.tasks_total = tasks_total
         self.size_total = size_total
         self.tasks_processed = 0
-        self.tasks_processed_d = {}
+        # name: (progress, size) of tasks in progress
+        self.tasks_active = {}
+        self.progress = 0
         self.size = 0
 
         self._t = time.time()
+        self._drawn = 0
 
     def run(self):
         while True:
             data = self.cb_queue.get()
             try:
+                if data is None:
+                    self.draw()
+                    utils.output_finish(self.output, self.summary())
+                    break
                 self.handler_cb(*data)
+                if time.time() - self._drawn >= self.interval:
+                    self._drawn = time.time()
+                    self.draw()
             except Exception as exc:
                 utils.output_finish(
                     self.output,
@@ -85,40 +319,36 @@ class _System(threading.Thread):
                 self.cb_queue.task_done()
 
     def handler_cb(self, name, progress, size):
-        if (
-            progress == 100
-            and self.tasks_processed_d.get(name, {}).get("progress") != 100
-        ):
-            self.tasks_processed += 1
+        progress_prev, size_prev = self.tasks_active.pop(name, (0, 0))
+        self.progress += progress - progress_prev
+        self.size += size - size_prev
 
-        self.tasks_processed_d[name] = {
-            "progress": progress,
-            "size": size,
-        }
+        if progress == 100:
+            self.tasks_processed += 1
+        else:
+            self.tasks_active[name] = (progress, size)
 
-        progress = sum(
-            item["progress"] for item in self.tasks_processed_d.values()
-        )
-        progress = float(progress) / self.tasks_total
-        size_all = sum(
-            item["size"] for item in self.tasks_processed_d.values()
-        )
+    def draw(self):
+        if self.tasks_total:
+            progress = float(self.progress) / self.tasks_total
+        else:
+            progress = 0
 
         len_full = 40
         progress_len = int(progress) * len_full // 100
 
         delta = time.time() - self._t
         if delta:
-            speed = davo.utils.format.humanize_speed(size_all / delta)
+            speed = davo.utils.format.humanize_speed(self.size / delta)
         else:
             speed = "n\\a"
 
-        if size_all:
+        cost = self.size + self.tasks_processed * self.task_cost
+        if cost:
+            cost_total = self.size_total + self.tasks_total * self.task_cost
             estimate = "Est: {}".format(
                 datetime.timedelta(
-                    seconds=int(
-                        delta * (self.size_total - size_all) / size_all
-                    )
+                    seconds=int(delta * max(cost_total - cost, 0) / cost)
                 ),
             )
         else:
@@ -136,49 +366,166 @@ class _System(threading.Thread):
             info="{}/{}".format(self.tasks_processed, self.tasks_total),
         )
 
+    def summary(self):
+        delta = time.time() - self._t
+        return "done {}/{} tasks, {} in {}, average {}".format(
+            self.tasks_processed,
+            self.tasks_total,
+            davo.utils.format.humanize_bytes(self.size).strip(),
+            datetime.timedelta(seconds=int(delta)),
+            davo.utils.format.humanize_speed(
+                self.size / delta if delta else 0
+            ).strip(),
+        )
 
-class ThreadPool:
-    def __init__(self, num_threads, auto_start=False):
-        self.num_threads = num_threads
-        self.cb_queue = queue.Queue()
-        self.task_queue = queue.Queue()
-        self.sys = None
-        self.total_tasks = 0
-        self.total_size = 0
 
-        if auto_start:
-            self.start()
+class Executor:
+    """
+    Thread pool with bounded task queue.
+
+    `submit` blocks while the queue is full, so tasks can be produced
+    lazily. With `adaptive` count of active threads is tuned between
+    THREAD_MIN_COUNT and `num_threads` by measured goodput (see
+    `_Controller`). Transient S3 errors are retried with exponential backoff.
+    On error (Ctrl-C included) inside `with` block queued tasks are
+    cancelled and running transfers abort on next progress callback.
+    """
 
-    def start(self, output=None):
-        if self.num_threads > 1:
-            self.sys = _System(
-                index=0,
-                cb_queue=self.cb_queue,
-                output=output,
-                tasks_total=self.total_tasks,
-                size_total=self.total_size,
+    def __init__(
+        self,
+        num_threads,
+        output=None,
+        tasks_total=0,
+        size_total=0,
+        queue_size=None,
+        retries=None,
+        backoff=None,
+        adaptive=None,
+    ):
+        self.num_threads = max(num_threads, 1)
+        self.output = output
+        self.tasks_total = tasks_total
+        self.size_total = size_total
+        if queue_size is None:
+            queue_size = conf.get("TASK_QUEUE_SIZE") or self.num_threads * 2
+        if retries is None:
+            retries = conf.get("TASK_RETRIES")
+        if backoff is None:
+            backoff = conf.get("TASK_RETRY_BACKOFF")
+        if adaptive is None:
+            adaptive = conf.get("THREAD_ADAPTIVE")
+
+        self.cb_queue = queue.Queue()
+        self.task_queue = queue.Queue(maxsize=queue_size)
+        self.cancelled = threading.Event()
+        self.retries = retries
+        self.backoff = backoff
+        self.sys = None
+        self.workers = []
+        self._started = None
+        self.controller = None
+        if adaptive and self.num_threads > 1:
+            self.controller = _Controller(
+                conf.get("THREAD_MIN_COUNT"), self.num_threads
             )
-            self.sys.start()
 
-        for index in range(1, self.num_threads):
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.cancel()
+        self.shutdown()
+        return False
+
+    def start(self):
+        self._started = time.perf_counter()
+        self.sys = _System(
+            index=0,
+            cb_queue=self.cb_queue,
+            output=self.output,
+            tasks_total=self.tasks_total,
+            size_total=self.size_total,
+        )
+        self.sys.start()
+
+        for index in range(1, self.num_threads + 1):
             worker = _Worker(
                 index=index,
                 task_queue=self.task_queue,
                 cb_queue=self.cb_queue,
-                output=output,
+                cancelled=self.cancelled,
+                output=self.output,
+                retries=self.retries,
+                backoff=self.backoff,
+                controller=self.controller,
             )
             worker.start()
+            self.workers.append(worker)
+
+    def submit(self, task):
+        """
+        Queue task, blocks while queue is full.
+
+        :param tasks._Task task:
 
-    def add_task(self, task):
-        self.total_tasks += 1
-        self.total_size += task.size()
-        self.task_queue.put(task)
+        :rtype: concurrent.futures.Future
+        """
+        future = concurrent.futures.Future()
+        if self.cancelled.is_set():
+            future.cancel()
+            return future
 
-    def join(self):
-        while self.task_queue.unfinished_tasks:
-            time.sleep(0.1)
+        self.task_queue.put((future, task))
+        return future
 
-        self.task_queue.join()
+    def map(self, tasks):
+        """
+        Feed tasks from iterable, without keeping their futures.
+
+        :param Iterable[tasks._Task] tasks:
+        """
+        for task in tasks:
+            if self.cancelled.is_set():
+                break
+            self.submit(task)
+
+    def cancel(self):
+        self.cancelled.set()
+        if self.controller is not None:
+            self.controller.release()
+        while True:
+            try:
+                item = self.task_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                item[0].cancel()
+            self.task_queue.task_done()
+
+    def shutdown(self):
+        if self.controller is not None:
+            self.controller.release()
+        for _worker in self.workers:
+            self.task_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self._report_utilization()
+        self.workers = []
 
         if self.sys is not None:
-            self.sys.join(timeout=1)
+            self.cb_queue.put(None)
+            self.sys.join()
+            self.sys = None
+
+    def _report_utilization(self):
+        if self._started is None:
+            return
+        elapsed = time.perf_counter() - self._started
+        for worker in self.workers:
+            metrics.metrics.set(
+                "worker_utilization",
+                worker.busy / elapsed if elapsed else 0,
+                str(worker.index),
+            )
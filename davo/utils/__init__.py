@@ -1,10 +1,13 @@
-from . import cli, concur, conf, format, path, prnt
+from . import cli, concur, conf, format, hashing, path, prnt, snapshot, sync
 
 __all__ = (
     "cli",
     "concur",
     "conf",
     "format",
+    "hashing",
     "path",
     "prnt",
+    "snapshot",
+    "sync",
 )
@@ -0,0 +1,234 @@
+import collections
+import concurrent.futures
+import hashlib
+import zlib
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+BLOCK_SIZE = 1024**2
+# bytes read from each end of file by `hash_file_ends`
+PARTIAL_SIZE = 64 * 1024
+
+MD5 = "md5"
+# S3 ETag of multipart upload, needs part size
+ETAG = "etag"
+# fast non-crypto hashes
+CRC32 = "crc32"
+XXH3 = "xxh3"
+
+
+class _Crc32:
+    """
+    hashlib-like running crc32.
+    """
+
+    name = CRC32
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def digest(self):
+        return self.value.to_bytes(4, "big")
+
+    def hexdigest(self):
+        return "{:08x}".format(self.value)
+
+
+class _MultipartEtag:
+    """
+    hashlib-like S3 multipart ETag: md5 of part md5 digests and parts count.
+    """
+
+    name = ETAG
+
+    def __init__(self, part_size):
+        self.part_size = part_size
+        self.digests = []
+        self._part = hashlib.md5()
+        self._left = part_size
+
+    def update(self, data):
+        while len(data):
+            chunk = data[: self._left]
+            self._part.update(chunk)
+            self._left -= len(chunk)
+            data = data[len(chunk) :]
+            if not self._left:
+                self._close_part()
+
+    def _close_part(self):
+        self.digests.append(self._part.digest())
+        self._part = hashlib.md5()
+        self._left = self.part_size
+
+    def hexdigest(self):
+        digests = list(self.digests)
+        if self._left != self.part_size:
+            digests.append(self._part.digest())
+        return "{}-{}".format(
+            hashlib.md5(b"".join(digests)).hexdigest(), len(digests)
+        )
+
+
+def algorithms():
+    """
+    :return: supported algorithm names
+    :rtype: tuple
+    """
+    return (MD5, ETAG, CRC32) + ((XXH3,) if xxhash is not None else ())
+
+
+def new(algorithm, part_size=None):
+    """
+    Make hasher.
+
+    :param str algorithm: one of `algorithms()`, or any hashlib name
+    :param int part_size: part size of ETAG
+
+    :return: hashlib-like object
+    """
+    if algorithm == ETAG:
+        if not part_size:
+            raise ValueError("etag needs part size")
+        return _MultipartEtag(part_size)
+    if algorithm == CRC32:
+        return _Crc32()
+    if algorithm == XXH3:
+        if xxhash is None:
+            raise ValueError("xxh3 needs xxhash package")
+        return xxhash.xxh3_64()
+    return hashlib.new(algorithm)
+
+
+def iter_blocks(file, block_size=BLOCK_SIZE):
+    """
+    Read file into one reused buffer.
+
+    Yielded views are valid until next iteration only.
+
+    :param file: binary file, unbuffered is best
+    :param int block_size:
+
+    :rtype: Iterator[memoryview]
+    """
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    while True:
+        length = file.readinto(buffer)
+        if not length:
+            break
+        yield view[:length]
+
+
+def update_from_file(hashers, path, block_size=BLOCK_SIZE):
+    """
+    Feed file content to hashers, in one read.
+
+    :param list hashers: hashlib-like objects
+    :param str path:
+    :param int block_size:
+    """
+    with open(path, "rb", buffering=0) as file:
+        for block in iter_blocks(file, block_size):
+            for hasher in hashers:
+                hasher.update(block)
+
+
+def hash_file(path, names=(MD5,), part_size=None, block_size=BLOCK_SIZE):
+    """
+    Hash file with several algorithms in one read.
+
+    :param str path:
+    :param tuple names: algorithm names, see `new`
+    :param int part_size: part size of ETAG
+    :param int block_size:
+
+    :return: algorithm: hex digest
+    :rtype: dict
+    """
+    hashers = [new(name, part_size=part_size) for name in names]
+    update_from_file(hashers, path, block_size)
+    return {
+        name: hasher.hexdigest() for name, hasher in zip(names, hashers)
+    }
+
+
+def hash_file_ends(path, size, length=PARTIAL_SIZE, name=MD5):
+    """
+    Hash first and last `length` bytes of file, cheap filter before full
+    hash. Files up to 2 * `length` are hashed whole.
+
+    :param str path:
+    :param int size: file size
+    :param int length:
+    :param str name: algorithm name, see `new`
+
+    :return: hex digest
+    :rtype: str
+    """
+    hasher = new(name)
+    with open(path, "rb", buffering=0) as file:
+        if size <= 2 * length:
+            for block in iter_blocks(file):
+                hasher.update(block)
+        else:
+            hasher.update(file.read(length))
+            file.seek(size - length)
+            hasher.update(file.read(length))
+    return hasher.hexdigest()
+
+
+def hash_files(
+    paths,
+    names=(MD5,),
+    part_size=None,
+    threads=None,
+    block_size=BLOCK_SIZE,
+):
+    """
+    Hash files concurrently on thread pool (hashlib releases GIL on large
+    blocks), results come in order of paths.
+
+    :param Iterable[str] paths:
+    :param tuple names: algorithm names, see `new`
+    :param int part_size: part size of ETAG
+    :param int threads: pool size, in place when 0 or None
+    :param int block_size:
+
+    :return: path, digests dict (see `hash_file`) or OSError
+    :rtype: Iterator[tuple]
+    """
+
+    def _hash(path):
+        try:
+            return hash_file(path, names, part_size, block_size)
+        except OSError as exc:
+            return exc
+
+    if not threads:
+        for path in paths:
+            yield path, _hash(path)
+        return
+
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(
+        threads, thread_name_prefix="hash"
+    ) as pool:
+        try:
+            for path in paths:
+                pending.append((path, pool.submit(_hash, path)))
+                if len(pending) >= threads * 4:
+                    path, future = pending.popleft()
+                    yield path, future.result()
+            while pending:
+                path, future = pending.popleft()
+                yield path, future.result()
+        finally:
+            for _path, future in pending:
+                future.cancel()
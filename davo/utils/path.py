@@ -1,68 +1,232 @@
 import collections
+import concurrent.futures
 import hashlib
 import logging
 import os
 import re
-import shutil
 
 from davo import constants, errors
 
+from . import hashing
+from .snapshot import HASH_FIELDS
+
 logger = logging.getLogger(__name__)
 
 
-def iter_files(root_path, recursive=False, exclude=(), depth=None):
+class _FileEntry:
+    """
+    `os.DirEntry` like entry of file given directly (not found by scandir).
     """
-    Iterate file in path.
 
-    :param str root_path:
-    :param bool recursive:
+    __slots__ = ("path", "name", "_stat")
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self._stat = None
+
+    def is_file(self):
+        return True
+
+    def is_dir(self):
+        return False
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+
+def compile_exclude(exclude):
+    """
+    Compile exclude patterns into one regex: patterns starting with `^` are
+    regexes matched from path start, others are substrings.
+
     :param tuple exclude:
-    :param int depth:
 
-    :rtype: Iterator
+    :return: regex for file paths, regex of substrings only (valid for
+        pruning dirs, as any file inside contains dir path) or None
+    :rtype: tuple
     """
+    regexes = [
+        "^(?:{})".format(excl) for excl in exclude if excl.startswith("^")
+    ]
+    substrings = [
+        re.escape(excl) for excl in exclude if not excl.startswith("^")
+    ]
+    file_re = re.compile("|".join(regexes + substrings)) if exclude else None
+    dir_re = re.compile("|".join(substrings)) if substrings else None
+    return file_re, dir_re
+
+
+def _scan_dir(path):
+    """
+    List dir, resolving entry types (may stat on network file systems).
 
-    def _check(dir_, file_):
-        path_ = os.path.join(dir_, file_)
-        if not os.path.isfile(path_):
-            return None
-        if exclude:
-            for excl in exclude:
-                if excl.startswith("^"):
-                    if re.match(excl, path_):
-                        return None
-                elif excl in path_:
-                    return None
-        return path_
-
-    if os.path.isdir(root_path):
-        if recursive:
-            for dir_path, dirs, file_names in os.walk(root_path):
-                if depth is not None:
-                    depth_ = (
-                        dir_path.count(os.sep) - root_path.count(os.sep) + 1
-                    )
-                    if depth < depth_:
-                        dirs.clear()
-                        continue
-
-                for file in file_names:
-                    path = _check(dir_path, file)
-                    if path is None:
-                        continue
-                    yield path
-        else:
-            for file in os.listdir(root_path):
-                path = _check(root_path, file)
-                if path is None:
+    :return: entries with flags is dir (real, not symlink), is file
+    :rtype: list[tuple]
+    """
+    result = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                    is_file = not is_dir and entry.is_file()
+                    is_dir = is_dir and not entry.is_symlink()
+                except OSError:
                     continue
-                yield path
+                result.append((entry, is_dir, is_file))
+    except OSError as exc:
+        logger.warning("scan %s failed: %s", path, exc)
+    return result
 
-    elif os.path.isfile(root_path):
-        yield root_path
 
-    else:
+def iter_file_entries(
+    root_path,
+    recursive=False,
+    exclude=(),
+    depth=None,
+    sort=False,
+    threads=None,
+):
+    """
+    Iterate file entries of path, with cached type and stat info.
+
+    Walk is depth first, files of directory come before its sub dirs, or
+    all paths come sorted with `sort`. Sub dirs are listed when walk
+    descends into them; with `threads` next ones in walk order (up to 4
+    per thread) are listed ahead on thread pool (useful on network
+    mounts), output order stays the same.
+
+    :param str root_path:
+    :param bool recursive:
+    :param tuple exclude: see `compile_exclude`
+    :param int depth: max dir level (root is 1)
+    :param bool sort:
+    :param int threads: dir listing threads, 0 or None to list in place
+
+    :rtype: Iterator[os.DirEntry]
+    """
+    if os.path.isfile(root_path) and not os.path.isdir(root_path):
+        yield _FileEntry(root_path)
+        return
+    if not os.path.isdir(root_path):
         raise errors.UserError("Invalid path {}".format(root_path))
+    if recursive and depth is not None and depth < 1:
+        return
+
+    file_re, dir_re = compile_exclude(exclude)
+    pool = None
+    # sub dir path: listing future, at most `window` ahead of walk
+    prefetched = {}
+    window = 0
+    if threads and recursive:
+        pool = concurrent.futures.ThreadPoolExecutor(
+            threads, thread_name_prefix="walk"
+        )
+        window = threads * 4
+
+    def _sort_key(item):
+        # paths in sub dir continue with separator
+        entry, is_dir, _is_file = item
+        return entry.name + os.sep if is_dir else entry.name
+
+    def _expand(path, level):
+        """
+        List dir (or take its prefetched listing), order entries.
+
+        :return: entries as (entry, sub dir path to descend into or None,
+            level), sub dir paths not prefetched yet
+        :rtype: tuple
+        """
+        future = prefetched.pop(path, None)
+        entries = _scan_dir(path) if future is None else future.result()
+        if sort:
+            entries = sorted(entries, key=_sort_key)
+        else:
+            entries = [item for item in entries if not item[1]] + [
+                item for item in entries if item[1]
+            ]
+
+        descend = recursive and (depth is None or level < depth)
+        result = []
+        dirs = collections.deque()
+        for entry, is_dir, is_file in entries:
+            if is_dir:
+                if descend and not (
+                    dir_re and dir_re.search(entry.path + os.sep)
+                ):
+                    result.append((entry, entry.path, level + 1))
+                    if pool is not None:
+                        dirs.append(entry.path)
+            elif is_file and not (file_re and file_re.search(entry.path)):
+                result.append((entry, None, level))
+        return iter(result), dirs
+
+    def _prefetch():
+        # deepest dirs are walked first
+        for _items, dirs in reversed(stack):
+            while dirs:
+                if len(prefetched) >= window:
+                    return
+                path = dirs.popleft()
+                prefetched[path] = pool.submit(_scan_dir, path)
+
+    stack = [_expand(root_path, 1)]
+    try:
+        if pool is not None:
+            _prefetch()
+        while stack:
+            items, dirs = stack[-1]
+            item = next(items, None)
+            if item is None:
+                stack.pop()
+            elif item[1] is None:
+                yield item[0]
+            else:
+                if dirs and dirs[0] == item[1]:
+                    # not prefetched, window is full
+                    dirs.popleft()
+                stack.append(_expand(item[1], item[2]))
+                if pool is not None:
+                    _prefetch()
+    finally:
+        if pool is not None:
+            for future in prefetched.values():
+                future.cancel()
+            pool.shutdown(wait=False)
+
+
+def iter_files(
+    root_path,
+    recursive=False,
+    exclude=(),
+    depth=None,
+    sort=False,
+    threads=None,
+):
+    """
+    Iterate file in path.
+
+    :param str root_path:
+    :param bool recursive:
+    :param tuple exclude: see `compile_exclude`
+    :param int depth:
+    :param bool sort: sorted paths
+    :param int threads: see `iter_file_entries`
+
+    :rtype: Iterator
+    """
+    for entry in iter_file_entries(
+        root_path,
+        recursive=recursive,
+        exclude=exclude,
+        depth=depth,
+        sort=sort,
+        threads=threads,
+    ):
+        yield entry.path
 
 
 def ensure(path, commit=False):
@@ -80,7 +244,7 @@ def ensure(path, commit=False):
         return
 
     if commit:
-        os.makedirs(root)
+        os.makedirs(root, exist_ok=True)
 
 
 def file_hash(f_path):
@@ -90,14 +254,8 @@ def file_hash(f_path):
     :param str f_path:
     :rtype: hashlib.md5
     """
-    file_ = open(f_path, "rb")
     hash_value = hashlib.md5()
-    while True:
-        block = file_.read(128)
-        if not block:
-            break
-        hash_value.update(block)
-    file_.close()
+    hashing.update_from_file([hash_value], f_path)
     return hash_value
 
 
@@ -111,25 +269,26 @@ def iter_file_options(
     ignore_case=False,
     check_size=False,
     exclude=(),
+    threads=None,
 ):
-    for file_path in iter_files(root, recursive, exclude=exclude):
+    for entry in iter_file_entries(
+        root, recursive, exclude=exclude, threads=threads
+    ):
         # TODO: filters
-        if not os.path.isfile(file_path):
-            continue
-
-        file_key = _get_rel_path(root, file_path)
+        file_key = _get_rel_path(root, entry.path)
         if ignore_case:
             file_key = file_key.lower()
 
         options = {
             "key": file_key,
-            "path": file_path,
+            "path": entry.path,
         }
 
         if check_size:
-            stat = os.stat(file_path)
+            stat = entry.stat()
             options["size"] = stat.st_size
             options["modified"] = stat.st_mtime
+            options["mtime_ns"] = stat.st_mtime_ns
 
         yield options
 
@@ -137,9 +296,165 @@ def iter_file_options(
 def _ensure_md5(file_options):
     if file_options.get("md5"):
         return
-    # if not file_options.get('path'):
-    #     return
-    file_options["md5"] = file_hash(file_options["path"])
+    _check_readable(file_options)
+    file_options["md5"] = file_hash(_options_path(file_options)).hexdigest()
+
+
+def _check_readable(file_options):
+    if file_options.get("snapshot_only"):
+        raise errors.UserError(
+            "No hash of {} in snapshot, compare with root attached".format(
+                file_options["path"]
+            )
+        )
+
+
+def _options_path(file_options):
+    # source-only entries keep path as `path_source`
+    return file_options.get("path") or file_options["path_source"]
+
+
+def _options_size(file_options):
+    if file_options.get("size") is None:
+        file_options["size"] = os.path.getsize(_options_path(file_options))
+    return file_options["size"]
+
+
+def _options_md5_partial(file_options):
+    if not file_options.get("md5_partial"):
+        if file_options.get("md5") and (
+            _options_size(file_options) <= 2 * hashing.PARTIAL_SIZE
+        ):
+            # small files are hashed whole
+            file_options["md5_partial"] = file_options["md5"]
+            return file_options["md5_partial"]
+        _check_readable(file_options)
+        file_options["md5_partial"] = hashing.hash_file_ends(
+            _options_path(file_options), _options_size(file_options)
+        )
+    return file_options["md5_partial"]
+
+
+def _options_md5(file_options):
+    _ensure_md5(file_options)
+    return file_options["md5"]
+
+
+def _split_groups(groups, key, keep=None):
+    """
+    Split (new, missing) groups by key, drop groups without both sides.
+
+    :param list[tuple] groups: of new options list, missing options list
+    :param callable key: options -> value, called only for grouped options
+    :param callable keep: options -> bool, group with such options is
+        kept unsplit
+
+    :rtype: list[tuple]
+    """
+    result = []
+    for new, missing in groups:
+        if keep is not None and any(map(keep, new + missing)):
+            result.append((new, missing))
+            continue
+        split = collections.defaultdict(lambda: ([], []))
+        for options in new:
+            split[key(options)][0].append(options)
+        for options in missing:
+            split[key(options)][1].append(options)
+        result.extend(
+            group for group in split.values() if group[0] and group[1]
+        )
+    return result
+
+
+def _pair_renames(new, missing):
+    """
+    Pair candidates with same content deterministically: same file name
+    first, the rest in key order.
+
+    :param list new: new options
+    :param list missing: missing options
+
+    :rtype: Iterator[tuple]
+    """
+    if len(new) == 1 and len(missing) == 1:
+        yield new[0], missing[0]
+        return
+
+    new = sorted(new, key=lambda options: options["key"])
+    missing = sorted(missing, key=lambda options: options["key"])
+    by_name = collections.defaultdict(collections.deque)
+    for options in missing:
+        by_name[os.path.basename(options["key"])].append(options)
+
+    paired = set()
+    left = []
+    for data_new in new:
+        same_name = by_name.get(os.path.basename(data_new["key"]))
+        if same_name:
+            data_missing = same_name.popleft()
+            paired.add(data_missing["key"])
+            yield data_new, data_missing
+        else:
+            left.append(data_new)
+
+    yield from zip(
+        left,
+        (options for options in missing if options["key"] not in paired),
+    )
+
+
+def _find_renames(files_dest, check_md5=False):
+    """
+    Match new and missing files as renames.
+
+    Files are bucketed by size, with `check_md5` buckets are split by
+    partial hash (see `hashing.hash_file_ends`) and then by full md5, so
+    only files sharing size with other side are read, each once.
+
+    :param dict files_dest: compare result, modified
+    :param bool check_md5: match content, otherwise size only
+    """
+    by_size = collections.defaultdict(lambda: ([], []))
+    for data in files_dest.values():
+        if data.get("state") == constants.STATE_LOCAL_NEW:
+            by_size[_options_size(data)][0].append(data)
+        elif data.get("state") == constants.STATE_LOCAL_MISSING:
+            by_size[_options_size(data)][1].append(data)
+
+    groups = [group for group in by_size.values() if group[0] and group[1]]
+    if check_md5:
+        groups = _split_groups(
+            groups,
+            _options_md5_partial,
+            # snapshot entries may have full hash only
+            keep=lambda options: (
+                options.get("snapshot_only")
+                and not options.get("md5_partial")
+                and options["size"] > 2 * hashing.PARTIAL_SIZE
+            ),
+        )
+        groups = _split_groups(
+            groups,
+            lambda options: (
+                _options_md5(options)
+                if options["size"] > 2 * hashing.PARTIAL_SIZE
+                else None
+            ),
+        )
+
+    for new, missing in groups:
+        for data_new, data_missing in _pair_renames(new, missing):
+            data_missing.update(
+                {
+                    "state": constants.STATE_RENAMED,
+                    "new_options": data_new,
+                    "comment": "new key: {}".format(data_new["key"]),
+                    "path_source": data_new.get("path_source"),
+                }
+            )
+            # mark for remove from result
+            data_new["state"] = constants.STATE_MARK_DELETE
 
 
 def compare_dirs(
@@ -152,34 +467,82 @@ def compare_dirs(
     recursive=False,
     exclude=(),
     verbose=False,
+    walk_threads=None,
+    snapshot=None,
+    snapshot_only=False,
 ):
+    """
+    Compare dirs, see `compare`.
+
+    :param str root1: source
+    :param str root2: destination
+    :param set states:
+    :param bool ignore_case:
+    :param bool check_size:
+    :param bool check_md5:
+    :param bool recursive:
+    :param tuple exclude:
+    :param bool verbose:
+    :param int walk_threads: list dirs on thread pool
+    :param davo.utils.snapshot.Snapshot snapshot: reuse hashes of
+        unchanged files, store walked roots
+    :param bool snapshot_only: take root2 from snapshot, don't walk it
+
+    :return: files by key
+    :rtype: dict
+    """
     if states is None:
         states = constants.STATES_DIFF_VALID
+    if snapshot_only and snapshot is None:
+        raise errors.UserError("snapshot_only requires snapshot")
+    # snapshot needs size and mtime
+    check_stat = check_size or snapshot is not None
 
     files_src = []
     root1 = os.path.abspath(root1)
     for options in iter_file_options(
-        root1, recursive, ignore_case, check_size, exclude
+        root1, recursive, ignore_case, check_stat, exclude, walk_threads
     ):
         files_src.append(options)
 
     if verbose:
         logger.info("%d files in %s", len(files_src), root1)
 
+    root2 = os.path.abspath(root2)
+    if snapshot_only:
+        if snapshot.taken_at(root2) is None:
+            raise errors.UserError("No snapshot of {}".format(root2))
+        files_dest_iter = snapshot.iter_options(root2, ignore_case)
+        if verbose:
+            logger.info(
+                "snapshot of %s taken at %s", root2, snapshot.taken_at(root2)
+            )
+    else:
+        files_dest_iter = iter_file_options(
+            root2, recursive, ignore_case, check_stat, exclude, walk_threads
+        )
+
     files_dest = dict()
-    for options in iter_file_options(
-        root2, recursive, ignore_case, check_size, exclude
-    ):
+    for options in files_dest_iter:
         options["state"] = constants.STATE_LOCAL_MISSING
         files_dest[options["key"]] = options
 
     if verbose:
         logger.info("%d files in %s", len(files_dest), root2)
 
+    if snapshot is not None:
+        reused = snapshot.apply(root1, files_src)
+        if not snapshot_only:
+            reused += snapshot.apply(root2, files_dest.values())
+        if verbose:
+            logger.info("hashes of %d files reused from snapshot", reused)
+
     if not files_src and not files_dest:
         return
 
-    return compare(
+    # compare copies source-only entries, so pick their hashes after
+    files_dest_all = files_dest.copy()
+    result = compare(
         files_src,
         files_dest,
         states=states,
@@ -188,6 +551,21 @@ def compare_dirs(
         verbose=verbose,
     )
 
+    if snapshot is not None:
+        for options in files_src:
+            copied = files_dest.get(options["key"])
+            if copied is not None and options["key"] not in files_dest_all:
+                options.update(
+                    (field, copied[field])
+                    for field in HASH_FIELDS
+                    if copied.get(field)
+                )
+        snapshot.save(root1, files_src)
+        if not snapshot_only:
+            snapshot.save(root2, files_dest_all.values())
+
+    return result
+
 
 def compare(
     files_src,
@@ -259,36 +637,8 @@ def compare(
             dest["state"] = constants.STATE_LOCAL_NEW
             dest.setdefault("path_source", "")
 
-    # find renames
     if constants.STATE_RENAMED in states:
-        for key_new, data_new in files_dest.items():
-            if data_new.get("state") != constants.STATE_LOCAL_NEW:
-                continue
-
-            for key_missing, data_missing in files_dest.items():
-                if data_missing["state"] != constants.STATE_LOCAL_MISSING:
-                    continue
-
-                if data_missing["size"] != data_new["size"]:
-                    continue
-
-                if check_md5:
-                    _ensure_md5(data_missing)
-                    _ensure_md5(data_new)
-                    if data_missing["md5"] != data_new["md5"]:
-                        continue
-
-                data_missing.update(
-                    {
-                        "state": constants.STATE_RENAMED,
-                        "new_options": data_new,
-                        "comment": "new key: {}".format(data_new["key"]),
-                        "path_source": data_new.get("path_source"),
-                    }
-                )
-                # mark for remove from result
-                data_new["state"] = constants.STATE_MARK_DELETE
-                break
+        _find_renames(files_dest, check_md5)
 
     return {
         key: options
@@ -364,102 +714,6 @@ def get_filename_no_extension(filename, lower=False):
     return value
 
 
-def sync_file(path_dest, root_source, root_dest, safe, commit):
-    """
-    Sync file between paths.
-
-    :param str path_dest:
-    :param str root_source:
-    :param str root_dest:
-    :param bool safe: safe == without deleting
-    :param bool commit: false = dry run
-    """
-    source = path_dest.replace(root_dest, root_source)
-    source_dir = os.path.dirname(source)
-    if commit:
-        if not os.path.exists(source_dir):
-            os.makedirs(source_dir)
-
-        if os.path.exists(source):
-            # protect from overwriting
-            if safe:
-                return 0
-            else:
-                try:
-                    os.remove(source)
-                except OSError:
-                    return 0
-        try:
-            shutil.copy2(path_dest, source, follow_symlinks=False)
-            return 1
-        except OSError:
-            return 0
-    else:
-        if not os.path.exists(source_dir):
-            print("mkdir -p {}".format(source_dir))
-
-        if os.path.exists(source):
-            if safe:
-                print(
-                    (
-                        "# (overriding will be skipped without --force) "
-                        "cp {} {}"
-                    ).format(
-                        path_dest, source
-                    )
-                )
-            else:
-                print("rm {}".format(source))
-                print("cp {} {}".format(path_dest, source))
-        else:
-            print("cp {} {}".format(path_dest, source))
-
-        return 0
-
-
-def sync_file_rename(path_dest, path_source, root_dest, root_source, commit):
-    """
-    Sync file between paths with renaming.
-
-    :param str path_dest:
-    :param str root_source:
-    :param str root_dest:
-    :param str path_source:
-    :param bool commit: false = dry run
-    """
-    dest = path_dest.replace(root_dest, root_source)
-    dest_dir = os.path.dirname(dest)
-    source = os.path.join(root_source, path_source)
-    if commit:
-        if not os.path.exists(dest_dir):
-            os.makedirs(dest_dir)
-        try:
-            os.rename(source, dest)
-            return 1
-        except OSError:
-            return 0
-    else:
-        if not os.path.exists(dest_dir):
-            print("mkdir -p {}".format(dest_dir))
-        print("mv {} {}".format(source, dest))
-        return 0
-
-
-def sync_file_remove(path_source, safe, commit):
-    if safe:
-        return 0
-
-    if commit:
-        try:
-            os.remove(path_source)
-            return 1
-        except OSError:
-            return 0
-    else:
-        print("rm {}".format(path_source))
-        return 0
-
-
 def find_config_root(root, config_name):
     while root:
         path = os.path.join(root, config_name)
@@ -0,0 +1,173 @@
+import datetime
+import os
+import sqlite3
+
+QUERY_CREATE_FILES = (
+    "CREATE TABLE IF NOT EXISTS files ( "
+    "root text, "
+    "name text, "
+    "size int, "
+    "mtime_ns int, "
+    "md5 text, "
+    "md5_partial text, "
+    "phash text, "
+    "PRIMARY KEY (root, name)) WITHOUT ROWID"
+)
+QUERY_CREATE_ROOTS = (
+    "CREATE TABLE IF NOT EXISTS roots (root text PRIMARY KEY, taken_at text)"
+)
+QUERY_FILES_FILTER = (
+    "SELECT name, size, mtime_ns, md5, md5_partial, phash FROM files "
+    "WHERE root=?"
+)
+QUERY_FILES_DELETE = "DELETE FROM files WHERE root=?"
+QUERY_FILES_INSERT = (
+    "INSERT INTO files "
+    "(root, name, size, mtime_ns, md5, md5_partial, phash) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+QUERY_ROOT_SET = "INSERT OR REPLACE INTO roots (root, taken_at) VALUES (?, ?)"
+QUERY_ROOT_GET = "SELECT taken_at FROM roots WHERE root=?"
+
+HASH_FIELDS = ("md5", "md5_partial", "phash")
+
+
+class Snapshot:
+    """
+    Store of compared roots: size, mtime and hashes (md5, partial md5,
+    perceptual) of each file, by absolute root path and path relative to
+    it.
+
+    Hashes of files with unchanged size and mtime are reused by next
+    compare, root may be compared by its snapshot only (offline disk).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        cur = self.conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute(QUERY_CREATE_FILES)
+        cur.execute(QUERY_CREATE_ROOTS)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def taken_at(self, root):
+        """
+        :param str root: absolute path
+
+        :return: snapshot time or None if root has no snapshot
+        :rtype: str
+        """
+        row = self.conn.execute(QUERY_ROOT_GET, (root,)).fetchone()
+        return None if row is None else row[0]
+
+    def load(self, root):
+        """
+        :param str root: absolute path
+
+        :return: name: file row
+        :rtype: dict
+        """
+        return {
+            row[0]: {
+                "size": row[1],
+                "mtime_ns": row[2],
+                "md5": row[3],
+                "md5_partial": row[4],
+                "phash": row[5],
+            }
+            for row in self.conn.execute(QUERY_FILES_FILTER, (root,))
+        }
+
+    def apply(self, root, files):
+        """
+        Copy hashes from snapshot to files with same size and mtime.
+
+        :param str root: absolute path
+        :param Iterable[dict] files: `iter_file_options` compatible, with
+            size and mtime_ns
+
+        :return: files with reused hashes
+        :rtype: int
+        """
+        rows = self.load(root)
+        reused = 0
+        for options in files:
+            row = rows.get(_name(root, options["path"]))
+            if (
+                row is None
+                or row["size"] != options["size"]
+                or row["mtime_ns"] != options["mtime_ns"]
+            ):
+                continue
+            hashes = {
+                field: row[field]
+                for field in HASH_FIELDS
+                if row[field] and not options.get(field)
+            }
+            if hashes:
+                options.update(hashes)
+                reused += 1
+        return reused
+
+    def iter_options(self, root, ignore_case=False):
+        """
+        Files of root snapshot, `iter_file_options` compatible.
+
+        :param str root: absolute path
+        :param bool ignore_case:
+
+        :rtype: Iterator[dict]
+        """
+        for name, row in self.load(root).items():
+            options = dict(row)
+            options.update(
+                {
+                    "key": name.lower() if ignore_case else name,
+                    "path": os.path.join(root, name),
+                    "modified": row["mtime_ns"] / 1e9,
+                    "snapshot_only": True,
+                }
+            )
+            yield options
+
+    def save(self, root, files):
+        """
+        Replace root snapshot.
+
+        :param str root: absolute path
+        :param Iterable[dict] files: `iter_file_options` compatible, with
+            size and mtime_ns
+        """
+        with self.conn:
+            self.conn.execute(QUERY_FILES_DELETE, (root,))
+            self.conn.executemany(
+                QUERY_FILES_INSERT,
+                (
+                    (
+                        root,
+                        _name(root, options["path"]),
+                        options["size"],
+                        options["mtime_ns"],
+                        options.get("md5"),
+                        options.get("md5_partial"),
+                        options.get("phash"),
+                    )
+                    for options in files
+                ),
+            )
+            self.conn.execute(
+                QUERY_ROOT_SET,
+                (
+                    root,
+                    datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                ),
+            )
+
+
+def _name(root, path):
+    return path[len(root) :].lstrip(os.sep)
@@ -0,0 +1,317 @@
+import collections
+import concurrent.futures
+import errno
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from . import format, hashing, prnt
+
+logger = logging.getLogger(__name__)
+
+ACTION_COPY = "cp"
+ACTION_MOVE = "mv"
+ACTION_REMOVE = "rm"
+
+STATUS_DONE = "done"
+STATUS_SKIPPED = "skipped"
+
+# linux ioctl cloning file extents (btrfs, xfs, ...)
+FICLONE = 0x40049409
+CHUNK_SIZE = 8 * 1024**2
+# kernel or file system can't do that copy, next method may
+_FALLBACK_ERRNOS = {
+    errno.EBADF,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTSOCK,
+    errno.ENOTSUP,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    errno.EPERM,
+    errno.EXDEV,
+}
+
+Operation = collections.namedtuple(
+    "Operation", ("action", "source", "dest", "size", "overwrite")
+)
+
+
+def copy(source, dest, overwrite=False):
+    """
+    :param str source:
+    :param str dest:
+    :param bool overwrite: replace existing dest, skip it otherwise
+
+    :rtype: Operation
+    """
+    try:
+        size = os.lstat(source).st_size
+    except OSError:
+        size = 0
+    return Operation(ACTION_COPY, source, dest, size, overwrite)
+
+
+def move(source, dest):
+    return Operation(ACTION_MOVE, source, dest, 0, False)
+
+
+def remove(path):
+    return Operation(ACTION_REMOVE, path, None, 0, False)
+
+
+class Summary:
+    """
+    Sync result: counts, copied bytes and failed operations.
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.skipped = 0
+        self.failed = []
+        self.bytes = 0
+        self.started = time.monotonic()
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add_bytes(self, amount):
+        with self._lock:
+            self.bytes += amount
+
+    def speed(self):
+        elapsed = self.seconds or time.monotonic() - self.started
+        return self.bytes / elapsed if elapsed else 0.0
+
+
+def _reflink(src_fd, dst_fd):
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return False
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except OSError as exc:
+        if exc.errno in _FALLBACK_ERRNOS:
+            return False
+        raise
+    return True
+
+
+def _copy_data(fsrc, fdst, size, progress):
+    """
+    Copy file content: reflink, else copy_file_range, else sendfile,
+    else read/write. Fallbacks continue from current file positions, zero
+    copied before `size` means method isn't supported by file system.
+    """
+    src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+    if size and _reflink(src_fd, dst_fd):
+        progress(size)
+        return
+
+    copied = 0
+    for method in ("copy_file_range", "sendfile"):
+        func = getattr(os, method, None)
+        if func is None:
+            continue
+        try:
+            while True:
+                if method == "sendfile":
+                    sent = func(dst_fd, src_fd, None, CHUNK_SIZE)
+                else:
+                    sent = func(src_fd, dst_fd, CHUNK_SIZE)
+                if not sent:
+                    if copied >= size:
+                        return
+                    break
+                copied += sent
+                progress(sent)
+        except OSError as exc:
+            if exc.errno not in _FALLBACK_ERRNOS:
+                raise
+
+    for block in hashing.iter_blocks(fsrc, CHUNK_SIZE):
+        while len(block):
+            written = fdst.write(block)
+            block = block[written:]
+            progress(written)
+
+
+def copy_file(source, dest, overwrite=False, progress=None):
+    """
+    Copy file with metadata (like `shutil.copy2`, symlinks are copied as
+    links), without passing content through user space when possible.
+
+    :param str source:
+    :param str dest:
+    :param bool overwrite: replace existing dest
+    :param callable progress: called with copied bytes
+
+    :return: status
+    :rtype: str
+    """
+    if progress is None:
+
+        def progress(_amount):
+            pass
+
+    if overwrite:
+        try:
+            os.remove(dest)
+        except FileNotFoundError:
+            pass
+
+    if os.path.islink(source):
+        try:
+            os.symlink(os.readlink(source), dest)
+        except FileExistsError:
+            return STATUS_SKIPPED
+        return STATUS_DONE
+
+    with open(source, "rb", buffering=0) as fsrc:
+        stat = os.fstat(fsrc.fileno())
+        try:
+            fd = os.open(
+                dest,
+                os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                stat.st_mode & 0o777,
+            )
+        except FileExistsError:
+            return STATUS_SKIPPED
+        try:
+            with open(fd, "wb", buffering=0) as fdst:
+                _copy_data(fsrc, fdst, stat.st_size, progress)
+        except BaseException:
+            try:
+                os.remove(dest)
+            except OSError:
+                pass
+            raise
+
+    shutil.copystat(source, dest)
+    return STATUS_DONE
+
+
+def _run(operation, summary):
+    if operation.action == ACTION_COPY:
+        return copy_file(
+            operation.source,
+            operation.dest,
+            overwrite=operation.overwrite,
+            progress=summary.add_bytes,
+        )
+    if operation.action == ACTION_MOVE:
+        os.rename(operation.source, operation.dest)
+    elif operation.action == ACTION_REMOVE:
+        os.remove(operation.source)
+    return STATUS_DONE
+
+
+def _dirs(operations):
+    return sorted(
+        {
+            os.path.dirname(operation.dest)
+            for operation in operations
+            if operation.dest is not None
+        }
+    )
+
+
+def _print_plan(operations):
+    for path in _dirs(operations):
+        if not os.path.exists(path):
+            print("mkdir -p {}".format(path))
+
+    for operation in operations:
+        if operation.action == ACTION_REMOVE:
+            print("rm {}".format(operation.source))
+        elif operation.action == ACTION_MOVE:
+            print("mv {} {}".format(operation.source, operation.dest))
+        elif not os.path.exists(operation.dest):
+            print("cp {} {}".format(operation.source, operation.dest))
+        elif operation.overwrite:
+            print("rm {}".format(operation.dest))
+            print("cp {} {}".format(operation.source, operation.dest))
+        else:
+            print(
+                "# (overriding will be skipped without --force) "
+                "cp {} {}".format(operation.source, operation.dest)
+            )
+
+
+def _progress_line(summary, total_bytes, processed):
+    return "{} {} of {}, {}".format(
+        prnt.progress_bar(processed, summary.total or 1),
+        format.humanize_bytes(summary.bytes).strip(),
+        format.humanize_bytes(total_bytes).strip(),
+        format.humanize_speed(summary.speed()).strip(),
+    )
+
+
+def execute(operations, threads=4, commit=False, output=None):
+    """
+    Run sync plan: create all dirs first, then run operations on thread
+    pool, copies use `copy_file`. Without commit plan is printed as shell
+    commands.
+
+    :param list[Operation] operations:
+    :param int threads: pool size
+    :param bool commit: false = dry run
+    :param list output: reprint output for progress line
+
+    :rtype: Summary
+    """
+    summary = Summary(len(operations))
+    if not commit:
+        _print_plan(operations)
+        return summary
+
+    for path in _dirs(operations):
+        try:
+            os.makedirs(path, exist_ok=True)
+        except OSError as exc:
+            logger.warning("mkdir %s failed: %s", path, exc)
+
+    total_bytes = sum(operation.size for operation in operations)
+    pool = concurrent.futures.ThreadPoolExecutor(
+        max(threads or 1, 1), thread_name_prefix="sync"
+    )
+    pending = {
+        pool.submit(_run, operation, summary): operation
+        for operation in operations
+    }
+    try:
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending,
+                timeout=0.5,
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for future in done:
+                operation = pending.pop(future)
+                exc = future.exception()
+                if exc is not None:
+                    summary.failed.append((operation, exc))
+                elif future.result() == STATUS_SKIPPED:
+                    summary.skipped += 1
+                else:
+                    summary.done += 1
+            if output is not None:
+                output[0] = _progress_line(
+                    summary,
+                    total_bytes,
+                    summary.total - len(pending),
+                )
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=True)
+        summary.seconds = time.monotonic() - summary.started
+
+    return summary
@@ -0,0 +1,86 @@
+import os
+
+from PIL import Image
+
+from davo.services.photo import duplicates
+from davo.utils import hashing
+
+
+def _write(root, name, data):
+    file_path = os.path.join(root, name)
+    with open(file_path, "wb") as file:
+        file.write(data)
+    return file_path
+
+
+def test_find_duplicates_tiers(tmp_path):
+    root = str(tmp_path)
+    big = os.urandom(3 * hashing.PARTIAL_SIZE)
+    # same size, head and tail
+    big_changed = bytearray(big)
+    big_changed[len(big) // 2] ^= 1
+    small = [_write(root, name, b"same") for name in ("a", "b", "c")]
+    large = [_write(root, name, big) for name in ("d", "e")]
+    _write(root, "f", bytes(big_changed))
+    _write(root, "g", b"diff")
+    _write(root, "empty1", b"")
+    _write(root, "empty2", b"")
+
+    files = duplicates.scan(root)
+    partial = duplicates.find_duplicates(files)
+    files = duplicates.scan(root)
+    full = duplicates.find_duplicates(files, full=True, threads=2)
+
+    assert [cluster.paths for cluster in partial] == [
+        sorted(large + [os.path.join(root, "f")]),
+        small,
+    ]
+    assert [cluster.kind for cluster in partial] == [
+        duplicates.KIND_PARTIAL,
+        duplicates.KIND_EXACT,
+    ]
+    assert [cluster.paths for cluster in full] == [large, small]
+    assert {cluster.kind for cluster in full} == {duplicates.KIND_EXACT}
+    assert full[0].key == hashing.hash_file(large[0])["md5"]
+    assert full[0].size == len(big)
+
+
+def test_find_similar_images(tmp_path):
+    root = str(tmp_path)
+    image = Image.new("L", (64, 64))
+    image.putdata([x * 4 for _y in range(64) for x in range(64)])
+    image.save(os.path.join(root, "a.png"))
+    image.resize((32, 32)).save(os.path.join(root, "a_small.jpg"))
+    image.transpose(Image.FLIP_LEFT_RIGHT).save(os.path.join(root, "b.png"))
+    _write(root, "broken.jpg", b"not an image")
+
+    (cluster,) = duplicates.find_similar(duplicates.scan(root), threads=2)
+
+    assert cluster.kind == duplicates.KIND_SIMILAR
+    assert [os.path.basename(path) for path in cluster.paths] == [
+        "a.png",
+        "a_small.jpg",
+    ]
+
+
+def test_find_similar_skips_exact_duplicates(tmp_path):
+    root = str(tmp_path)
+    image = Image.new("L", (64, 64))
+    image.putdata([x * 4 for _y in range(64) for x in range(64)])
+    image.save(os.path.join(root, "a.png"))
+    image.save(os.path.join(root, "a_copy.png"))
+    files = duplicates.scan(root)
+    found = duplicates.find_duplicates(files)
+
+    assert [cluster.kind for cluster in found] == [duplicates.KIND_EXACT]
+    assert duplicates.find_similar(files, found=found) == []
+
+    image.resize((32, 32)).save(os.path.join(root, "a_small.jpg"))
+    files = duplicates.scan(root)
+    found = duplicates.find_duplicates(files)
+
+    (cluster,) = duplicates.find_similar(files, found=found)
+    assert [os.path.basename(path) for path in cluster.paths] == [
+        "a.png",
+        "a_small.jpg",
+    ]
@@ -1,6 +1,103 @@
+import argparse
+import concurrent.futures
+import datetime
+import hashlib
+import json
+import logging
 import os
+import sqlite3
+import threading
+import time
 
-from davo.services.s3sync import cache, cli, conf, utils
+import boto.s3.connection
+import boto.s3.key
+import boto.s3.multidelete
+import boto.s3.prefix
+import pytest
+
+from davo import constants
+from davo.services.s3sync import (
+    cache,
+    cli,
+    conf,
+    connections,
+    diff,
+    download,
+    handlers,
+    manifest,
+    metrics,
+    multipart,
+    rename,
+    schedule,
+    tasks,
+    throttle,
+    utils,
+    workers,
+)
+
+
+@pytest.fixture()
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        conf,
+        "_CONFIG",
+        {
+            **conf._CONFIG,
+            "PROJECT_ROOT": str(tmp_path),
+            "CACHE_FILE_NAME": ".s3cache-test.db",
+        },
+    )
+    db = cache.Cache()
+    db.init()
+    yield db
+    db.close()
+
+
+class FakeBucket:
+    """
+    In-process bucket stand-in, sleeps `latency` per listing page.
+    """
+
+    def __init__(self, names, latency=0.0, page_size=1000):
+        self.names = sorted(names)
+        self.latency = latency
+        self.page_size = page_size
+
+    def _key(self, name):
+        key = boto.s3.key.Key(bucket=self, name=name)
+        key.size = 1
+        key.etag = '"e"'
+        key.last_modified = "2026-05-13T00:00:00.000Z"
+        return key
+
+    def list(self, prefix="", delimiter=None):
+        items = []
+        seen = set()
+        for name in self.names:
+            if not name.startswith(prefix):
+                continue
+            rest = name[len(prefix) :]
+            if delimiter and delimiter in rest:
+                sub = prefix + rest.split(delimiter, 1)[0] + delimiter
+                if sub not in seen:
+                    seen.add(sub)
+                    items.append(boto.s3.prefix.Prefix(self, sub))
+                continue
+            items.append(self._key(name))
+
+        for index, item in enumerate(items):
+            if index % self.page_size == 0:
+                time.sleep(self.latency)
+            yield item
+
+
+def _record(name, size=1, etag="e"):
+    return {
+        "name": name,
+        "size": size,
+        "last_modified": "2026-05-13T00:00:00.000Z",
+        "etag": etag,
+    }
 
 
 def test_cli_command_with_mapping():
@@ -178,3 +275,1286 @@ def test_cache_select_directory_prefix_with_delimiter(tmp_path, monkeypatch):
         db.close()
 
     assert [row["name"] for row in rows] == ["docs/one.md"]
+
+
+def test_cache_bulk_update_upserts_in_batches(db):
+    db.update("a.md", _record("a.md", etag="old"))
+    db.flush()
+
+    written = db.bulk_update(
+        (_record(name, etag="new") for name in ("a.md", "b/c.md", "d.md")),
+        batch_size=2,
+    )
+
+    assert written == 3
+    assert db.total() == 3
+    assert db.select_one("a.md")["etag"] == "new"
+    assert [row["name"] for row in db.select(prefix="b/")] == ["b/c.md"]
+
+
+def test_cache_bulk_update_rollback_on_error(db):
+    db.update("a.md", _record("a.md"))
+    db.flush()
+
+    def records():
+        yield _record("b.md")
+        raise RuntimeError("listing failed")
+
+    with pytest.raises(RuntimeError):
+        db.bulk_update(records(), batch_size=1)
+
+    assert [row["name"] for row in db.select()] == ["a.md"]
+
+
+def test_cache_bulk_update_fast_replaces_table(db):
+    db.update("stale.md", _record("stale.md"))
+    db.flush()
+
+    db.bulk_update(
+        [_record("a.md"), _record("b/c.md")], batch_size=1, fast=True
+    )
+
+    assert sorted(row["name"] for row in db.select()) == ["a.md", "b/c.md"]
+    assert db.select_one("stale.md") is None
+
+
+def test_cache_bulk_update_fast_restores_journal(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "find_project_root", lambda: str(tmp_path))
+    monkeypatch.setattr(utils, "get_cwd", lambda: str(tmp_path))
+    monkeypatch.setitem(conf._CONFIG, "WALK_THREADS", None)
+    namespace = argparse.Namespace(
+        recursive=True, depth=None, file_types=None, ignore_case=False
+    )
+
+    db.bulk_update([_record("a.md")], fast=True)
+
+    conn = sqlite3.connect(str(tmp_path / ".s3cache-test.db"))
+    assert conn.execute("PRAGMA journal_mode").fetchone() == ("delete",)
+    conn.close()
+    assert list(handlers._iter_local_keys(str(tmp_path), namespace)) == []
+    # stale journal files of crashed process
+    (tmp_path / ".s3cache-test.db-wal").write_bytes(b"")
+    (tmp_path / ".s3cache-test.db-journal").write_bytes(b"")
+    assert list(handlers._iter_local_keys(str(tmp_path), namespace)) == []
+
+
+def test_cache_select_prefix_range_scan(db):
+    db.bulk_update(
+        [
+            _record("docs/one.md"),
+            _record("docs/sub/two.md"),
+            _record("docs/sub/deep/three.md"),
+            _record("docs0/other.md"),
+            _record("docsX/other.md"),
+            _record("docs.md"),
+        ]
+    )
+
+    rows = [row["name"] for row in db.select(prefix="docs/")]
+    assert sorted(rows) == [
+        "docs/one.md",
+        "docs/sub/deep/three.md",
+        "docs/sub/two.md",
+    ]
+
+    rows = [row["name"] for row in db.select(prefix="docs/", depth=2)]
+    assert sorted(rows) == ["docs/one.md", "docs/sub/two.md"]
+
+
+def test_cache_select_uses_level_index(db):
+    plan = db.conn.execute(
+        "EXPLAIN QUERY PLAN "
+        + cache.QUERY_FILTER
+        + " WHERE level=? and name>=? and name<?",
+        (2, "docs/", "docs0"),
+    ).fetchall()
+
+    assert "s3keys_level_name" in " ".join(str(row) for row in plan)
+
+
+def test_cache_refresh_prefix_reconciles_only_subtree(db):
+    db.bulk_update(
+        [
+            _record("album/a.jpg", etag="old"),
+            _record("album/gone.jpg"),
+            _record("album2/b.jpg"),
+            _record("other/c.jpg"),
+        ]
+    )
+
+    listed, deleted = db.refresh_prefix(
+        "album/",
+        [_record("album/a.jpg", etag="new"), _record("album/new.jpg")],
+    )
+
+    assert (listed, deleted) == (2, 1)
+    assert sorted(row["name"] for row in db.select()) == [
+        "album/a.jpg",
+        "album/new.jpg",
+        "album2/b.jpg",
+        "other/c.jpg",
+    ]
+    assert db.select_one("album/a.jpg")["etag"] == "new"
+
+
+def test_cache_refresh_dir_prefix_keeps_same_named_key(db):
+    db.bulk_update([_record("album"), _record("album/x")])
+
+    assert db.refresh_prefix("album/", [_record("album/x")]) == (1, 0)
+    assert [row["name"] for row in db.select()] == ["album", "album/x"]
+
+    assert db.refresh_prefix("album", [_record("album/x")]) == (1, 1)
+    assert [row["name"] for row in db.select()] == ["album/x"]
+
+
+def test_cache_watermark_covers_nested_prefixes(db):
+    assert not db.is_fresh("album/2026")
+
+    db.refresh_prefix(
+        "album",
+        [
+            _record("album/2026/a.jpg"),
+            {**_record("album/b.jpg"), "last_modified": "2026-06-01"},
+        ],
+    )
+
+    watermark = db.watermark("album/2026/")
+    assert watermark["prefix"] == "album"
+    assert watermark["total"] == 2
+    assert watermark["last_modified"] == "2026-06-01"
+    assert db.is_fresh("album/2026", ttl=60)
+    assert not db.is_fresh("album", ttl=0)
+    assert not db.is_fresh("other")
+
+    db.mark_refreshed()
+    assert db.watermark("album")["prefix"] == ""
+
+
+def test_iter_remote_sharded_lists_all_keys_concurrently():
+    names = ["top.md"] + [
+        "shard{}/sub{}/{}.jpg".format(shard, sub, index)
+        for shard in range(8)
+        for sub in range(2)
+        for index in range(50)
+    ]
+    bucket = FakeBucket(names, latency=0.01, page_size=10)
+
+    _t = time.time()
+    sequential = [key.name for key in utils._iter_remote(bucket)]
+    sequential_time = time.time() - _t
+
+    _t = time.time()
+    sharded = [
+        key.name for key in utils.iter_remote_sharded(bucket, threads=8)
+    ]
+    sharded_time = time.time() - _t
+
+    assert sorted(sharded) == sorted(sequential) == sorted(names)
+    assert sharded_time < sequential_time / 2
+
+
+def test_iter_remote_sharded_reports_shard_progress():
+    bucket = FakeBucket(["a/1.jpg", "a/2.jpg", "b/3.jpg"])
+    output = [""] * 4
+
+    keys = list(
+        utils.iter_remote_sharded(bucket, threads=2, output=output)
+    )
+
+    assert len(keys) == 3
+    assert sorted(output[4:]) == ["listed a/ (2)", "listed b/ (1)"]
+
+
+class FakeTask:
+    def __init__(self, name, failures=(), delay=0.0):
+        self.name = name
+        self.failures = list(failures)
+        self.delay = delay
+        self.calls = 0
+
+    def size(self):
+        return 1
+
+    def exec(self, worker=None):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.failures:
+            raise self.failures.pop(0)
+        worker.cb_queue.put((self.name, 100, 1))
+
+
+def _executor(threads, **kwargs):
+    return workers.Executor(
+        threads,
+        output=[""] * (threads + 1),
+        tasks_total=kwargs.pop("tasks_total", 1),
+        size_total=1,
+        backoff=0,
+        **kwargs,
+    )
+
+
+def test_executor_runs_all_workers_with_bounded_queue():
+    tasks_ = [FakeTask(str(index), delay=0.01) for index in range(20)]
+
+    with _executor(4, queue_size=2, tasks_total=20) as executor:
+        futures = [executor.submit(task) for task in tasks_]
+        assert executor.task_queue.maxsize == 2
+        assert len(executor.workers) == 4
+
+    assert [future.result() for future in futures] == tasks_
+
+
+def test_executor_retries_transient_errors_only():
+    flaky = FakeTask("flaky", failures=[ConnectionResetError("reset")])
+    broken = FakeTask("broken", failures=[ValueError("bad")] * 2)
+
+    with _executor(1, retries=2, tasks_total=2) as executor:
+        flaky_future = executor.submit(flaky)
+        broken_future = executor.submit(broken)
+
+    assert flaky_future.result() is flaky
+    assert flaky.calls == 2
+    assert isinstance(broken_future.exception(), ValueError)
+    assert broken.calls == 1
+
+
+def test_executor_cancels_queued_tasks_on_error():
+    started = FakeTask("started", delay=0.2)
+    queued = FakeTask("queued")
+
+    with pytest.raises(KeyboardInterrupt):
+        with _executor(1, tasks_total=2) as executor:
+            first = executor.submit(started)
+            second = executor.submit(queued)
+            time.sleep(0.05)
+            raise KeyboardInterrupt()
+
+    assert first.result() is started
+    assert second.cancelled()
+    assert queued.calls == 0
+
+
+def test_system_progress_counters_use_deltas():
+    system = workers._System(
+        index=0,
+        cb_queue=None,
+        output=[""],
+        tasks_total=2,
+        size_total=30,
+    )
+
+    system.handler_cb("a", 50, 5)
+    system.handler_cb("b", 10, 2)
+    system.handler_cb("a", 100, 10)
+    # retried task restarts from zero
+    system.handler_cb("b", 0, 0)
+
+    assert system.tasks_processed == 1
+    assert system.progress == 100
+    assert system.size == 10
+    assert system.tasks_active == {"b": (0, 0)}
+
+    system.draw()
+    assert system.output[0].endswith("1/2")
+
+
+def test_system_redraw_is_rate_limited(monkeypatch):
+    draws = []
+    monkeypatch.setattr(
+        workers._System, "draw", lambda self: draws.append(self.size)
+    )
+    cb_queue = workers.queue.Queue()
+    system = workers._System(
+        index=0,
+        cb_queue=cb_queue,
+        output=[""],
+        tasks_total=1,
+        size_total=1000,
+        interval=60,
+    )
+    for index in range(1, 101):
+        cb_queue.put(("a", index, index * 10))
+    cb_queue.put(None)
+
+    system.run()
+
+    # first message and final redraw only
+    assert draws == [10, 1000]
+    assert system.output[-1].startswith("done 1/1 tasks")
+
+
+def test_system_estimate_counts_task_cost(monkeypatch):
+    system = workers._System(
+        index=0,
+        cb_queue=None,
+        output=[""],
+        tasks_total=4,
+        size_total=0,
+        task_cost=10,
+    )
+    monkeypatch.setattr(workers.time, "time", lambda: system._t + 30)
+
+    # only metadata tasks: bytes say nothing, tasks do
+    system.handler_cb("a", 100, 0)
+    system.draw()
+
+    assert "Est: 0:01:30" in system.output[0]
+
+
+def test_schedule_lanes():
+    assert schedule.lanes_for(4, {"meta", "small", "large"}) == [
+        "meta",
+        "small",
+        "large",
+        "large",
+    ]
+    assert schedule.lanes_for(2, {"meta", "small"}) == ["meta", "large"]
+    assert schedule.lanes_for(3, {"large"}) == ["large"] * 3
+
+
+def test_schedule_order_largest_first_with_lanes():
+    items = [
+        ("s1", 1),
+        ("big", 100),
+        ("s2", 1),
+        ("delete", 0),
+        ("mid", 50),
+        ("s3", 1),
+        ("s4", 1),
+    ]
+
+    ordered = schedule.order(items, threads=3, small_size=10, task_cost=1)
+
+    # lanes start together, small ones keep going while large run
+    assert ordered == ["delete", "s1", "big", "s2", "s3", "s4", "mid"]
+    assert schedule.order([], threads=3, small_size=10, task_cost=0) == []
+
+
+def test_controller_hill_climbs_goodput(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(workers.time, "monotonic", lambda: now[0])
+    controller = workers._Controller(1, 8, interval=1, task_cost=0)
+    assert controller.limit == 4
+
+    def _window(size, errors=0):
+        now[0] += 1
+        controller.record(size=size, errors=errors)
+        return controller.limit
+
+    # baseline, then growth while goodput improves
+    assert [_window(100), _window(200), _window(300)] == [4, 5, 6]
+    # growth without improvement is undone, plateau is probed
+    assert [_window(300), _window(300), _window(300)] == [5, 6, 5]
+    # transient errors halve the limit, baseline is taken again
+    assert [_window(300, errors=1), _window(50)] == [2, 2]
+
+
+def test_executor_adaptive_limit_pauses_workers():
+    tasks_ = [FakeTask(str(index), delay=0.01) for index in range(10)]
+
+    with _executor(4, adaptive=True, tasks_total=10) as executor:
+        executor.controller.interval = 60
+        futures = [executor.submit(task) for task in tasks_]
+        concurrent.futures.wait(futures)
+
+    assert executor.controller.limit == 2
+    assert [future.result() for future in futures] == tasks_
+
+
+def test_token_bucket_sleeps_off_debt(monkeypatch):
+    now = [0.0]
+    sleeps = []
+    monkeypatch.setattr(throttle.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(throttle.time, "sleep", sleeps.append)
+    bucket = throttle.TokenBucket(1000)
+
+    assert bucket.consume(500) == 0.5
+    now[0] += 0.5
+    assert bucket.consume(250) == 0.25
+    # idle time saves at most burst (1 second) of tokens
+    now[0] += 10
+    assert bucket.consume(1500) == 0.5
+    assert sleeps == [0.5, 0.25, 0.5]
+
+    bucket = throttle.TokenBucket(lambda: 0)
+    assert bucket.consume(10**9) == 0
+
+
+def test_bandwidth_schedule():
+    schedule = {"08:00-20:00": "512K", "23:00-02:00": 0}
+
+    assert throttle.parse_rate("2.5M") == 2.5 * 1024**2
+    assert throttle.parse_rate("100") == 100
+    assert [
+        throttle.rate_for("1M", schedule, now=datetime.time(hour))
+        for hour in (9, 1, 21)
+    ] == [512 * 1024, 0, 1024**2]
+
+
+class FakePart:
+    def __init__(self, part_number, etag):
+        self.part_number = part_number
+        self.etag = etag
+
+
+class FakeMultiPartUpload:
+    def __init__(self, key_name, upload_id="mp1"):
+        self.key_name = key_name
+        self.id = upload_id
+        self.parts = {}
+        self.completed = False
+
+    def __iter__(self):
+        return iter(
+            FakePart(num, '"{}"'.format(hashlib.md5(data).hexdigest()))
+            for num, data in sorted(self.parts.items())
+        )
+
+    def upload_part_from_file(self, fp, part_num, cb=None, **kwargs):
+        self.parts[part_num] = fp.read()
+        if cb:
+            cb(len(self.parts[part_num]), len(self.parts[part_num]))
+
+    def complete_upload(self):
+        self.completed = True
+        result = type("Complete", (), {})()
+        result.etag = multipart.multipart_etag(
+            [
+                hashlib.md5(data).digest()
+                for _, data in sorted(self.parts.items())
+            ]
+        )
+        return result
+
+
+class FakeMultipartBucket:
+    def __init__(self):
+        self.uploads = []
+
+    def initiate_multipart_upload(self, key_name):
+        mp = FakeMultiPartUpload(key_name, "mp{}".format(len(self.uploads)))
+        self.uploads.append(mp)
+        return mp
+
+    def get_all_multipart_uploads(self, prefix=""):
+        return [mp for mp in self.uploads if mp.key_name.startswith(prefix)]
+
+    def cancel_multipart_upload(self, key_name, upload_id):
+        self.uploads = [mp for mp in self.uploads if mp.id != upload_id]
+
+
+def test_multipart_upload_etag_and_progress(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "cache", db)
+    path = tmp_path / "video.mp4"
+    path.write_bytes(os.urandom(2500))
+    bucket = FakeMultipartBucket()
+    progress = []
+
+    etag = multipart.upload(
+        bucket,
+        "video.mp4",
+        str(path),
+        callback=lambda sent, total: progress.append((sent, total)),
+        chunk_size=1000,
+    )
+
+    data = path.read_bytes()
+    expected = hashlib.md5(
+        b"".join(
+            hashlib.md5(data[offset : offset + 1000]).digest()
+            for offset in (0, 1000, 2000)
+        )
+    ).hexdigest()
+    assert etag == '"{}-3"'.format(expected)
+    assert bucket.uploads[0].completed
+    assert max(progress) == (2500, 2500)
+    assert db.upload_get("video.mp4") is None
+
+
+def test_multipart_upload_without_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "cache", cache.Cache())
+    path = tmp_path / "video.mp4"
+    path.write_bytes(os.urandom(2500))
+    bucket = FakeMultipartBucket()
+
+    multipart.upload(bucket, "video.mp4", str(path), chunk_size=1000)
+
+    assert bucket.uploads[0].completed
+
+
+def test_multipart_upload_resumes_unfinished_parts(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "cache", db)
+    path = tmp_path / "video.mp4"
+    data = os.urandom(2500)
+    path.write_bytes(data)
+    stat = path.stat()
+
+    bucket = FakeMultipartBucket()
+    mp = bucket.initiate_multipart_upload("video.mp4")
+    mp.parts[1] = data[:1000]
+    db.upload_save(
+        {
+            "name": "video.mp4",
+            "upload_id": mp.id,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "part_size": 1000,
+        }
+    )
+    uploaded = []
+    monkeypatch.setattr(
+        mp,
+        "upload_part_from_file",
+        lambda fp, num, **kwargs: uploaded.append(num)
+        or mp.parts.__setitem__(num, fp.read()),
+    )
+
+    multipart.upload(bucket, "video.mp4", str(path), chunk_size=1000)
+
+    assert len(bucket.uploads) == 1
+    assert sorted(uploaded) == [2, 3]
+    assert mp.completed
+
+
+@pytest.fixture()
+def ranged_bucket(monkeypatch):
+    bucket = type("RangedBucket", (), {"data": {}, "requests": []})()
+
+    def get_contents_as_string(self, headers=None, cb=None, num_cb=10):
+        start, end = headers["Range"][len("bytes=") :].split("-")
+        bucket.requests.append(int(start))
+        return self.bucket.data[self.name][int(start) : int(end) + 1]
+
+    monkeypatch.setattr(
+        boto.s3.key.Key, "get_contents_as_string", get_contents_as_string
+    )
+    return bucket
+
+
+def _cached_key(bucket, name, data, etag=None):
+    if etag is None:
+        etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+    bucket.data[name] = data
+    return utils.S3KeyCached(
+        bucket=bucket, name=name, size=len(data), last_modified="", etag=etag
+    )
+
+
+def test_download_ranges_verified(db, tmp_path, monkeypatch, ranged_bucket):
+    monkeypatch.setattr(cache, "cache", db)
+    key = _cached_key(ranged_bucket, "video.mp4", os.urandom(2500))
+    path = str(tmp_path / "video.mp4")
+
+    download.download(key, path, chunk_size=1000)
+
+    assert sorted(ranged_bucket.requests) == [0, 1000, 2000]
+    assert open(path, "rb").read() == ranged_bucket.data["video.mp4"]
+    assert not os.path.exists(path + ".s3part")
+
+
+def test_download_resumes_ranges(db, tmp_path, monkeypatch, ranged_bucket):
+    monkeypatch.setattr(cache, "cache", db)
+    data = os.urandom(2500)
+    key = _cached_key(ranged_bucket, "video.mp4", data)
+    path = str(tmp_path / "video.mp4")
+    with open(path + ".s3part", "wb") as file:
+        file.write(data[:1000] + bytes(1500))
+    db.range_done(key.name, key.etag, 1000, 1)
+
+    download.download(key, path, chunk_size=1000)
+
+    assert sorted(ranged_bucket.requests) == [1000, 2000]
+    assert open(path, "rb").read() == data
+
+
+def test_download_without_cache(tmp_path, monkeypatch, ranged_bucket):
+    monkeypatch.setattr(cache, "cache", cache.Cache())
+    key = _cached_key(ranged_bucket, "video.mp4", os.urandom(2500))
+    path = str(tmp_path / "video.mp4")
+
+    download.download(key, path, chunk_size=1000)
+
+    assert open(path, "rb").read() == ranged_bucket.data["video.mp4"]
+
+
+def test_download_etag_mismatch(db, tmp_path, monkeypatch, ranged_bucket):
+    monkeypatch.setattr(cache, "cache", db)
+    key = _cached_key(ranged_bucket, "a.bin", b"abc" * 100, etag='"bad"')
+    path = str(tmp_path / "a.bin")
+
+    with pytest.raises(download.davo.errors.Error):
+        download.download(key, path, chunk_size=100)
+
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + ".s3part")
+
+
+def test_file_etag_multipart(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        conf, "_CONFIG", {**conf._CONFIG, "MULTIPART_CHUNK_SIZE": 100}
+    )
+    data = os.urandom(250)
+    path = tmp_path / "a.bin"
+    path.write_bytes(data)
+    etag = multipart.multipart_etag(
+        [hashlib.md5(data[i : i + 100]).digest() for i in (0, 100, 200)]
+    )
+
+    assert download.file_etag(str(path), etag, 250) == etag.strip('"')
+    assert download.file_etag(str(path), '"x-2"', 250) is None
+
+
+def test_local_hashes_reuse_index_until_stat_changes(
+    db, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(cache, "cache", db)
+    path = tmp_path / "a.jpg"
+    path.write_bytes(b"photo")
+    calls = []
+    file_hashes = multipart.file_hashes
+    monkeypatch.setattr(
+        multipart,
+        "file_hashes",
+        lambda *args: calls.append(args) or file_hashes(*args),
+    )
+
+    hashes = utils.local_hashes(str(path))
+    assert hashes[0] == hashlib.md5(b"photo").hexdigest()
+    assert utils.local_hashes(str(path)) == hashes
+    assert len(calls) == 1
+
+    os.utime(path, ns=(0, 0))
+    utils.local_hashes(str(path))
+    assert len(calls) == 2
+
+
+def test_etag_matches_plain_and_multipart():
+    hashes = ("abc", "def-2")
+
+    assert utils.etag_matches(hashes, '"abc"')
+    assert utils.etag_matches(hashes, "def-2")
+    assert not utils.etag_matches(hashes, '"def"')
+    assert not utils.etag_matches(hashes, None)
+
+
+def _remote_key(name, size=1, etag="e"):
+    return utils.S3KeyCached(
+        bucket=None, **_record(name, size, '"{}"'.format(etag))
+    )
+
+
+def _local_file(tmp_path, name, data=b"x"):
+    path = tmp_path / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return name, str(path)
+
+
+def test_merge_join_sorted_streams():
+    joined = list(
+        diff.merge_join(
+            [("a", 1), ("b/c", 2), ("d", 3)],
+            [("a", "ra"), ("b.txt", "rb"), ("d", "rd"), ("e", "re")],
+        )
+    )
+    assert joined == [
+        ("a", 1, "ra"),
+        ("b.txt", None, "rb"),
+        ("b/c", 2, None),
+        ("d", 3, "rd"),
+        ("e", None, "re"),
+    ]
+
+
+def test_iter_diff_states(db, tmp_path):
+    local = [
+        _local_file(tmp_path, "new", b"n"),
+        _local_file(tmp_path, "same", b"s"),
+        _local_file(tmp_path, "size", b"bigger"),
+    ]
+    remote = [
+        (name, _remote_key(name)) for name in ("gone", "same", "size")
+    ]
+
+    records = dict(diff.iter_diff(local, remote))
+
+    assert {key: record.state for key, record in records.items()} == {
+        "gone": constants.STATE_LOCAL_MISSING,
+        "new": constants.STATE_LOCAL_NEW,
+        "same": constants.STATE_EQUAL,
+        "size": constants.STATE_LOCAL_NEWER,
+    }
+    assert records["size"]["comment"][0] == "size: 600.00%"
+    assert records["new"].get("local_size") == 1
+    with pytest.raises(KeyError):
+        records["new"]["missing"]  # pylint: disable=pointless-statement
+
+
+def test_match_renames_by_size_and_md5(db, tmp_path):
+    data = b"renamed"
+    local = [
+        _local_file(tmp_path, "a_new", b"other!!"),
+        _local_file(tmp_path, "b_new", data),
+    ]
+    remote = [
+        ("old", _remote_key("old", len(data), hashlib.md5(data).hexdigest()))
+    ]
+
+    files = dict(diff.iter_diff(local, remote))
+    assert diff.match_renames(dict(files)) == 1
+    assert files["old"].local_name == "a_new"
+
+    files = dict(diff.iter_diff(local, remote))
+    assert diff.match_renames(files, md5=True) == 1
+    assert list(files) == ["a_new", "old"]
+    assert files["old"].state == constants.STATE_RENAMED
+    assert files["old"].local_name == "b_new"
+    assert files["old"].comment == ["new: b_new"]
+
+
+def test_match_renames_hashes_only_size_candidates(db, tmp_path, monkeypatch):
+    local = [_local_file(tmp_path, "new", b"n")]
+    remote = [("old", _remote_key("old", size=5))]
+    files = dict(diff.iter_diff(local, remote))
+
+    monkeypatch.setattr(utils, "local_hashes", pytest.fail)
+    assert diff.match_renames(files, md5=True) == 0
+
+
+def _s3_bucket(name="bucket"):
+    conn = boto.s3.connection.S3Connection(
+        "access", "secret", host="s3.example.com"
+    )
+    return conn.get_bucket(name, validate=False)
+
+
+def test_worker_report_without_output_logs(caplog):
+    worker = workers._Worker(0, None, None, threading.Event())
+
+    with caplog.at_level(logging.INFO, logger=workers.__name__):
+        worker.report("done")
+
+    assert caplog.messages == ["done"]
+
+
+def test_thread_bucket_is_per_thread():
+    bucket = _s3_bucket()
+    handles = []
+
+    def _get():
+        handles.append(connections.thread_bucket(bucket))
+        handles.append(connections.thread_bucket(bucket))
+
+    for _ in range(2):
+        thread = threading.Thread(target=_get)
+        thread.start()
+        thread.join()
+
+    assert handles[0] is handles[1]
+    assert handles[1] is not handles[2]
+    assert handles[0].connection is not bucket.connection
+    assert handles[0].connection.host == "s3.example.com"
+    assert handles[0].connection.aws_secret_access_key == "secret"
+    assert connections.thread_bucket(FakeBucket([])).names == []
+
+
+def test_cached_key_built_without_request(monkeypatch):
+    bucket = _s3_bucket()
+    monkeypatch.setattr(
+        boto.s3.connection.S3Connection, "make_request", pytest.fail
+    )
+    cached = utils.S3KeyCached(bucket=bucket, **_record("a/b", 5, '"e"'))
+
+    key = cached._key()
+
+    assert key.bucket.connection is not bucket.connection
+    assert (key.name, key.size, key.etag) == ("a/b", 5, '"e"')
+
+
+class FakeDeleteBucket:
+    def __init__(self, failed=()):
+        self.failed = set(failed)
+        self.requests = []
+
+    def delete_keys(self, names, quiet=False):
+        self.requests.append(list(names))
+        result = boto.s3.multidelete.MultiDeleteResult()
+        result.errors = [
+            boto.s3.multidelete.Error(name, code="AccessDenied", message="no")
+            for name in names
+            if name in self.failed
+        ]
+        return result
+
+
+def test_batch_deletes_groups_remote_deletes():
+    plan = [
+        (tasks.DeleteRemote, "a", {"name": "a"}),
+        (tasks.Upload, "b", {"name": "b"}),
+        (tasks.DeleteRemote, "c", {"name": "c"}),
+        (tasks.DeleteRemote, "d", {"name": "d"}),
+    ]
+
+    batched = handlers._batch_deletes(plan, batch_size=2)
+
+    assert [(cls, name) for cls, name, _data in batched] == [
+        (tasks.Upload, "b"),
+        (tasks.DeleteRemoteBatch, "a (2 keys)"),
+        (tasks.DeleteRemoteBatch, "d (1 keys)"),
+    ]
+    assert batched[1][2] == [{"name": "a"}, {"name": "c"}]
+    assert handlers._batch_deletes(plan, batch_size=1) == plan
+
+
+def test_delete_remote_batch_reports_failed_keys(db, monkeypatch):
+    monkeypatch.setattr(cache, "cache", db)
+    db.bulk_update(_record(name) for name in ("a", "b", "c"))
+    bucket = FakeDeleteBucket(failed={"b"})
+    data = [
+        {"key": _remote_key(name), "comment": []} for name in ("a", "b", "c")
+    ]
+
+    with _executor(1) as executor:
+        task = tasks.DeleteRemoteBatch().init(bucket, "a (3 keys)", data)
+        future = executor.submit(task)
+    future.result()
+
+    assert bucket.requests == [["a", "b", "c"]]
+    assert [row["name"] for row in db.select()] == ["b"]
+    assert data[0]["comment"] == ["deleted from s3"]
+    assert data[1]["comment"] == ["delete failed: AccessDenied no"]
+    assert task.done == "deleted (remote) 2/3"
+
+
+def test_delete_remote_batch_without_cache(monkeypatch):
+    monkeypatch.setattr(cache, "cache", cache.Cache())
+    bucket = FakeDeleteBucket()
+    data = [{"key": _remote_key(name), "comment": []} for name in ("a", "b")]
+
+    with _executor(1) as executor:
+        task = tasks.DeleteRemoteBatch().init(bucket, "a (2 keys)", data)
+        future = executor.submit(task)
+    future.result()
+
+    assert bucket.requests == [["a", "b"]]
+    assert data[1]["comment"] == ["deleted from s3"]
+
+
+def test_split_move_strips_common_tail():
+    assert rename.split_move("p/2020/trip/a.jpg", "p/2021/trip/a.jpg") == (
+        "p/2020/",
+        "p/2021/",
+    )
+    assert rename.split_move("a/x.jpg", "x.jpg") == ("a/", "")
+    assert rename.split_move("a/x.jpg", "a/y.jpg") == ("a/x.jpg", "a/y.jpg")
+
+
+def test_group_moves_by_prefix_change():
+    moves = rename.group_moves(
+        [
+            ("k1", "p/old/a/1", "p/new/a/1"),
+            ("k2", "p/old/b/2", "p/new/b/2"),
+            ("k3", "x", "y"),
+        ]
+    )
+
+    assert [str(move) for move in moves] == [
+        "p/old/* -> p/new/* (2 keys)",
+        "x -> y",
+    ]
+    assert moves[0].names == ["k1", "k2"]
+
+
+class FakeCopyUpload(FakeMultiPartUpload):
+    def __init__(self, key_name, upload_id, objects):
+        super().__init__(key_name, upload_id)
+        self.objects = objects
+
+    def copy_part_from_key(self, bucket_name, source, part_num, start, end):
+        self.parts[part_num] = self.objects[source][start : end + 1]
+
+    def complete_upload(self):
+        result = super().complete_upload()
+        self.objects[self.key_name] = b"".join(
+            data for _, data in sorted(self.parts.items())
+        )
+        return result
+
+
+class FakeCopyBucket(FakeDeleteBucket, FakeMultipartBucket):
+    name = "bucket"
+
+    def __init__(self, objects, failed=()):
+        FakeDeleteBucket.__init__(self, failed)
+        FakeMultipartBucket.__init__(self)
+        self.objects = objects
+
+    def copy_key(self, dest, bucket_name, source, preserve_acl=False):
+        self.objects[dest] = self.objects[source]
+        key = boto.s3.key.Key(name=dest)
+        key.etag = '"{}"'.format(hashlib.md5(self.objects[dest]).hexdigest())
+        return key
+
+    def initiate_multipart_upload(self, key_name):
+        mp = FakeCopyUpload(key_name, "mp", self.objects)
+        self.uploads.append(mp)
+        return mp
+
+    def get_xml_acl(self, name):
+        return "<acl/>"
+
+    def set_xml_acl(self, acl, name):
+        pass
+
+
+class FakeUploadBucket:
+    name = "bucket"
+
+    def __init__(self, existing=()):
+        self.existing = set(existing)
+        self.uploaded = []
+
+    def lookup(self, name):
+        return name in self.existing
+
+
+@pytest.mark.parametrize(
+    "task_cls, comment",
+    [
+        (tasks.Upload, "exists on s3, skipped"),
+        (tasks.ReplaceUpload, "uploaded(replaced)"),
+    ],
+)
+def test_upload_keeps_concurrently_written_key(
+    tmp_path, monkeypatch, task_cls, comment
+):
+    monkeypatch.setattr(cache, "cache", cache.Cache())
+    local_path = tmp_path / "a.txt"
+    local_path.write_bytes(b"local")
+    bucket = FakeUploadBucket(existing={"a.txt"})
+
+    def _set_contents(key, file, replace=False, **kwargs):
+        assert replace
+        bucket.uploaded.append((key.name, file.read()))
+
+    monkeypatch.setattr(
+        boto.s3.key.Key, "set_contents_from_file", _set_contents
+    )
+    data = {
+        "key": boto.s3.key.Key(bucket=bucket, name="a.txt"),
+        "local_path": str(local_path),
+        "comment": [],
+    }
+
+    with _executor(1) as executor:
+        future = executor.submit(task_cls().init(bucket, "a.txt", data))
+    future.result()
+
+    assert data["comment"] == [comment]
+    assert bucket.uploaded == (
+        [] if task_cls is tasks.Upload else [("a.txt", b"local")]
+    )
+
+
+def test_batch_renames_groups_moves():
+    plan = [
+        (
+            tasks.RenameRemote,
+            "old/{}".format(num),
+            {
+                "key": _remote_key("old/{}".format(num)),
+                "local_name": "new/{}".format(num),
+            },
+        )
+        for num in range(3)
+    ]
+    plan.append((tasks.Upload, "up", {}))
+
+    batched = handlers._batch_renames(plan, batch_size=2)
+
+    assert [(cls, name, len(data)) for cls, name, data in batched] == [
+        (tasks.Upload, "up", 0),
+        (tasks.RenameRemoteBatch, "old/* -> new/* (3 keys) [1/2]", 2),
+        (tasks.RenameRemoteBatch, "old/* -> new/* (3 keys) [2/2]", 1),
+    ]
+
+
+def test_rename_remote_batch_copies_then_deletes(db, monkeypatch):
+    monkeypatch.setattr(cache, "cache", db)
+    monkeypatch.setitem(conf._CONFIG, "MULTIPART_THRESHOLD", 2000)
+    monkeypatch.setitem(conf._CONFIG, "MULTIPART_CHUNK_SIZE", 1000)
+    objects = {
+        "old/small": b"s",
+        "old/large": os.urandom(2500),
+        "old/denied": b"d",
+    }
+    db.bulk_update(
+        _record(name, len(data)) for name, data in objects.items()
+    )
+    bucket = FakeCopyBucket(objects, failed={"old/denied"})
+    data = [
+        {
+            "key": _remote_key(name, len(objects[name])),
+            "size": len(objects[name]),
+            "local_name": name.replace("old/", "new/"),
+            "comment": [],
+        }
+        for name in sorted(objects)
+    ]
+
+    with _executor(1) as executor:
+        task = tasks.RenameRemoteBatch().init(bucket, "old/* -> new/*", data)
+        future = executor.submit(task)
+    future.result()
+
+    assert objects["new/large"] == objects["old/large"]
+    assert bucket.uploads[0].completed
+    assert bucket.requests == [["old/denied", "old/large", "old/small"]]
+    assert {row["name"]: row["etag"] for row in db.select()} == {
+        "new/denied": '"{}"'.format(hashlib.md5(b"d").hexdigest()),
+        "new/large": bucket.uploads[0].complete_upload().etag,
+        "new/small": '"{}"'.format(hashlib.md5(b"s").hexdigest()),
+        "old/denied": "e",
+    }
+    assert data[0]["comment"] == ["rename failed: AccessDenied no"]
+    assert task.done == "renamed (remote) 2/3"
+
+
+def test_rename_remote_batch_without_cache_uses_thread_bucket(monkeypatch):
+    monkeypatch.setattr(cache, "cache", cache.Cache())
+    monkeypatch.setitem(conf._CONFIG, "MULTIPART_THRESHOLD", 2000)
+    monkeypatch.setitem(conf._CONFIG, "MULTIPART_CHUNK_SIZE", 1000)
+    objects = {"old/large": os.urandom(2500)}
+    bucket = FakeCopyBucket(objects)
+    handle = FakeCopyBucket(objects)
+    monkeypatch.setattr(connections, "thread_bucket", lambda _bucket: handle)
+    data = [
+        {
+            "key": _remote_key("old/large", 2500),
+            "size": 2500,
+            "local_name": "new/large",
+            "comment": [],
+        }
+    ]
+
+    with _executor(1) as executor:
+        task = tasks.RenameRemoteBatch().init(bucket, "old/* -> new/*", data)
+        future = executor.submit(task)
+    future.result()
+
+    assert objects["new/large"] == objects["old/large"]
+    assert handle.uploads[0].completed
+    assert not bucket.uploads
+    assert handle.requests == [["old/large"]]
+    assert task.done == "renamed (remote)"
+
+
+def test_cache_writer_group_commits(db, monkeypatch):
+    commits = []
+    monkeypatch.setattr(db, "flush", lambda: commits.append(db.conn.commit()))
+
+    with db.writer(interval=60, size=3) as writer:
+        for num in range(4):
+            db.write_update("k{}".format(num), _record("k{}".format(num)))
+        db.write_delete("k0")
+
+    assert writer.commits == 2
+    assert [row["name"] for row in db.select()] == ["k1", "k2", "k3"]
+    # without writer changes are committed at once
+    db.write_delete("k1")
+    assert len(commits) == 3
+
+
+def test_cache_writer_commits_on_interrupt(db):
+    with pytest.raises(KeyboardInterrupt):
+        with db.writer(interval=60, size=100):
+            db.write_update("a", _record("a"))
+            raise KeyboardInterrupt()
+
+    db.conn.rollback()
+    assert [row["name"] for row in db.select()] == ["a"]
+
+
+def test_cache_writer_changes_survive_failed_transaction(db, tmp_path):
+    def records():
+        yield _record("listed")
+        raise RuntimeError("listing failed")
+
+    with db.writer(interval=60, size=100):
+        db.write_update("w", _record("w"))
+        deadline = time.time() + 5
+        while db.select_one("w") is None and time.time() < deadline:
+            time.sleep(0.01)
+        with pytest.raises(RuntimeError):
+            db.refresh_prefix("", records())
+        with pytest.raises(RuntimeError):
+            db.bulk_update(records())
+
+    conn = sqlite3.connect(str(tmp_path / ".s3cache-test.db"))
+    assert conn.execute("SELECT name FROM s3keys").fetchall() == [("w",)]
+    conn.close()
+
+
+def test_cache_writer_keeps_first_error(db):
+    def _fail(message):
+        raise ValueError(message)
+
+    writer = cache.Writer(db, interval=60, size=100)
+    writer.start()
+    writer.queue.put((_fail, ("first",)))
+    writer.queue.put((_fail, ("second",)))
+
+    with pytest.raises(ValueError, match="first"):
+        writer.close()
+
+
+def test_metrics_report_formats(tmp_path):
+    registry = metrics.Metrics()
+    registry.inc("requests_total", label="GET")
+    registry.inc("requests_total", 2, "PUT")
+    registry.inc("retries_total")
+    registry.set("worker_utilization", 0.5, "1")
+
+    assert registry.report() == {
+        "requests_total": {"GET": 1, "PUT": 2},
+        "retries_total": 1,
+        "worker_utilization": {"1": 0.5},
+    }
+
+    path = str(tmp_path / "s3sync.prom")
+    registry.write(path, "update")
+    with open(path) as file:
+        lines = file.read().splitlines()
+    assert "# TYPE s3sync_requests_total counter" in lines
+    assert 's3sync_requests_total{command="update",method="PUT"} 2' in lines
+    assert 's3sync_retries_total{command="update"} 1' in lines
+
+    path = str(tmp_path / "s3sync.jsonl")
+    registry.write(path, "diff")
+    registry.write(path, "diff")
+    with open(path) as file:
+        records = [json.loads(line) for line in file]
+    assert len(records) == 2
+    assert records[0]["command"] == "diff"
+    assert records[0]["requests_total"] == {"GET": 1, "PUT": 2}
+
+
+def test_metrics_instrument_writes_outermost(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "metrics", metrics.Metrics())
+    path = tmp_path / "metrics.jsonl"
+
+    @metrics.instrument("diff")
+    def _inner(_namespace):
+        metrics.metrics.inc("keys_total", 3, "local")
+
+    @metrics.instrument("update")
+    def _outer(namespace):
+        _inner(namespace)
+        metrics.metrics.inc("tasks_total", label="upload")
+
+    namespace = argparse.Namespace(metrics=str(path))
+    _outer(namespace)
+    _outer(namespace)
+
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [record["command"] for record in records] == ["update", "update"]
+    # reset per command
+    assert records[1]["keys_total"] == {"local": 3}
+    assert records[1]["tasks_total"] == {"upload": 1}
+    assert set(records[1]["phase_seconds"]) == {"total"}
+
+
+def test_connection_counts_requests(monkeypatch):
+    monkeypatch.setattr(metrics, "metrics", metrics.Metrics())
+    monkeypatch.setattr(
+        boto.s3.connection.S3Connection,
+        "make_request",
+        lambda self, method, *args, **kwargs: method,
+    )
+    conn = connections.Connection("a", "b")
+
+    conn.make_request("GET", "bucket", "key")
+    conn.make_request("GET", "bucket", "key")
+    conn.make_request("DELETE", "bucket", "key")
+
+    assert metrics.metrics.report() == {
+        "requests_total": {"DELETE": 1, "GET": 2}
+    }
+
+
+def test_manifest_export_and_verify(tmp_path):
+    root = tmp_path / "root"
+    root.joinpath("b").mkdir(parents=True)
+    root.joinpath("a").write_bytes(b"aa")
+    root.joinpath("b", "c").write_bytes(b"ccc")
+    md5_a = hashlib.md5(b"aa").hexdigest()
+
+    def _items():
+        local = [
+            ("a", str(root / "a")),
+            ("b/c", str(root / "b" / "c")),
+        ]
+        remote = [
+            ("a", {"size": 2, "etag": '"{}"'.format(md5_a)}),
+            ("gone", {"size": 1, "etag": '"e"'}),
+        ]
+        return diff.merge_join(local, remote)
+
+    target = manifest.Manifest(str(tmp_path / "manifest.db"))
+    with concurrent.futures.ProcessPoolExecutor(2) as pool:
+        assert manifest.export(target, _items(), str(root), pool, 4) == (3, 2)
+        # unchanged files are kept as is
+        assert manifest.export(target, _items(), str(root), pool, 4) == (0, 0)
+
+        entries = {entry["name"]: entry for entry in target.iter_entries()}
+        assert entries["a"]["md5"] == entries["a"]["etag"] == md5_a
+        assert entries["gone"]["md5"] is None
+        assert entries["gone"]["remote_size"] == 1
+
+        root.joinpath("a").unlink()
+        root.joinpath("b", "c").write_bytes(b"CCC")
+        run, failed = manifest.verify(target, pool, 4)
+
+        assert sorted(failed) == [("a", "missing"), ("b/c", "changed")]
+        assert target.verify_summary(run) == {"changed": 1, "missing": 1}
+        # finished run isn't resumed
+        assert manifest.verify(target, pool, 4)[0] == run + 1
+    target.close()
+
+
+def test_manifest_verify_skips_unreadable_files(tmp_path, monkeypatch):
+    root = tmp_path / "root"
+    root.mkdir()
+    for name in ("a", "b", "c"):
+        root.joinpath(name).write_bytes(name.encode())
+    items = diff.merge_join(
+        [(name, str(root / name)) for name in ("a", "b", "c")], []
+    )
+    target = manifest.Manifest(str(tmp_path / "manifest.db"))
+    file_hashes = multipart.file_hashes
+    failing = set()
+
+    def _file_hashes(path, size, part_size):
+        name = os.path.basename(path)
+        if name == "b" and failing:
+            raise PermissionError("denied")
+        if name in failing:
+            raise RuntimeError("pool broken")
+        return file_hashes(path, size, part_size)
+
+    monkeypatch.setattr(multipart, "file_hashes", _file_hashes)
+    with concurrent.futures.ThreadPoolExecutor(1) as pool:
+        manifest.export(target, items, str(root), pool, 1)
+        failing.update(("b", "c"))
+        with pytest.raises(RuntimeError):
+            manifest.verify(target, pool, 1)
+        # results checked before error are saved and not checked again
+        assert target.verify_summary(0) == {"error": 1, "ok": 1}
+
+        failing.discard("c")
+        run, failed = manifest.verify(target, pool, 1)
+
+    assert (run, failed) == (0, [])
+    assert target.verify_summary(run) == {"error": 1, "ok": 2}
+    target.close()
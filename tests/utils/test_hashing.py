@@ -0,0 +1,69 @@
+import hashlib
+import os
+import zlib
+
+import pytest
+
+from davo.services.s3sync import multipart
+from davo.utils import hashing, path
+
+
+@pytest.fixture()
+def data_file(tmp_path):
+    data = os.urandom(2 * 1024 + 100)
+    file_path = tmp_path / "data.bin"
+    file_path.write_bytes(data)
+    return str(file_path), data
+
+
+def test_hash_file_single_read_matches_reference(data_file):
+    file_path, data = data_file
+    part_size = 1024
+    parts = [data[i : i + part_size] for i in range(0, len(data), part_size)]
+
+    hashes = hashing.hash_file(
+        file_path,
+        (hashing.MD5, hashing.ETAG, hashing.CRC32),
+        part_size=part_size,
+        block_size=300,
+    )
+
+    assert hashes == {
+        hashing.MD5: hashlib.md5(data).hexdigest(),
+        hashing.ETAG: multipart.multipart_etag(
+            [hashlib.md5(part).digest() for part in parts]
+        ).strip('"'),
+        hashing.CRC32: "{:08x}".format(zlib.crc32(data)),
+    }
+    assert multipart.file_hashes(file_path, len(data), part_size) == (
+        hashes[hashing.MD5],
+        hashes[hashing.ETAG],
+    )
+    assert path.file_hash(file_path).hexdigest() == hashes[hashing.MD5]
+
+
+def test_hash_file_empty_etag(tmp_path):
+    file_path = tmp_path / "empty"
+    file_path.write_bytes(b"")
+
+    assert hashing.hash_file(str(file_path), (hashing.ETAG,), 1024) == {
+        hashing.ETAG: multipart.multipart_etag([]).strip('"')
+    }
+    with pytest.raises(ValueError):
+        hashing.new(hashing.ETAG)
+
+
+@pytest.mark.parametrize("threads", [None, 3])
+def test_hash_files_keeps_order_and_reports_errors(tmp_path, threads):
+    paths = []
+    for num in range(20):
+        file_path = tmp_path / "{}.txt".format(num)
+        file_path.write_text(str(num))
+        paths.append(str(file_path))
+    paths.insert(5, str(tmp_path / "missing"))
+
+    results = list(hashing.hash_files(paths, threads=threads))
+
+    assert [file_path for file_path, _ in results] == paths
+    assert isinstance(results[5][1], FileNotFoundError)
+    assert results[0][1] == {hashing.MD5: hashlib.md5(b"0").hexdigest()}
@@ -0,0 +1,172 @@
+import os
+
+import pytest
+
+from davo import constants, errors
+from davo.utils import hashing, path
+
+
+@pytest.fixture()
+def tree(tmp_path):
+    for name in (
+        "a.txt",
+        "a/b.txt",
+        "a/.git/config",
+        "a.b/c.jpg",
+        "a/sub/d.txt",
+        "z.txt",
+    ):
+        file_path = tmp_path.joinpath(*name.split("/"))
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        file_path.write_text(name)
+    os.symlink(tmp_path / "a", tmp_path / "link")
+    return str(tmp_path)
+
+
+def _keys(root, paths):
+    return [os.path.relpath(file_path, root) for file_path in paths]
+
+
+def test_iter_files_sorted_walk(tree):
+    paths = list(path.iter_files(tree, recursive=True, sort=True))
+
+    # symlinked dirs aren't followed
+    assert _keys(tree, paths) == [
+        "a.b/c.jpg",
+        "a.txt",
+        "a/.git/config",
+        "a/b.txt",
+        "a/sub/d.txt",
+        "z.txt",
+    ]
+    assert paths == sorted(paths)
+    assert (
+        list(path.iter_files(tree, recursive=True, sort=True, threads=3))
+        == paths
+    )
+
+
+@pytest.mark.parametrize("threads, listed", [(None, 2), (1, 6)])
+def test_iter_files_lists_dirs_lazily(tmp_path, monkeypatch, threads, listed):
+    for num in range(20):
+        (tmp_path / "d{:02}".format(num)).mkdir()
+        (tmp_path / "d{:02}".format(num) / "f.txt").write_text("")
+    scanned = []
+    scan_dir = path._scan_dir
+
+    def _scan_dir(dir_path):
+        scanned.append(dir_path)
+        return scan_dir(dir_path)
+
+    monkeypatch.setattr(path, "_scan_dir", _scan_dir)
+    walk = path.iter_files(str(tmp_path), True, sort=True, threads=threads)
+
+    assert _keys(str(tmp_path), [next(walk)]) == ["d00/f.txt"]
+    # root, first sub dir and prefetch window of 4 per thread
+    assert len(scanned) <= listed
+    assert len(list(walk)) == 19
+    assert len(scanned) == 21
+
+
+def test_iter_files_exclude_and_depth(tree):
+    exclude = ("/.git/", "^.*\\.jpg$")
+
+    assert _keys(
+        tree, path.iter_files(tree, True, exclude=exclude, sort=True)
+    ) == ["a.txt", "a/b.txt", "a/sub/d.txt", "z.txt"]
+    assert _keys(tree, path.iter_files(tree, True, depth=1, sort=True)) == [
+        "a.txt",
+        "z.txt",
+    ]
+    assert sorted(_keys(tree, path.iter_files(tree))) == ["a.txt", "z.txt"]
+
+
+def test_iter_files_unsorted_lists_files_before_sub_dirs(tree):
+    keys = _keys(tree, path.iter_files(os.path.join(tree, "a"), True))
+
+    assert keys[0] == os.path.join("a", "b.txt")
+    assert sorted(keys) == [
+        os.path.join("a", ".git", "config"),
+        os.path.join("a", "b.txt"),
+        os.path.join("a", "sub", "d.txt"),
+    ]
+
+
+def test_iter_file_entries_single_file(tree):
+    file_path = os.path.join(tree, "a.txt")
+
+    (entry,) = path.iter_file_entries(file_path)
+
+    assert entry.path == file_path
+    assert entry.stat().st_size == len("a.txt")
+    with pytest.raises(errors.UserError):
+        list(path.iter_files(os.path.join(tree, "missing")))
+
+
+def _write(root, name, data):
+    file_path = os.path.join(root, *name.split("/"))
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, "wb") as file:
+        file.write(data)
+
+
+def _renames(files):
+    return {
+        key: data["new_options"]["key"]
+        for key, data in files.items()
+        if data["state"] == constants.STATE_RENAMED
+    }
+
+
+def test_compare_dirs_renames_by_content(tmp_path):
+    src, dest = str(tmp_path / "src"), str(tmp_path / "dest")
+    big = os.urandom(3 * hashing.PARTIAL_SIZE)
+    # same size and ends, differs in the middle only
+    big_changed = bytearray(big)
+    big_changed[len(big) // 2] ^= 1
+    for name, data in (
+        ("moved/a.txt", b"aaaa"),
+        ("moved/big.bin", big),
+        ("other/big.bin", bytes(big_changed)),
+        ("b.txt", b"bbbb"),
+    ):
+        _write(src, name, data)
+    for name, data in (
+        ("a.txt", b"aaaa"),
+        ("big.bin", big),
+        ("c.txt", b"bbbb"),
+    ):
+        _write(dest, name, data)
+
+    files = path.compare_dirs(
+        src, dest, check_size=True, check_md5=True, recursive=True
+    )
+
+    assert _renames(files) == {
+        "a.txt": "moved/a.txt",
+        "big.bin": "moved/big.bin",
+        "c.txt": "b.txt",
+    }
+    assert files["other/big.bin"]["state"] == constants.STATE_LOCAL_NEW
+
+
+def test_compare_renames_many_to_many_deterministic():
+    def _options(key, state):
+        return {"key": key, "size": 1, "path": key, "state": state}
+
+    files_dest = {
+        key: _options(key, constants.STATE_LOCAL_MISSING)
+        for key in ("old/x.txt", "old/y.txt", "old/z.txt")
+    }
+    files_src = [
+        {"key": key, "size": 1, "path": key}
+        for key in ("new/z.txt", "new/b.txt", "new/a.txt")
+    ]
+
+    files = path.compare(files_src, files_dest, check_size=True)
+
+    assert _renames(files) == {
+        "old/z.txt": "new/z.txt",
+        "old/x.txt": "new/a.txt",
+        "old/y.txt": "new/b.txt",
+    }
@@ -0,0 +1,69 @@
+import os
+import shutil
+
+import pytest
+
+from davo import constants, errors
+from davo.utils import path, snapshot
+
+
+@pytest.fixture()
+def roots(tmp_path):
+    for root in ("src", "dest"):
+        for name, data in (("a.txt", "aaaa"), ("b.txt", "bbbb")):
+            file_path = tmp_path / root / name
+            file_path.parent.mkdir(exist_ok=True)
+            file_path.write_text(data)
+    return str(tmp_path / "src"), str(tmp_path / "dest")
+
+
+def _compare(roots, store, **kwargs):
+    return path.compare_dirs(
+        *roots,
+        states="-+~<>r=",
+        check_size=True,
+        check_md5=True,
+        snapshot=store,
+        **kwargs,
+    )
+
+
+def test_compare_dirs_reuses_snapshot_hashes(roots, tmp_path, monkeypatch):
+    store = snapshot.Snapshot(str(tmp_path / "snapshot.db"))
+    _compare(roots, store)
+    assert store.load(roots[1])["a.txt"]["md5"]
+
+    hashed = []
+    file_hash = path.file_hash
+
+    def _file_hash(f_path):
+        hashed.append(f_path)
+        return file_hash(f_path)
+
+    monkeypatch.setattr(path, "file_hash", _file_hash)
+    changed = os.path.join(roots[0], "b.txt")
+    with open(changed, "w") as file:
+        file.write("cccc")
+
+    files = _compare(roots, store)
+
+    assert hashed == [changed]
+    assert files["a.txt"]["state"] == constants.STATE_EQUAL
+    assert files["b.txt"]["state"] == constants.STATE_DIFFERENT
+
+
+def test_compare_dirs_offline_snapshot(roots, tmp_path):
+    store = snapshot.Snapshot(str(tmp_path / "snapshot.db"))
+    with pytest.raises(errors.UserError):
+        _compare(roots, store, snapshot_only=True)
+    _compare(roots, store)
+    shutil.rmtree(roots[1])
+    os.rename(
+        os.path.join(roots[0], "a.txt"), os.path.join(roots[0], "c.txt")
+    )
+
+    files = _compare(roots, store, snapshot_only=True)
+
+    assert files["a.txt"]["state"] == constants.STATE_RENAMED
+    assert files["b.txt"]["state"] == constants.STATE_EQUAL
+    assert not os.path.exists(roots[1])
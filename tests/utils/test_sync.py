@@ -0,0 +1,68 @@
+import os
+
+import pytest
+
+from davo.utils import sync
+
+
+def test_copy_file_keeps_content_and_metadata(tmp_path):
+    source = tmp_path / "source.bin"
+    source.write_bytes(os.urandom(3 * 1024 * 1024 + 7))
+    os.utime(source, ns=(1_000_000_000, 2_000_000_000))
+    dest = str(tmp_path / "dest.bin")
+    copied = []
+
+    assert sync.copy_file(str(source), dest, progress=copied.append) == (
+        sync.STATUS_DONE
+    )
+
+    assert open(dest, "rb").read() == source.read_bytes()
+    assert sum(copied) == source.stat().st_size
+    assert os.stat(dest).st_mtime_ns == 2_000_000_000
+    assert sync.copy_file(str(source), dest) == sync.STATUS_SKIPPED
+
+
+@pytest.mark.parametrize("fallback", ["sendfile", "read"])
+def test_copy_file_falls_back_on_zero_copied(tmp_path, monkeypatch, fallback):
+    source = tmp_path / "source.bin"
+    source.write_bytes(os.urandom(sync.CHUNK_SIZE + 7))
+    dest = str(tmp_path / "dest.bin")
+    monkeypatch.setattr(sync, "_reflink", lambda src_fd, dst_fd: False)
+    monkeypatch.setattr(os, "copy_file_range", lambda *args: 0, raising=False)
+    if fallback == "read":
+        monkeypatch.setattr(os, "sendfile", lambda *args: 0, raising=False)
+    copied = []
+
+    sync.copy_file(str(source), dest, progress=copied.append)
+
+    assert open(dest, "rb").read() == source.read_bytes()
+    assert sum(copied) == source.stat().st_size
+
+
+def test_execute_plan(tmp_path):
+    root = tmp_path / "root"
+    root.mkdir()
+    for name in ("a.txt", "b.txt", "c.txt", "exists.txt"):
+        (root / name).write_text(name)
+    (tmp_path / "out").mkdir()
+    (tmp_path / "out" / "exists.txt").write_text("old")
+    out = str(tmp_path / "out")
+    operations = [
+        sync.copy(str(root / "a.txt"), os.path.join(out, "x", "y", "a.txt")),
+        sync.copy(str(root / "exists.txt"), os.path.join(out, "exists.txt")),
+        sync.copy(str(root / "missing.txt"), os.path.join(out, "m.txt")),
+        sync.move(str(root / "b.txt"), os.path.join(out, "x", "b.txt")),
+        sync.remove(str(root / "c.txt")),
+    ]
+
+    summary = sync.execute(operations, threads=3, commit=True, output=[""])
+
+    assert (summary.done, summary.skipped) == (3, 1)
+    assert [op.source for op, _exc in summary.failed] == [
+        str(root / "missing.txt")
+    ]
+    assert summary.bytes == len("a.txt")
+    assert sorted(os.listdir(root)) == ["a.txt", "exists.txt"]
+    assert (tmp_path / "out" / "x" / "y" / "a.txt").read_text() == "a.txt"
+    assert (tmp_path / "out" / "exists.txt").read_text() == "old"
+    assert (tmp_path / "out" / "x" / "b.txt").read_text() == "b.txt"